@@ -82,39 +82,72 @@ $(document).ready(function() {
     }).appendTo(tbody);
   }
 
+  function receiveMessages(messages) {
+    for (var i = 0; i < messages.length; i++) {
+      if (messages[i].id > cursor) {
+        receiveMessage(messages[i]);
+        cursor = messages[i].id;
+      }
+    }
+  }
+
+  function refresh() {
+    update_values();
+    if($("#sort_check").is(":checked")) {
+      sort_table($("#progress"));
+    } else {
+      unsort_table($("#progress"));
+    }
+  }
+
   var get_posts = function() {
-    if(is_visible()){
-      $.ajax({
-        type: 'get',
-        url: "/staff/progress/",
-        data: {last_solve_pk: last_solve_pk, last_unlock_pk: last_unlock_pk,
-               last_guess_pk: last_guess_pk},
-        success: function (response) {
-          var response = JSON.parse(response);
-          messages = response.messages
-          if(messages.length > 0){
-            for (var i = 0; i < messages.length; i++) {
-              receiveMessage(messages[i]);
-              console.log(messages[i]);
-            };
-            last_solve_pk = response.update_info[0];
-            last_unlock_pk = response.update_info[1];
-            last_guess_pk = response.update_info[2];
-          }
-        },
-        error: function (html) {
-          console.log(html);
-        }
-      });
-      update_values();
-      if($("#sort_check").is(":checked")) {
-        sort_table($("#progress"));
-      } else {
-        unsort_table($("#progress"));
+    $.ajax({
+      type: 'get',
+      url: window.location.pathname,
+      dataType: 'json',
+      data: {cursor: cursor},
+      success: function (response) {
+        receiveMessages(response.messages);
+      },
+      error: function (html) {
+        console.log(html);
       }
+    });
+  }
+
+  /* the events are pushed over a websocket, polling is only the fallback */
+  var polling = false;
+  function startPolling() {
+    polling = true;
+  }
+
+  function connect() {
+    if (!('WebSocket' in window)) {
+      startPolling();
+      return;
     }
+    var ws_scheme = window.location.protocol == "https:" ? "wss://" : "ws://";
+    var sock = new WebSocket(ws_scheme + window.location.host + '/ws/staff/progress/' + episode_pk + '/');
+    // catch up on the events since the page was rendered
+    sock.onopen = get_posts;
+    sock.onmessage = function(e) {
+      var data = JSON.parse(e.data);
+      if (data.type == 'events') {
+        receiveMessages(data.content);
+      }
+    };
+    sock.onclose = startPolling;
   }
-  setInterval(get_posts, 30000);
+  connect();
+
+  setInterval(function() {
+    if(is_visible()){
+      if (polling) {
+        get_posts();
+      }
+      refresh();
+    }
+  }, 30000);
   update_values();
 
 
@@ -133,6 +166,7 @@ $(document).ready(function() {
 
   function receiveMessage(update) {
     $td = $("#p" + update.puzzle.id + "t" + update.team_pk);
+    // the events of a cell may come again or out of order with the page, never go backwards
     if(update.status_type == "solve"){
       $td.removeClass();
       $td.addClass('solved');
@@ -140,13 +174,13 @@ $(document).ready(function() {
       $td.css("background", "");
       $td.data("date", (Date.now()/1000));
     }
-    else if(update.status_type == "unlock"){
+    else if(update.status_type == "unlock" && $td.hasClass('unavailable')){
       $td.removeClass();
       $td.addClass('available');
       $td.data("date", (Date.now()/1000));
       $td.html(" ");
     }
-    else if(update.status_type == "guess"){
+    else if(update.status_type == "guess" && $td.hasClass('available')){
       $td.html("<b>" + update.time_str + "</b>");
     }
   }
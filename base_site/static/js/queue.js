@@ -26,39 +26,69 @@ $(document).ready(function() {
     }
   }, 1000);
 
+  /* cursors are "<microseconds>-<pk>" of the last modification seen, see Guess.queue_cursor */
+  function cursorAfter(a, b) {
+    a = a.split('-').map(Number);
+    b = b.split('-').map(Number);
+    return a[0] > b[0] || (a[0] == b[0] && a[1] > b[1]);
+  }
+
   var get_posts = function() {
     $.ajax({
       type: 'get',
       url: "/staff/queue/",
-      data: {last_date: last_date, all: true, puzzle_id: puzzle_id, team_id: team_id},
+      dataType: 'json',
+      data: {cursor: cursor, puzzle_id: puzzle_id, team_id: team_id},
       success: function (response) {
-        var response = JSON.parse(response);
-        messages = response.guess_list;
-        if(messages.length > 0){
-          for (var i = 0; i < messages.length; i++) {
-            receiveMessage(messages[i]);
-          };
-          last_date = response.last_date;
-        }
+        var guesses = response.guesses;
+        for (var i = 0; i < guesses.length; i++) {
+          receiveMessage(guesses[i]);
+        };
       },
       error: function (html) {
         console.log(html);
       }
     });
   }
-  setInterval(get_posts, 3000);
+
+  /* the guesses are pushed over a websocket, polling is only the fallback */
+  var polling = null;
+  function startPolling() {
+    if (polling === null) {
+      get_posts();
+      polling = setInterval(get_posts, 3000);
+    }
+  }
+
+  function connect() {
+    if (!('WebSocket' in window)) {
+      startPolling();
+      return;
+    }
+    var ws_scheme = window.location.protocol == "https:" ? "wss://" : "ws://";
+    var sock = new WebSocket(ws_scheme + window.location.host + '/ws/staff/queue/?' +
+                             $.param({team_id: team_id, puzzle_id: puzzle_id}));
+    // catch up on the guesses made since the page was rendered
+    sock.onopen = get_posts;
+    sock.onmessage = function(e) {
+      var data = JSON.parse(e.data);
+      if (data.type == 'guess') {
+        receiveMessage(data.content);
+      }
+    };
+    sock.onclose = startPolling;
+  }
+  connect();
 
   function formListener(e) {
     e.preventDefault();
-    old_row = $(this).parent().parent();
     $.ajax({
       url : $(this).attr('action') || window.location.pathname,
       type: "POST",
+      dataType: 'json',
       data: $(this).serialize(),
       success: function (response) {
-        response = JSON.parse(response);
-        old_row.replaceWith($(response.guess_list[0]));
-        $('.sub_form').on('submit', formListener);
+        receiveMessage(response.guesses[0]);
       },
       error: function (jXHR, textStatus, errorThrown) {
         console.log(jXHR);
@@ -66,20 +96,35 @@ $(document).ready(function() {
     });
   }
 
+  var row_classes = {pending: 'warning', correct: 'success', wrong: 'danger'};
+  function renderRow(guess) {
+    var row = $('<tr>').addClass(row_classes[guess.status] + ' guess').attr('data-id', guess.pk);
+    var team_name = guess.team_name.length > 40 ? guess.team_name.substring(0, 39) + '…' : guess.team_name;
+    $('<th scope="row">').css({'max-width': '200px', 'overflow': 'hidden', 'text-overflow': 'ellipsis'})
+      .text(team_name).appendTo(row);
+    $('<td>').text(guess.puzzle_name).appendTo(row);
+    $('<td>').css({'max-width': '200px', 'overflow-wrap': 'break-word'}).text(guess.text).appendTo(row);
+    $('<td>').text(guess.time_str).appendTo(row);
+    return row;
+  }
+
   function receiveMessage(guess) {
-    guess = $(guess);
-    pk = guess.data('id');
-    if ($('tr[data-id=' + pk + ']').length == 0) {
-      if(!guess.hasClass('correct')) {
+    if (cursorAfter(guess.cursor, cursor)) {
+      cursor = guess.cursor;
+    }
+    var row = renderRow(guess);
+    var old_row = $('tr[data-id=' + guess.pk + ']');
+    if (old_row.length == 0) {
+      if(guess.status != 'correct') {
         flashing = !focused;
         $('audio')[0].play();
       }
-      guess.prependTo("#sub_table");
+      row.prependTo("#sub_table");
       if($('#sub_table tr').length >= 30){
         $('#sub_table tr:last').remove();
       }
     } else {
-      $('tr[data-id=' + pk + ']').replaceWith(guess);
+      old_row.replaceWith(row);
     }
     $('.sub_form').on('submit', formListener);
   }
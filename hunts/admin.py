@@ -22,6 +22,7 @@ from baton.admin import DropdownFilter, RelatedDropdownFilter, ChoicesDropdownFi
 import re
 
 from . import models
+from .graph import get_hunt_graph
 from teams.widgets import HtmlEditor
 from . import widgets
 
@@ -161,8 +162,10 @@ class PuzzleAdminForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super(PuzzleAdminForm, self).__init__(*args, **kwargs)
         if self.instance.pk:
-            self.initial['reverse_unlocks'] = self.instance.puzzle_set.values_list('pk', flat=True)
-            choices = self.instance.episode.puzzle_set.exclude(pk=self.instance.pk).values_list('pk', 'puzzle_name')
+            graph = get_hunt_graph(self.instance.episode.hunt_id)
+            self.initial['reverse_unlocks'] = graph.predecessors(self.instance.pk)
+            choices = [(pk, graph.name(pk)) for pk in graph.episode_puzzles(self.instance.episode_id)
+                       if pk != self.instance.pk]
             self.fields['reverse_unlocks'].choices = choices
 
     def save(self, *args, **kwargs):
@@ -0,0 +1,161 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+import json
+import os
+import shutil
+import tempfile
+import uuid
+
+# The stats of a hunt are built in the background (see hunts.tasks.build_hunt_stats) as a set of
+# named JSON artifacts. A build is written completely under its own id before the manifest of the
+# hunt is switched to it in a single write, so readers on any node see either the previous build
+# or the new one, never a mix of both. The build before the current one is kept for the readers
+# that loaded the previous manifest.
+
+
+def _dumps(data):
+    return json.dumps(data, cls=DjangoJSONEncoder)
+
+
+class ArtifactStore(object):
+    """ Where the artifacts of the hunts are published and read from """
+
+    def publish(self, hunt_pk, artifacts):
+        """ Stores a new build made of the dictionary name => JSON serializable data """
+        build = {'id': uuid.uuid4().hex, 'built_at': timezone.now(), 'names': sorted(artifacts)}
+        self.write_build(hunt_pk, build['id'], {name: _dumps(data) for name, data in artifacts.items()})
+        previous = self.read_manifest(hunt_pk)
+        self.write_manifest(hunt_pk, _dumps({'current': build, 'previous': previous and previous['current']}))
+        if previous is not None and previous['previous'] is not None:
+            self.delete_build(hunt_pk, previous['previous']['id'], previous['previous']['names'])
+        return build
+
+    def build_id(self, hunt_pk):
+        """ The id of the current build of the hunt, or None if there is none """
+        manifest = self.read_manifest(hunt_pk)
+        return None if manifest is None else manifest['current']['id']
+
+    def built_at(self, hunt_pk):
+        """ When the current build of the hunt was made, or None if there is none """
+        manifest = self.read_manifest(hunt_pk)
+        if manifest is None:
+            return None
+        return parse_datetime(manifest['current']['built_at'])
+
+    def get(self, hunt_pk, name):
+        """ The data of the artifact in the current build of the hunt, or None """
+        manifest = self.read_manifest(hunt_pk)
+        if manifest is None or name not in manifest['current']['names']:
+            return None
+        data = self.read_artifact(hunt_pk, manifest['current']['id'], name)
+        return None if data is None else json.loads(data)
+
+    def read_manifest(self, hunt_pk):
+        data = self.read_raw_manifest(hunt_pk)
+        return None if data is None else json.loads(data)
+
+    def write_build(self, hunt_pk, build_id, artifacts):
+        raise NotImplementedError
+
+    def delete_build(self, hunt_pk, build_id, names):
+        raise NotImplementedError
+
+    def read_artifact(self, hunt_pk, build_id, name):
+        raise NotImplementedError
+
+    def read_raw_manifest(self, hunt_pk):
+        raise NotImplementedError
+
+    def write_manifest(self, hunt_pk, data):
+        raise NotImplementedError
+
+
+class CacheArtifactStore(ArtifactStore):
+    """ Keeps the artifacts in the django cache, shared by all the nodes using the same redis """
+
+    def _key(self, hunt_pk, build_id, name):
+        return "stats:%s:%s:%s" % (hunt_pk, build_id, name)
+
+    def write_build(self, hunt_pk, build_id, artifacts):
+        cache.set_many({self._key(hunt_pk, build_id, name): data for name, data in artifacts.items()}, None)
+
+    def delete_build(self, hunt_pk, build_id, names):
+        cache.delete_many([self._key(hunt_pk, build_id, name) for name in names])
+
+    def read_artifact(self, hunt_pk, build_id, name):
+        return cache.get(self._key(hunt_pk, build_id, name))
+
+    def read_raw_manifest(self, hunt_pk):
+        return cache.get("stats-manifest:%s" % hunt_pk)
+
+    def write_manifest(self, hunt_pk, data):
+        cache.set("stats-manifest:%s" % hunt_pk, data, None)
+
+
+class FileArtifactStore(ArtifactStore):
+    """ Keeps the artifacts in a directory (on a volume shared by the nodes), every file being
+    written to a temporary file first and renamed to its final name """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, hunt_pk, *parts):
+        return os.path.join(self.root, str(hunt_pk), *parts)
+
+    def _write(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _read(self, path):
+        try:
+            with open(path) as data_file:
+                return data_file.read()
+        except FileNotFoundError:
+            return None
+
+    def write_build(self, hunt_pk, build_id, artifacts):
+        for name, data in artifacts.items():
+            self._write(self._path(hunt_pk, build_id, name + '.json'), data)
+
+    def delete_build(self, hunt_pk, build_id, names):
+        shutil.rmtree(self._path(hunt_pk, build_id), ignore_errors=True)
+
+    def read_artifact(self, hunt_pk, build_id, name):
+        return self._read(self._path(hunt_pk, build_id, name + '.json'))
+
+    def read_raw_manifest(self, hunt_pk):
+        return self._read(self._path(hunt_pk, 'manifest.json'))
+
+    def write_manifest(self, hunt_pk, data):
+        self._write(self._path(hunt_pk, 'manifest.json'), data)
+
+
+def get_artifact_store():
+    """ The store selected by the STATS_ARTIFACT_STORE setting: cache or media """
+    if getattr(settings, 'STATS_ARTIFACT_STORE', 'cache') == 'media':
+        return FileArtifactStore(os.path.join(settings.MEDIA_ROOT, 'stats'))
+    return CacheArtifactStore()
@@ -0,0 +1,130 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from threading import Lock
+from django.core.cache import cache
+from django.db import transaction
+from django.template import Template
+from hashlib import sha1
+
+import time
+
+
+# Versions are shared between processes through the django cache. A version that is missing
+# (never set or evicted) is re-created from the current time, so that entries cached under an
+# older counter can never be confused with the new one.
+def _version_key(scope, pk):
+    return "version:%s:%s" % (scope, pk)
+
+
+def _fresh_version():
+    return int(time.time() * 1000)
+
+
+def get_version(scope, pk):
+    """ Returns the current version of the object (scope, pk), creating it if necessary """
+    key = _version_key(scope, pk)
+    version = cache.get(key)
+    if version is None:
+        version = _fresh_version()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def get_versions(objects):
+    """ Returns the current versions of a list of (scope, pk) in a single cache read when
+    they all exist """
+    keys = [_version_key(scope, pk) for scope, pk in objects]
+    found = cache.get_many(keys)
+    return [found[key] if key in found else get_version(scope, pk)
+            for key, (scope, pk) in zip(keys, objects)]
+
+
+def bump_version(scope, pk):
+    """ Invalidates everything cached under the current version of (scope, pk) """
+    key = _version_key(scope, pk)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _fresh_version(), None)
+
+
+def bump_version_on_commit(scope, pk):
+    """ Bumps the version right away, so that the current transaction sees its own changes, and
+    once more when it is committed, so that entries rebuilt by other processes from the old
+    database state in the meantime are not kept under the new version """
+    bump_version(scope, pk)
+    if not transaction.get_autocommit():
+        transaction.on_commit(lambda: bump_version(scope, pk))
+
+
+class LocalCache(object):
+    """ A small thread-safe LRU cache living in the memory of the current process.
+    Entries can be stored with a version, in which case they are only returned when the
+    caller asks for that same version. """
+
+    def __init__(self, maxsize=1024, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, version=None, default=None):
+        with self._lock:
+            try:
+                entry_version, expires, value = self._data[key]
+            except KeyError:
+                return default
+            if entry_version != version or (expires is not None and expires < time.monotonic()):
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, version=None):
+        expires = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._lock:
+            self._data[key] = (version, expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_templates = LocalCache(maxsize=256)
+
+
+def get_compiled_template(label, pk, content):
+    """ Returns the django template made from a text field of an object (e.g. 'hunts.hunt', pk),
+    parsed and compiled at most once per process as long as the text does not change. Texts that
+    do not come from an object are cached by their hash only. """
+    digest = sha1(content.encode('utf-8')).hexdigest()
+    key = (label, pk) if label is not None else (None, digest)
+    template = _templates.get(key, digest)
+    if template is None:
+        template = Template(content)
+        _templates.set(key, template, digest)
+    return template
+
+
+def forget_template(label, pk):
+    """ To be called when the object is saved, other processes notice the new text by its hash """
+    _templates.delete((label, pk))
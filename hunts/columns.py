@@ -0,0 +1,168 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .graph import get_hunt_graph
+from .models import Episode, Hint
+from teams.models import PuzzleSolve, TeamPuzzleLink, TeamEpisodeLink, TeamEurekaLink
+
+import numpy as np
+import warnings
+
+# The solves, unlocks and eurekas of a hunt as dense team x puzzle (or team x eureka) matrices of
+# seconds since the epoch, NaN where the team did not unlock, solve or find anything. Teams and
+# puzzles are numbered by their position in self.team_pks and in the hunt graph.
+
+
+def _seconds(value):
+    return value.timestamp()
+
+
+def to_datetime(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+
+class HuntColumns(object):
+    """ Loads the progress of all the teams of a hunt with a handful of queries, and computes
+    the per-puzzle stats with vectorized operations instead of per-solve queries """
+
+    def __init__(self, hunt, team_pks=None):
+        self.hunt = hunt
+        self.graph = get_hunt_graph(hunt.pk)
+        if team_pks is None:
+            team_pks = hunt.team_set.order_by('pk').values_list('pk', flat=True)
+        self.team_pks = np.array(list(team_pks), dtype=np.int64)
+        self.team_index = {pk: i for i, pk in enumerate(self.team_pks.tolist())}
+        self.puzzle_pks = np.array(self.graph.puzzle_pks, dtype=np.int64)
+        teams = list(self.team_index)
+        puzzles = list(self.graph.index)
+        shape = (len(self.team_pks), len(self.puzzle_pks))
+
+        # when each team could start working on each puzzle, see Puzzle.unlock_time_for_team
+        self.start = np.full(shape, np.nan)
+        headstart = TeamEpisodeLink.objects.filter(team=OuterRef('team'), episode=OuterRef('puzzle__episode')) \
+            .values('headstart')[:1]
+        unlocks = TeamPuzzleLink.objects.filter(team__in=teams, puzzle__in=puzzles) \
+            .annotate(headstart=Subquery(headstart)) \
+            .values_list('team', 'puzzle', 'time', 'puzzle__episode__start_date', 'headstart')
+        for team, puzzle, time, episode_start, headstart in unlocks:
+            start = episode_start if headstart is None else max(time, episode_start - headstart)
+            self.start[self.team_index[team], self.graph.index[puzzle]] = _seconds(start)
+        # puzzles unlocked without a link (by hand, or through an episode link) count from the
+        # start of their episode, as in Puzzle.starting_time_for_team
+        episode_starts = dict(Episode.objects.filter(pk__in=list(self.graph.episode_pks))
+                              .values_list('pk', 'start_date'))
+        default = np.array([_seconds(episode_starts[pk]) for pk in self.graph.episode_of], dtype=np.float64)
+        self.start = np.where(np.isnan(self.start), default, self.start)
+
+        self.solve_time = np.full(shape, np.nan)
+        self.duration = np.full(shape, np.nan)
+        solves = PuzzleSolve.objects.filter(team__in=teams, puzzle__in=puzzles) \
+            .values_list('team', 'puzzle', 'guess__guess_time', 'duration')
+        for team, puzzle, time, duration in solves:
+            i, j = self.team_index[team], self.graph.index[puzzle]
+            self.solve_time[i, j] = _seconds(time)
+            self.duration[i, j] = duration.total_seconds()
+        self.solved = ~np.isnan(self.solve_time)
+
+        links = list(TeamEurekaLink.objects.filter(team__in=teams, eureka__puzzle__in=puzzles)
+                     .values_list('team', 'eureka', 'time'))
+        eureka_pks = sorted(set(eureka for team, eureka, time in links))
+        self.eureka_index = {pk: i for i, pk in enumerate(eureka_pks)}
+        self.eureka_time = np.full((len(self.team_pks), len(eureka_pks)), np.nan)
+        for team, eureka, time in links:
+            self.eureka_time[self.team_index[team], self.eureka_index[eureka]] = _seconds(time)
+
+        self.hints = list(Hint.objects.filter(puzzle__in=puzzles)
+                          .values_list('pk', 'puzzle', 'time', 'short_time', 'number_eurekas'))
+        self.hint_eurekas = {}
+        for hint, eureka in Hint.eurekas.through.objects.filter(hint__puzzle__in=puzzles) \
+                .values_list('hint', 'eureka'):
+            self.hint_eurekas.setdefault(hint, []).append(eureka)
+
+    def hint_delays(self):
+        """ The delay of every hint for every team (team x hint), see Hint.delay_for_team """
+        delays = np.empty((len(self.team_pks), len(self.hints)))
+        for k, (pk, puzzle, time, short_time, number_eurekas) in enumerate(self.hints):
+            delays[:, k] = time.total_seconds()
+            if pk not in self.hint_eurekas:
+                continue
+            # eurekas nobody found have no column, they count as not found
+            columns = [self.eureka_index[eureka] for eureka in self.hint_eurekas[pk] if eureka in self.eureka_index]
+            if len(columns) == 0:
+                continue
+            found = self.eureka_time[:, columns] - self.start[:, [self.graph.index[puzzle]]]
+            count = np.sum(~np.isnan(found), axis=1)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                latest = np.nanmax(found, axis=1)
+            shorter = (count > 0) & (count >= number_eurekas)
+            delays[shorter, k] = np.minimum(time.total_seconds(), latest[shorter] + short_time.total_seconds())
+        return delays
+
+    @cached_property
+    def hints_used(self):
+        """ The number of hints each team had seen when it solved each puzzle (team x puzzle) """
+        hint_puzzles = np.array([self.graph.index[hint[1]] for hint in self.hints], dtype=np.int64)
+        used = np.zeros((len(self.team_pks), len(self.puzzle_pks)), dtype=np.int64)
+        if len(self.hints) > 0:
+            with np.errstate(invalid='ignore'):
+                shown = self.hint_delays() < self.duration[:, hint_puzzles]
+            # sum the hints shown per puzzle: shown (team x hint) times the hint => puzzle incidence
+            incidence = np.zeros((len(self.hints), len(self.puzzle_pks)), dtype=np.int64)
+            incidence[np.arange(len(self.hints)), hint_puzzles] = 1
+            used = shown.astype(np.int64) @ incidence
+        return np.where(self.solved, used, 0)
+
+    def _column_stats(self, values, function):
+        """ function applied to each column of values ignoring NaN, NaN for empty columns """
+        result = np.full(values.shape[1], np.nan)
+        filled = np.any(~np.isnan(values), axis=0)
+        if np.any(filled):
+            result[filled] = function(values[:, filled], axis=0)
+        return result
+
+    def puzzle_stats(self):
+        """ Per puzzle arrays: number of solves, first and average solve times, minimum, average
+        and median durations, minimum and average number of hints used """
+        hints = np.where(self.solved, self.hints_used, np.nan)
+        return {
+            'success': np.sum(self.solved, axis=0),
+            'min_time': self._column_stats(self.solve_time, np.nanmin),
+            'av_time': self._column_stats(self.solve_time, np.nanmean),
+            'min_dur': self._column_stats(self.duration, np.nanmin),
+            'av_dur': self._column_stats(self.duration, np.nanmean),
+            'med_dur': self._column_stats(self.duration, np.nanmedian),
+            'min_hints': self._column_stats(hints, np.nanmin),
+            'av_hints': self._column_stats(hints, np.nanmean),
+        }
+
+    def ranks(self):
+        """ The position of each solve among the solves of its puzzle, by solve time and by
+        duration (team x puzzle, 0 where not solved) """
+        def rank(values):
+            # NaN are sorted last, so they never come before an actual solve
+            order = np.argsort(values, axis=0, kind='stable')
+            ranks = np.empty_like(order)
+            np.put_along_axis(ranks, order, np.arange(1, values.shape[0] + 1)[:, None], axis=0)
+            return np.where(self.solved, ranks, 0)
+        return rank(self.solve_time), rank(self.duration)
+
+    def episode_curves(self, episode_pk):
+        """ The solve times of each team in the episode in increasing order (team x puzzles of the
+        episode), NaN padded: the progress curves of the charts page """
+        start, end = self.graph.episode_ranges.get(episode_pk, (0, 0))
+        return np.sort(self.solve_time[:, start:end], axis=1)
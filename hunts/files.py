@@ -0,0 +1,126 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotFound, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.encoding import escape_uri_path
+from django.utils.http import http_date
+
+import mimetypes
+import os
+import re
+
+# Puzzle and solution files are only sent once the views have checked the permissions of the
+# user, in one of the following ways (settings.PROTECTED_FILE_BACKEND):
+#  - x-accel: nginx sends the file from an internal location (see docker/configs/nginx_*.conf)
+#  - sendfile: the X-Sendfile header, for apache with mod_xsendfile or lighttpd
+#  - stream: django streams the file itself, for development
+X_ACCEL = 'x-accel'
+SENDFILE = 'sendfile'
+STREAM = 'stream'
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def content_type(path):
+    """ The mimetype of the file, compressed files are sent as such like django's FileResponse does """
+    mimetype, encoding = mimetypes.guess_type(path)
+    if encoding is not None:
+        return {'bzip2': 'application/x-bzip', 'gzip': 'application/gzip', 'xz': 'application/x-xz'} \
+            .get(encoding, 'application/octet-stream')
+    return mimetype or 'application/octet-stream'
+
+
+def file_etag(stat):
+    """ A strong ETag built from the modification time and the size of the file """
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+def parse_range(header, size):
+    """ Returns the (first, last) bytes requested by a single range Range header, None when the
+    whole file should be sent (no header, several ranges or a syntax error), or () when the
+    range cannot be satisfied """
+    match = RANGE_RE.match(header or "")
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        # suffix range: the last N bytes
+        length = int(match.group(2))
+        if length == 0:
+            return ()
+        return max(size - length, 0), size - 1
+    first = int(match.group(1))
+    last = size - 1 if match.group(2) == "" else min(int(match.group(2)), size - 1)
+    if first >= size or last < first:
+        return ()
+    return first, last
+
+
+def _read_range(path, first, last):
+    with open(path, "rb") as f:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _stream(request, path, stat):
+    byte_range = None
+    if request.method == 'GET' and request.headers.get('If-Range', file_etag(stat)) == file_etag(stat):
+        byte_range = parse_range(request.headers.get('Range'), stat.st_size)
+    if byte_range == ():
+        response = HttpResponse(status=416)
+        response['Content-Range'] = "bytes */%d" % stat.st_size
+        return response
+    if byte_range is None:
+        return FileResponse(open(path, "rb"))
+
+    first, last = byte_range
+    response = StreamingHttpResponse(_read_range(path, first, last), status=206)
+    response['Content-Range'] = "bytes %d-%d/%d" % (first, last, stat.st_size)
+    response['Content-Length'] = str(last - first + 1)
+    return response
+
+
+def serve_file(request, field_file):
+    """ Sends a puzzle or solution file to a user that is allowed to see it """
+    path = field_file.path
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return HttpResponseNotFound('<h1>Page not found</h1>')
+
+    etag = file_etag(stat)
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        backend = settings.PROTECTED_FILE_BACKEND
+        if backend == X_ACCEL:
+            # nginx answers Range requests itself
+            response = HttpResponse()
+            response['X-Accel-Redirect'] = escape_uri_path(settings.MEDIA_URL + field_file.name)
+        elif backend == SENDFILE:
+            response = HttpResponse()
+            response['X-Sendfile'] = path
+        else:
+            response = _stream(request, path, stat)
+        response['Content-Type'] = content_type(path)
+        response['Accept-Ranges'] = 'bytes'
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    return response
@@ -0,0 +1,166 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from django.apps import apps
+from django.core.cache import cache
+
+from .cache import LocalCache, get_version
+
+_graphs = LocalCache(maxsize=32)
+
+
+def _csr(size, edges):
+    """ Packs a list of (source, target) index pairs into compressed sparse rows:
+    the targets of source i are targets[offsets[i]:offsets[i + 1]] """
+    counts = [0] * (size + 1)
+    for source, target in edges:
+        counts[source + 1] += 1
+    for i in range(size):
+        counts[i + 1] += counts[i]
+    offsets = array('i', counts)
+    targets = array('i', [0] * len(edges))
+    position = list(counts)
+    for source, target in edges:
+        targets[position[source]] = target
+        position[source] += 1
+    return offsets, targets
+
+
+class HuntGraph(object):
+    """ A read-only snapshot of the prerequisite graph of a hunt: the puzzles and episodes with
+    their unlocking relations, the number of prerequisites required by each puzzle and the
+    ordering of episodes and puzzles. Puzzles are stored in dense arrays, the index of a puzzle
+    being its position in the (episode number, puzzle number) ordering. """
+
+    def __init__(self, hunt_pk, episodes, puzzles, edges):
+        self.hunt_pk = hunt_pk
+
+        # episodes: list of (pk, number, name, unlocks pk) ordered by number
+        self.episode_pks = array('i', [ep[0] for ep in episodes])
+        self.episode_names = {ep[0]: ep[2] for ep in episodes}
+        self.episode_unlocks = {ep[0]: ep[3] for ep in episodes}
+        unlocked = set(ep[3] for ep in episodes if ep[3] is not None)
+        self.initial_episode_pks = [ep[0] for ep in episodes if ep[0] not in unlocked]
+
+        # puzzles: list of (pk, episode pk, puzzle number, required, puzzle id, name), ordered
+        self.puzzle_pks = array('i', [puz[0] for puz in puzzles])
+        self.index = {puz[0]: i for i, puz in enumerate(puzzles)}
+        self.episode_of = array('i', [puz[1] for puz in puzzles])
+        self.numbers = array('i', [puz[2] for puz in puzzles])
+        self.required = array('i', [puz[3] for puz in puzzles])
+        self.puzzle_ids = [puz[4] for puz in puzzles]
+        self.puzzle_names = [puz[5] for puz in puzzles]
+
+        self.episode_ranges = {}
+        for i, puz in enumerate(puzzles):
+            start, end = self.episode_ranges.get(puz[1], (i, i))
+            self.episode_ranges[puz[1]] = (start, i + 1)
+
+        # edges: (prerequisite pk, unlocked pk)
+        pairs = [(self.index[source], self.index[target]) for source, target in edges
+                 if source in self.index and target in self.index]
+        self.successor_offsets, self.successor_targets = _csr(len(puzzles), pairs)
+        self.predecessor_offsets, self.predecessor_targets = _csr(
+            len(puzzles), [(target, source) for source, target in pairs])
+
+    @classmethod
+    def load(cls, hunt_pk):
+        """ Builds the graph of the hunt from the database in two queries """
+        Episode = apps.get_model('hunts', 'Episode')
+        Puzzle = apps.get_model('hunts', 'Puzzle')
+        episodes = list(Episode.objects.filter(hunt=hunt_pk).order_by('ep_number')
+                        .values_list('pk', 'ep_number', 'ep_name', 'unlocks'))
+        rows = Puzzle.objects.filter(episode__hunt=hunt_pk) \
+            .order_by('episode__ep_number', 'puzzle_number', 'pk') \
+            .values_list('pk', 'episode', 'puzzle_number', 'num_required_to_unlock',
+                         'puzzle_id', 'puzzle_name', 'unlocks')
+        puzzles = []
+        edges = []
+        for row in rows:
+            if len(puzzles) == 0 or puzzles[-1][0] != row[0]:
+                puzzles.append(row[:6])
+            if row[6] is not None:
+                edges.append((row[0], row[6]))
+        return cls(hunt_pk, episodes, puzzles, edges)
+
+    def _pks(self, indices):
+        return [self.puzzle_pks[i] for i in indices]
+
+    def successors(self, puzzle_pk):
+        """ The pks of the puzzles the puzzle counts towards """
+        i = self.index[puzzle_pk]
+        return self._pks(self.successor_targets[self.successor_offsets[i]:self.successor_offsets[i + 1]])
+
+    def predecessors(self, puzzle_pk):
+        """ The pks of the puzzles that count towards the puzzle """
+        i = self.index[puzzle_pk]
+        return self._pks(self.predecessor_targets[self.predecessor_offsets[i]:self.predecessor_offsets[i + 1]])
+
+    def episode_successors(self, puzzle_pk):
+        """ The successors of the puzzle within its own episode, the only ones used for unlocking """
+        episode = self.episode_of[self.index[puzzle_pk]]
+        return [pk for pk in self.successors(puzzle_pk) if self.episode_of[self.index[pk]] == episode]
+
+    def name(self, puzzle_pk):
+        return self.puzzle_names[self.index[puzzle_pk]]
+
+    def required_for(self, puzzle_pk):
+        return self.required[self.index[puzzle_pk]]
+
+    def episode_puzzles(self, episode_pk):
+        """ The pks of the puzzles of the episode, ordered by puzzle number """
+        start, end = self.episode_ranges.get(episode_pk, (0, 0))
+        return list(self.puzzle_pks[start:end])
+
+    def puzzle_count(self, episode_pk):
+        start, end = self.episode_ranges.get(episode_pk, (0, 0))
+        return end - start
+
+    def next_episode(self, episode_pk):
+        return self.episode_unlocks.get(episode_pk)
+
+    def serialize_for_ajax(self):
+        """ Serializes the graph as cytoscape elements for the staff DAG page """
+        nodes = []
+        edges = []
+        for episode_pk in self.episode_pks:
+            nodes.append({'id': 'ep%d' % episode_pk, 'name': self.episode_names[episode_pk],
+                          'href': '/admin/hunts/episode/%d/change/' % episode_pk,
+                          'parent': 'hu%d' % self.hunt_pk})
+            if self.episode_unlocks[episode_pk] is not None:
+                edges.append({'source': 'ep%d' % episode_pk,
+                              'target': 'ep%d' % self.episode_unlocks[episode_pk]})
+        for i, pk in enumerate(self.puzzle_pks):
+            num_predecessors = self.predecessor_offsets[i + 1] - self.predecessor_offsets[i]
+            nodes.append({'id': str(pk), 'name': self.puzzle_names[i],
+                          'required': self.required[i], 'predecessors': num_predecessors,
+                          'href': '/admin/hunts/puzzle/%d/change/' % pk,
+                          'parent': 'ep%d' % self.episode_of[i]})
+            for target in self.successors(pk):
+                edges.append({'source': str(pk), 'target': str(target)})
+        return {'nodes': nodes, 'edges': edges}
+
+
+def get_hunt_graph(hunt_pk):
+    """ Returns the graph of the hunt, rebuilt only when the content of the hunt changes.
+    Snapshots are kept in the memory of each process and shared through the django cache. """
+    version = get_version('hunt', hunt_pk)
+    graph = _graphs.get(hunt_pk, version)
+    if graph is None:
+        key = "hunt-graph:%s:%s" % (hunt_pk, version)
+        graph = cache.get(key)
+        if graph is None:
+            graph = HuntGraph.load(hunt_pk)
+            cache.set(key, graph, 24 * 3600)
+        _graphs.set(hunt_pk, graph, version)
+    return graph
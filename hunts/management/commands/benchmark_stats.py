@@ -0,0 +1,146 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Avg, Max, Min
+from django.utils import timezone
+from hunts.columns import HuntColumns
+from hunts.models import Hunt, Episode, Puzzle, Eureka, Hint
+from teams.models import Team, Guess, PuzzleSolve, TeamPuzzleLink, TeamEurekaLink
+
+import random
+import time
+import uuid
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ("Compares the columnar stats engine with the per-solve code it replaced, on a synthetic "
+            "hunt created in a transaction that is rolled back afterwards")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--teams', type=int, default=1000, help="The number of teams of the hunt")
+        parser.add_argument('--puzzles', type=int, default=100, help="The number of puzzles of the hunt")
+        parser.add_argument('--sample', type=int, default=500,
+                            help="The number of solves the per-solve code is timed on, its total is extrapolated")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['teams'] < 1 or options['puzzles'] < 1:
+            raise CommandError("The hunt needs at least one team and one puzzle")
+        self.random = random.Random(options['seed'])
+        try:
+            with transaction.atomic():
+                hunt = self.create_hunt(options['teams'], options['puzzles'])
+                self.run(hunt, options['sample'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def timed(self, label, function):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        self.stdout.write("%-40s %8.3fs" % (label, elapsed))
+        return result, elapsed
+
+    def create_hunt(self, team_count, puzzle_count):
+        now = timezone.now()
+        start = now - timedelta(days=2)
+        number = (Hunt.objects.aggregate(number=Max('hunt_number'))['number'] or 0) + 1
+        hunt = Hunt.objects.create(
+            hunt_name="Benchmark", hunt_number=number, team_size=5, start_date=start, end_date=now,
+            display_start_date=start, display_end_date=now)
+        episode = Episode.objects.create(ep_name="Benchmark", ep_number=1, start_date=start, hunt=hunt)
+        prefix = uuid.uuid4().hex[:4]
+        puzzles = Puzzle.objects.bulk_create([
+            Puzzle(episode=episode, puzzle_name="Puzzle %d" % i, puzzle_number=i, puzzle_id="%s%04d" % (prefix, i),
+                   answer="answer", num_required_to_unlock=0)
+            for i in range(1, puzzle_count + 1)])
+        eurekas = Eureka.objects.bulk_create([
+            Eureka(puzzle=puzzle, regex="EUREKA%d" % i, answer="eureka")
+            for puzzle in puzzles for i in range(2)])
+        hints = Hint.objects.bulk_create([
+            Hint(puzzle=puzzle, text="Hint", time=timedelta(hours=i + 1), short_time=timedelta(minutes=10),
+                 number_eurekas=1)
+            for puzzle in puzzles for i in range(3)])
+        # the last hint of every puzzle comes earlier to the teams that found one of its eurekas
+        Hint.eurekas.through.objects.bulk_create([
+            Hint.eurekas.through(hint_id=hints[3 * j + 2].pk, eureka_id=eurekas[2 * j + i].pk)
+            for j in range(len(puzzles)) for i in range(2)])
+
+        user = User.objects.create_user("benchmark-%s" % prefix)
+        teams = Team.objects.bulk_create([
+            Team(team_name="Team %d" % i, join_code=prefix[:4] + "X", hunt=hunt) for i in range(team_count)])
+        links, guesses, solves, found = [], [], [], []
+        for team in teams:
+            for j, puzzle in enumerate(puzzles):
+                unlock = start + timedelta(minutes=self.random.randint(0, 600))
+                links.append(TeamPuzzleLink(team=team, puzzle=puzzle, time=unlock))
+                if self.random.random() < 0.3:
+                    found.append(TeamEurekaLink(team=team, eureka=eurekas[2 * j],
+                                                time=unlock + timedelta(minutes=self.random.randint(1, 120))))
+                if self.random.random() < 0.7:
+                    duration = timedelta(minutes=self.random.randint(1, 300))
+                    guesses.append(Guess(team=team, user=user, puzzle=puzzle, hunt=hunt, guess_text="answer",
+                                         normalized_text="ANSWER", guess_time=unlock + duration,
+                                         modified_date=unlock + duration))
+                    solves.append((team, puzzle, duration))
+        TeamPuzzleLink.objects.bulk_create(links, batch_size=5000)
+        TeamEurekaLink.objects.bulk_create(found, batch_size=5000)
+        Guess.objects.bulk_create(guesses, batch_size=5000)
+        PuzzleSolve.objects.bulk_create([
+            PuzzleSolve(team=team, puzzle=puzzle, guess=guess, duration=duration)
+            for (team, puzzle, duration), guess in zip(solves, guesses)], batch_size=5000)
+        self.stdout.write("Created %d teams, %d puzzles, %d solves and %d eurekas found" % (
+            len(teams), len(puzzles), len(solves), len(found)))
+        return hunt
+
+    def run(self, hunt, sample):
+        def columns_stats():
+            columns = HuntColumns(hunt)
+            return columns, columns.puzzle_stats(), columns.ranks()
+        (columns, stats, ranks), columns_time = self.timed("Columns: load, hints, durations, ranks", columns_stats)
+
+        # what the stats pages did before: the hints of every solve checked one by one
+        solves = list(PuzzleSolve.objects.filter(puzzle__episode__hunt=hunt).select_related('team', 'puzzle'))
+        sampled = self.random.sample(solves, min(sample, len(solves)))
+
+        def count_hints():
+            counts = []
+            for solve in sampled:
+                counts.append(sum(1 for hint in solve.puzzle.hint_set.all()
+                                  if hint.delay_for_team(solve.team) < solve.duration))
+            return counts
+        counts, hints_time = self.timed("Per solve: hints of %d solves" % len(sampled), count_hints)
+
+        def aggregates():
+            return [PuzzleSolve.objects.filter(puzzle=puzzle_pk).aggregate(
+                av_dur=Avg('duration'), min_dur=Min('duration'))
+                for puzzle_pk in columns.puzzle_pks.tolist()]
+        self.timed("Per puzzle: duration aggregates", aggregates)
+
+        if len(sampled) > 0:
+            total = hints_time * len(solves) / len(sampled)
+            self.stdout.write("Per solve hints extrapolated to %d solves: %.1fs, %.0fx the columns" % (
+                len(solves), total, total / max(columns_time, 1e-9)))
+        mismatches = sum(1 for solve, count in zip(sampled, counts)
+                         if columns.hints_used[columns.team_index[solve.team_id],
+                                               columns.graph.index[solve.puzzle_id]] != count)
+        if mismatches:
+            self.stderr.write("%d sampled solves have a different hint count" % mismatches)
@@ -0,0 +1,94 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.urls import reverse
+from hunts.models import Hunt, Puzzle
+from hunts.rendering import Sidebar, get_puzzle_body, get_prepuzzle_values, get_postpuzzle_values
+
+import os
+import shutil
+
+
+class Command(BaseCommand):
+    help = ("Exports a demo or finished hunt as static pages, to be served by nginx from the output "
+            "directory with 'try_files $uri $uri/index.html =404;'")
+
+    def add_arguments(self, parser):
+        parser.add_argument('hunt', type=int, help="The number of the hunt to export")
+        parser.add_argument('output', help="The directory in which the pages are written")
+        parser.add_argument('--with-solutions', action='store_true',
+                            help="Also export the solution files, which otherwise require a login")
+
+    def handle(self, *args, **options):
+        try:
+            hunt = Hunt.objects.get(hunt_number=options['hunt'])
+        except Hunt.DoesNotExist:
+            raise CommandError("There is no hunt number %d" % options['hunt'])
+        if not hunt.is_public:
+            raise CommandError("Only demo and finished hunts can be exported")
+
+        self.output = options['output']
+        self.factory = RequestFactory()
+        user = AnonymousUser()
+        sidebar = Sidebar(hunt, user, None)
+
+        url = reverse('hunt', kwargs={'hunt_num': hunt.hunt_number})
+        self.write_page(url, 'hunt/hunt.html', {
+            'hunt': hunt, 'episodes': sidebar.episodes, 'sidebar': sidebar, 'team': None,
+            'text': hunt.template, 'message': ''})
+
+        puzzles = Puzzle.objects.filter(episode__hunt=hunt).select_related('episode__hunt') \
+            .prefetch_related('puzzlefile_set', 'solutionfile_set')
+        for puzzle in puzzles:
+            body = get_puzzle_body(puzzle)
+            context = {'hunt': hunt, 'episodes': sidebar.episodes, 'sidebar': sidebar, 'puzzle': puzzle,
+                       'eureka': body.eureka, 'team': None, 'text': body.text, 'status': 'unsolved'}
+            if hunt.is_demo and not hunt.is_finished:
+                template = 'puzzle/prepuzzle.html'
+                context['prepuzzle_values'] = get_prepuzzle_values(puzzle)
+            else:
+                template = 'puzzle/postpuzzle.html'
+                context['postpuzzle_values'], context['solutions'] = get_postpuzzle_values(puzzle)
+                if not options['with_solutions']:
+                    context['solutions'] = []
+            self.write_page(reverse('puzzle', kwargs={'puzzle_id': puzzle.puzzle_id}), template, context)
+
+            files = [('puzzle_file', f) for f in puzzle.puzzlefile_set.all()]
+            if options['with_solutions']:
+                files += [('solution_file', f) for f in puzzle.solutionfile_set.all()]
+            for name, f in files:
+                url = reverse(name, kwargs={'puzzle_id': puzzle.puzzle_id, 'file_path': f.url_path})
+                shutil.copyfile(f.file.path, self.path(url))
+            self.stdout.write("Exported %s" % puzzle.puzzle_name)
+
+        self.stdout.write(self.style.SUCCESS("Exported %d puzzles to %s" % (len(puzzles), self.output)))
+
+    def path(self, url):
+        """ The file serving the url in the output directory, directories get an index.html """
+        path = os.path.join(self.output, url.lstrip('/'))
+        if url.endswith('/'):
+            path = os.path.join(path, 'index.html')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def write_page(self, url, template, context):
+        request = self.factory.get(url)
+        request.user = context['sidebar'].user
+        request.hunt = context['hunt']
+        request.team = None
+        request.puzzle = context.get('puzzle')
+        with open(self.path(url), 'w', encoding='utf-8') as f:
+            f.write(render_to_string(template, context, request=request))
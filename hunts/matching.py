@@ -0,0 +1,104 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+
+from .cache import LocalCache, get_version
+
+import re
+
+
+# Regexes made only of these characters match exactly one (case insensitive) string
+LITERAL_RE = re.compile(r"[A-Za-z0-9]*")
+# Patterns using backreferences cannot be merged with others: their group numbers would shift
+BACKREFERENCE_RE = re.compile(r"\\[1-9]|\(\?P=")
+
+MatchedEureka = namedtuple('MatchedEureka', ['pk', 'answer', 'feedback', 'admin_only'])
+
+_matchers = LocalCache(maxsize=2048)
+
+
+def normalize_guess(text):
+    """ Guesses are neither case nor space sensitive """
+    return text.upper().replace(" ", "")
+
+
+class PuzzleMatcher(object):
+    """ Everything needed to check a guess against a puzzle answer and its eurekas,
+    precompiled once per puzzle version. Eurekas keep the priority of their database order. """
+
+    def __init__(self, puzzle, eurekas):
+        self.answer = normalize_guess(puzzle.answer)
+        self.answer_regex = None
+        if puzzle.answer_regex != "":
+            self.answer_regex = re.compile(puzzle.answer_regex, re.IGNORECASE)
+
+        self.eurekas = []
+        self.exact_eurekas = {}
+        self.unmergeable_eurekas = []
+        alternatives = []
+        for index, eureka in enumerate(eurekas):
+            self.eurekas.append(MatchedEureka(eureka.pk, eureka.answer, eureka.feedback,
+                                              eureka.admin_only))
+            pattern = eureka.regex.replace(" ", "")
+            if LITERAL_RE.fullmatch(pattern):
+                self.exact_eurekas.setdefault(pattern.upper(), index)
+            elif BACKREFERENCE_RE.search(pattern):
+                self.unmergeable_eurekas.append((index, re.compile(pattern, re.IGNORECASE)))
+            else:
+                alternatives.append((index, pattern))
+
+        self.eureka_regex = None
+        if len(alternatives) > 0:
+            try:
+                self.eureka_regex = re.compile(
+                    "|".join("(?P<e%d>%s)" % alternative for alternative in alternatives),
+                    re.IGNORECASE)
+            except re.error:
+                # e.g. inline flags, which are only allowed at the start of a whole pattern
+                self.unmergeable_eurekas.extend(
+                    (index, re.compile(pattern, re.IGNORECASE)) for index, pattern in alternatives)
+                self.unmergeable_eurekas.sort(key=lambda eureka: eureka[0])
+
+    def is_correct(self, text):
+        """ A boolean indicating if the guess matches either the answer or the non-empty regex """
+        guess = normalize_guess(text)
+        return (guess == self.answer or
+                (self.answer_regex is not None and self.answer_regex.fullmatch(guess) is not None))
+
+    def match_eureka(self, text):
+        """ Returns the first eureka matched by the guess, or None """
+        guess = normalize_guess(text)
+        index = self.exact_eurekas.get(guess)
+        if self.eureka_regex is not None:
+            match = self.eureka_regex.fullmatch(guess)
+            if match is not None:
+                # the named group wrapping each alternative is always the last one to close
+                matched = int(match.lastgroup[1:])
+                index = matched if index is None else min(index, matched)
+        for eureka_index, regex in self.unmergeable_eurekas:
+            if index is not None and index < eureka_index:
+                break
+            if regex.fullmatch(guess):
+                index = eureka_index
+                break
+        return None if index is None else self.eurekas[index]
+
+
+def get_matcher(puzzle):
+    """ Returns the matcher of the puzzle, built at most once per process and puzzle version """
+    version = get_version('puzzle', puzzle.pk)
+    matcher = _matchers.get(puzzle.pk, version)
+    if matcher is None:
+        matcher = PuzzleMatcher(puzzle, puzzle.eureka_set.order_by('pk'))
+        _matchers.set(puzzle.pk, matcher, version)
+    return matcher
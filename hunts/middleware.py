@@ -11,7 +11,9 @@
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
 from .models import Team
-from hunts.models import Hunt, Puzzle
+from django.utils.functional import SimpleLazyObject
+from hunts.models import Hunt, Puzzle, get_current_hunt, get_hunt, get_hunt_by_number
+from hunts.resolver import resolve_puzzle
 
 class PuzzleMiddleware(object):
     """
@@ -25,11 +27,12 @@ class PuzzleMiddleware(object):
 
     def process_view(self, request, view_func, view_args, view_kwargs):
         request.puzzle = None
-        try:
-            if 'puzzle_id' in view_kwargs:
-                request.puzzle = Puzzle.objects.get(puzzle_id=view_kwargs['puzzle_id'])
-        except Puzzle.DoesNotExist:
-            request.puzzle = None
+        if 'puzzle_id' in view_kwargs:
+            # unknown puzzles are resolved from the cache, known ones are only fetched when used
+            ref = resolve_puzzle(view_kwargs['puzzle_id'])
+            if ref is not None:
+                request.puzzle = SimpleLazyObject(
+                    lambda: Puzzle.objects.select_related('episode__hunt').get(pk=ref[0]))
 
 
 class HuntMiddleware(object):
@@ -47,11 +50,12 @@ class HuntMiddleware(object):
         request.hunt = None
         try:
             if 'hunt_num' in view_kwargs:
-                request.hunt = Hunt.objects.get(hunt_number=view_kwargs['hunt_num'])
+                request.hunt = get_hunt_by_number(view_kwargs['hunt_num'])
             else:
-                if request.puzzle:
-                    request.hunt = request.puzzle.episode.hunt
+                if request.puzzle is not None:
+                    # from the cached references and hunts, the puzzle itself is not loaded
+                    request.hunt = get_hunt(resolve_puzzle(view_kwargs['puzzle_id'])[2])
                 else:
-                    request.hunt = Hunt.objects.get(is_current_hunt=True)
+                    request.hunt = get_current_hunt()
         except Hunt.DoesNotExist:
             request.hunt = None
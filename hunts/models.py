@@ -14,13 +14,21 @@ from django.core.validators import MinValueValidator
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.utils import timezone
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models, transaction
-from django.db.models import F
+from django.db.models import F, Subquery, Exists, OuterRef, Value
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.flatpages.models import FlatPage
 from datetime import timedelta
-from teams.models import Team, Person, Guess, TeamPuzzleLink, TeamEpisodeLink
+from teams.models import Team, Person, Guess, PuzzleSolve, TeamPuzzleLink, TeamEpisodeLink
+from .cache import LocalCache, get_version, bump_version_on_commit, forget_template
+from .graph import get_hunt_graph
+from .resolver import get_team, invalidate_puzzles
 
 import os
+import pickle
 import re
 import zipfile
 import shutil
@@ -116,6 +124,7 @@ class Hunt(models.Model):
         if self.is_current_hunt:
             Hunt.objects.filter(is_current_hunt=True).update(is_current_hunt=False)
         super(Hunt, self).save(*args, **kwargs)
+        bump_version_on_commit('hunts', 0)
 
     @property
     def is_locked(self):
@@ -154,13 +163,7 @@ class Hunt(models.Model):
 
     def team_from_user(self, user):
         """ Takes a user and a hunt and returns either the user's team for that hunt or None """
-        if(not user.is_authenticated):
-            return None
-        try:
-            teams = Person.objects.get(user=user).teams.filter(hunt=self)
-            return teams[0] if (len(teams) > 0) else None
-        except Person.DoesNotExist:
-            return None
+        return get_team(user, self.pk)
 
     def can_access(self, user, team):
         return self.is_public or user.is_staff or (team and (self.is_open or (team.is_playtester_team and team.playtest_started)))
@@ -178,16 +181,27 @@ class Hunt(models.Model):
         return episode_list
 
     def get_formatted_episodes(self, user, team):
-#        episodes = sorted(self.get_episodes(user, team), key=lambda p: p.ep_number)
-        episodes = self.get_episodes(user,team)
-        if user.is_staff or self.is_public:
-            episodes = [{'ep': ep, 'puz': ep.puzzle_set.all(), 'solves': 0} for ep in episodes]
-        else:
-            episodes = [{'ep': ep, 'puz': team.puz_unlocked.filter(episode=ep), 'solves':0} for ep in episodes]
+        """ The episodes that a user/team can see, each with its list of visible puzzles, its
+        number of puzzles and the number of them solved by the team, in two queries """
+        episodes = list(self.get_episodes(user, team))
+        puzzles = Puzzle.objects.filter(episode__in=episodes)
+        if not (user.is_staff or self.is_public):
+            puzzles = puzzles.filter(teampuzzlelink__team=team)
         if team is not None:
-            for i in range(len(episodes)):
-                episodes[i]['solves'] = team.puz_solved.filter(episode=episodes[i]['ep']).count()
-        return episodes
+            puzzles = puzzles.annotate(solved=Exists(
+                PuzzleSolve.objects.filter(team=team, puzzle=OuterRef('pk'))))
+        else:
+            puzzles = puzzles.annotate(solved=Value(False, output_field=models.BooleanField()))
+
+        graph = get_hunt_graph(self.pk)
+        formatted = [{'ep': ep, 'puz': [], 'solves': 0, 'total': graph.puzzle_count(ep.pk)}
+                     for ep in episodes]
+        by_pk = {episode['ep'].pk: episode for episode in formatted}
+        for puzzle in puzzles:
+            episode = by_pk[puzzle.episode_id]
+            episode['puz'].append(puzzle)
+            episode['solves'] += puzzle.solved
+        return formatted
 
     def get_puzzle_list(self, user, team):
         """ Return the list of puzzles that a user/team can see"""
@@ -201,6 +215,61 @@ class Hunt(models.Model):
         return puzzle_list
 
 
+_hunts = LocalCache(maxsize=4)
+
+
+def _get_hunts():
+    """ All the hunts, ordered by number, from a cache invalidated by Hunt.save. Every call
+    returns new instances so that callers can freely modify them. """
+    version = get_version('hunts', 0)
+    data = _hunts.get('all', version)
+    if data is None:
+        key = "hunts:%s" % version
+        data = cache.get(key)
+        if data is None:
+            data = pickle.dumps(list(Hunt.objects.order_by('hunt_number')))
+            cache.set(key, data, 24 * 3600)
+        _hunts.set('all', data, version)
+    return pickle.loads(data)
+
+
+def get_current_hunt():
+    """ The current hunt, raises Hunt.DoesNotExist if there is none """
+    for hunt in _get_hunts():
+        if hunt.is_current_hunt:
+            return hunt
+    raise Hunt.DoesNotExist("There is no current hunt")
+
+
+def get_hunt(pk):
+    """ The hunt with this pk, raises Hunt.DoesNotExist if there is none """
+    for hunt in _get_hunts():
+        if hunt.pk == pk:
+            return hunt
+    raise Hunt.DoesNotExist("There is no hunt %s" % pk)
+
+
+def get_hunt_by_number(number):
+    """ The hunt with this number (an int or the string of an URL), raises Hunt.DoesNotExist if
+    there is none """
+    for hunt in _get_hunts():
+        if hunt.hunt_number == int(number):
+            return hunt
+    raise Hunt.DoesNotExist("There is no hunt number %s" % number)
+
+
+def get_recent_hunts(limit=5):
+    """ The last finished hunts, other than the current one, most recent first """
+    old_hunts = [hunt for hunt in _get_hunts() if hunt.is_finished and not hunt.is_current_hunt]
+    return old_hunts[::-1][:limit]
+
+
+def get_last_finished_hunt():
+    """ The finished hunt with the latest end date, or None """
+    finished = [hunt for hunt in _get_hunts() if hunt.is_finished]
+    return max(finished, key=lambda hunt: hunt.end_date) if len(finished) > 0 else None
+
+
 class Episode(models.Model):
     """ Base class for a set of puzzle """
 
@@ -294,6 +363,11 @@ class PuzzleManager(models.Manager):
                     .exclude(pk=puz.pk) \
                     .update(puzzle_number=models.F('puzzle_number') - 1)
 
+        # bulk updates do not send signals, the cached unlock graphs must be refreshed by hand
+        bump_version_on_commit('hunt', puz.episode.hunt_id)
+        if old_episode.hunt_id != puz.episode.hunt_id:
+            bump_version_on_commit('hunt', old_episode.hunt_id)
+
 
 class Puzzle(models.Model):
     """ A class representing a puzzle within a hunt """
@@ -368,19 +442,24 @@ class Puzzle(models.Model):
     def __str__(self):
         return str(self.puzzle_number) + "-" + str(self.puzzle_id) + " " + self.puzzle_name + " (" + self.episode.ep_name + ")"
 
-    def starting_time_for_team(self, team):
+    def unlock_time_for_team(self, team):
+        """ The time the team started working on the puzzle, taking the episode headstart into
+        account, or None if the team has not unlocked it. Costs a single query. """
         episode = self.episode
-        if team is None:
+        headstart = TeamEpisodeLink.objects.filter(episode=episode, team=team).values('headstart')[:1]
+        unlock = TeamPuzzleLink.objects.filter(puzzle=self, team=team) \
+            .annotate(ep_headstart=Subquery(headstart)).values_list('time', 'ep_headstart').first()
+        if unlock is None:
+            return None
+        if unlock[1] is None:
             return episode.start_date
-        else:
-            try:
-                puz_unlock = TeamPuzzleLink.objects.get(puzzle=self, team=team)
-                ep_unlock = TeamEpisodeLink.objects.get(episode=episode, team=team)
-                return max(puz_unlock.time,episode.start_date-ep_unlock.headstart)
-            except TeamPuzzleLink.DoesNotExist:
-                return episode.start_date
-            except TeamEpisodeLink.DoesNotExist:
-                return episode.start_date
+        return max(unlock[0], episode.start_date - unlock[1])
+
+    def starting_time_for_team(self, team):
+        if team is None:
+            return self.episode.start_date
+        start = self.unlock_time_for_team(team)
+        return self.episode.start_date if start is None else start
 
 
 def puzzle_file_path(instance, filename):
@@ -532,13 +611,16 @@ class Hint(models.Model):
                 for team_eureka in teams_eurekas:
                   if eureka == team_eureka.eureka:
                       eureka_times.append(team_eureka.time - start_time)
-              if len(eureka_times) >= self.number_eurekas:
-                return min(self.time, max(eureka_times) + self.short_time)
-              else:
-                return self.time
+              return self.delay_after_eurekas(eureka_times)
             else:
                 return self.time
 
+    def delay_after_eurekas(self, eureka_times):
+        """ The delay of the hint for a team that found its eurekas after these durations """
+        if len(eureka_times) > 0 and len(eureka_times) >= self.number_eurekas:
+            return min(self.time, max(eureka_times) + self.short_time)
+        return self.time
+
     def starting_time_for_team(self, team):
         return self.puzzle.starting_time_for_team(team)
 
@@ -578,3 +660,50 @@ class APIToken(models.Model):
 
     def __str__(self):
         return str(self.token)
+
+
+
+# drop the compiled templates (see hunts.cache) of hunts and flatpages when they change
+@receiver(post_save, sender=Hunt)
+@receiver(post_save, sender=FlatPage)
+def template_changed(sender, instance, *args, **kwargs):
+    forget_template(sender._meta.label_lower, instance.pk)
+
+
+# invalidate the cached answer matchers (see hunts.matching) and page data (see hunts.rendering)
+# when a puzzle, its eurekas or its files change
+@receiver([post_save, post_delete], sender=Puzzle)
+def puzzle_content_changed(sender, instance, *args, **kwargs):
+    bump_version_on_commit('puzzle', instance.pk)
+
+@receiver([post_save, post_delete], sender=Eureka)
+@receiver([post_save, post_delete], sender=PuzzleFile)
+@receiver([post_save, post_delete], sender=SolutionFile)
+def puzzle_related_changed(sender, instance, *args, **kwargs):
+    bump_version_on_commit('puzzle', instance.puzzle_id)
+
+
+# invalidate the cached unlock graphs (see hunts.graph) when puzzles, episodes or unlocks change
+@receiver([post_save, post_delete], sender=Puzzle)
+def puzzle_graph_changed(sender, instance, *args, **kwargs):
+    bump_version_on_commit('hunt', instance.episode.hunt_id)
+
+@receiver([post_save, post_delete], sender=Episode)
+def episode_graph_changed(sender, instance, *args, **kwargs):
+    bump_version_on_commit('hunt', instance.hunt_id)
+
+@receiver(m2m_changed, sender=Puzzle.unlocks.through)
+def unlocks_graph_changed(sender, instance, action, *args, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version_on_commit('hunt', instance.episode.hunt_id)
+
+# the puzzle_id => (puzzle, episode, hunt) mapping of hunts.resolver
+@receiver([post_save, post_delete], sender=Puzzle)
+@receiver([post_save, post_delete], sender=Episode)
+@receiver([post_save, post_delete], sender=Hunt)
+def puzzle_refs_changed(sender, instance, *args, **kwargs):
+    invalidate_puzzles()
+
+@receiver(post_delete, sender=Hunt)
+def hunt_deleted(sender, instance, *args, **kwargs):
+    bump_version_on_commit('hunts', 0)
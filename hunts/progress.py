@@ -0,0 +1,145 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import DateTimeField, ExpressionWrapper, F
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from .cache import get_version, get_versions, bump_version_on_commit
+
+# The progress of a team (unlocked episodes and puzzles, solves) is versioned twice: per team,
+# bumped by the unlock and solve code paths, and per hunt, bumped by the staff actions that
+# change the progress of many teams at once (initial release, reset). Anything derived from
+# the progress of a team is cached under both, and under the version of the hunt graph.
+
+
+def bump_team_progress(team_pk):
+    bump_version_on_commit('team-progress', team_pk)
+
+
+def bump_hunt_progress(hunt_pk):
+    bump_version_on_commit('hunt-progress', hunt_pk)
+
+
+def bump_hunt_solves(hunt_pk):
+    """ To be called when any team of the hunt solves a puzzle, see the leaderboard """
+    bump_version_on_commit('hunt-solves', hunt_pk)
+
+
+def get_progress_version(team_pk, hunt_pk):
+    """ A string identifying the current progress of the team and content of the hunt """
+    return "%s.%s.%s" % tuple(get_versions([('team-progress', team_pk), ('hunt-progress', hunt_pk),
+                                            ('hunt', hunt_pk)]))
+
+
+def get_solve_counts(team_pk, hunt_pk):
+    """ The numbers of episodes and of puzzles solved by the team """
+    key = "team-solves:%s:%s" % (team_pk, get_progress_version(team_pk, hunt_pk))
+    counts = cache.get(key)
+    if counts is None:
+        EpisodeSolve = apps.get_model('teams', 'EpisodeSolve')
+        PuzzleSolve = apps.get_model('teams', 'PuzzleSolve')
+        counts = (EpisodeSolve.objects.filter(team=team_pk).count(),
+                  PuzzleSolve.objects.filter(team=team_pk).count())
+        cache.set(key, counts, 24 * 3600)
+    return counts
+
+
+def get_team_episodes(team_pk, hunt_pk):
+    """ The episodes unlocked by the team, as a list of (episode pk, time at which the episode
+    becomes visible to the team) ordered by episode number """
+    key = "team-episodes:%s:%s" % (team_pk, get_progress_version(team_pk, hunt_pk))
+    episodes = cache.get(key)
+    if episodes is None:
+        TeamEpisodeLink = apps.get_model('teams', 'TeamEpisodeLink')
+        episodes = list(TeamEpisodeLink.objects.filter(team=team_pk)
+                        .order_by('episode__ep_number')
+                        .values_list('episode', ExpressionWrapper(F('episode__start_date') - F('headstart'),
+                                                                  output_field=DateTimeField())))
+        cache.set(key, episodes, 24 * 3600)
+    return episodes
+
+
+def visible_episode_pks(team_pk, hunt_pk, now=None):
+    """ The pks of the episodes unlocked by the team that have started for it """
+    now = now or timezone.now()
+    return [pk for pk, visible_at in get_team_episodes(team_pk, hunt_pk) if visible_at <= now]
+
+
+# The puzzles unlocked by each team are also kept in a Redis set of puzzle pks, so that the access
+# check done on every puzzle page and file is a single SISMEMBER. The set is filled from the
+# database on first use, new unlocks are added to it once committed, and it is dropped whenever
+# unlocks are deleted. Sets are keyed by the hunt progress version, so that the bulk release and
+# reset start over with new ones. A puzzle missing from the set is always checked against the
+# database.
+UNLOCKED_TIMEOUT = 24 * 3600
+
+# adds the members to the set only if it exists, a missing set is filled by the next check
+_ADD_IF_EXISTS = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('sadd', KEYS[1], unpack(ARGV))
+end
+return 0
+"""
+
+
+def _unlocked_key(team_pk, hunt_pk):
+    return cache.make_key("unlocked-puzzles:%s:%s" % (team_pk, get_version('hunt-progress', hunt_pk)))
+
+
+def _load_unlocked_puzzles(team_pk, key):
+    TeamPuzzleLink = apps.get_model('teams', 'TeamPuzzleLink')
+    pks = list(TeamPuzzleLink.objects.filter(team=team_pk).values_list('puzzle', flat=True))
+    pipe = get_redis_connection().pipeline()
+    # 0 is never a puzzle pk, it keeps the set of a team without unlocks from being empty
+    pipe.sadd(key, 0, *pks)
+    pipe.expire(key, UNLOCKED_TIMEOUT)
+    pipe.execute()
+    return pks
+
+
+def add_unlocked_puzzles(team_pk, hunt_pk, puzzle_pks):
+    """ To be called when the team unlocks puzzles, the set is updated on commit """
+    puzzle_pks = list(puzzle_pks)
+    if len(puzzle_pks) == 0:
+        return
+    transaction.on_commit(lambda: get_redis_connection().eval(
+        _ADD_IF_EXISTS, 1, _unlocked_key(team_pk, hunt_pk), *puzzle_pks))
+
+
+def forget_unlocked_puzzles(team_pk, hunt_pk):
+    """ To be called when unlocks of the team are deleted """
+    key = _unlocked_key(team_pk, hunt_pk)
+    get_redis_connection().delete(key)
+    if not transaction.get_autocommit():
+        transaction.on_commit(lambda: get_redis_connection().delete(key))
+
+
+def has_unlocked_puzzle(team_pk, hunt_pk, puzzle_pk):
+    """ Whether the team has unlocked the puzzle, with a single indexed query on a cache miss """
+    key = _unlocked_key(team_pk, hunt_pk)
+    if get_redis_connection().sismember(key, puzzle_pk):
+        return True
+    TeamPuzzleLink = apps.get_model('teams', 'TeamPuzzleLink')
+    if not TeamPuzzleLink.objects.filter(team=team_pk, puzzle=puzzle_pk).exists():
+        return False
+    transaction.on_commit(lambda: _load_unlocked_puzzles(team_pk, key))
+    return True
+
+
+def can_see_puzzle(team_pk, hunt_pk, puzzle):
+    """ Whether the team has unlocked the puzzle and the puzzle's episode has started for it """
+    return (puzzle.episode_id in visible_episode_pks(team_pk, hunt_pk) and
+            has_unlocked_puzzle(team_pk, hunt_pk, puzzle.pk))
@@ -0,0 +1,232 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+from django.core.cache import cache
+from django.db.models import Count
+from django.template import Context
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.safestring import mark_safe
+from hashlib import sha1, sha256
+from string import Template
+
+from .cache import LocalCache, get_compiled_template, get_version, get_versions
+from .graph import get_hunt_graph
+from .models import get_current_hunt
+from .progress import get_progress_version, get_solve_counts, visible_episode_pks
+from .resolver import get_team_pk
+from teams.models import TeamStanding
+
+import re
+import time
+
+# The part of a puzzle page that is the same for every team: the puzzle template with the URLs
+# of its files substituted, and whether the puzzle has eurekas visible to the players
+PuzzleBody = namedtuple('PuzzleBody', ['text', 'eureka'])
+
+# Keys used to obfuscate the answers sent to the browser in demo and finished hunts
+PREPUZZLE_SALT = "SuperRandomInitialSalt"
+POSTPUZZLE_KEY = "secretkey"
+
+_puzzle_data = LocalCache(maxsize=1024)
+
+# Flatpages using these variables depend on the user, the others are rendered once for everyone
+USER_VARIABLES_RE = re.compile(r"\b(nb_solve|user)\b")
+
+# The leaderboard shows the first teams only, and is rebuilt at most once per second while
+# teams keep solving puzzles
+LEADERBOARD_SIZE = 10
+LEADERBOARD_DELAY = 1
+
+
+def _get_puzzle_data(kind, puzzle, build):
+    """ Returns build(puzzle), computed at most once per puzzle version: the version is bumped
+    when the puzzle, its files or its eurekas change """
+    version = get_version('puzzle', puzzle.pk)
+    data = _puzzle_data.get((kind, puzzle.pk), version)
+    if data is None:
+        key = "puzzle-%s:%s:%s" % (kind, puzzle.pk, version)
+        data = cache.get(key)
+        if data is None:
+            data = build(puzzle)
+            cache.set(key, data, 24 * 3600)
+        _puzzle_data.set((kind, puzzle.pk), data, version)
+    return data
+
+
+def render_puzzle_body(puzzle):
+    """ Builds the body of the puzzle page from the database """
+    puzzle_files = {slug: reverse('puzzle_file', kwargs={'puzzle_id': puzzle.puzzle_id, 'file_path': url_path})
+                    for slug, url_path in puzzle.puzzlefile_set.filter(slug__isnull=False)
+                    .values_list('slug', 'url_path')}
+    text = Template(puzzle.template).safe_substitute(**puzzle_files)
+    return PuzzleBody(text, puzzle.eureka_set.filter(admin_only=False).exists())
+
+
+def get_puzzle_body(puzzle):
+    """ Returns the body of the puzzle page """
+    return _get_puzzle_data('body', puzzle, render_puzzle_body)
+
+
+# simple way to encode a prepuzzle response string
+def encode(key, string):
+    encoded_chars = []
+    for i in range(len(string)):
+        key_c = key[i % len(key)]
+        encoded_c = chr(ord(string[i]) + ord(key_c) % 256)
+        encoded_chars.append(encoded_c)
+    return "".join(encoded_chars)
+
+
+def hash_answer(text):
+    return sha256((PREPUZZLE_SALT + text.replace(" ", "").lower()).encode('utf-8')).hexdigest()
+
+
+def build_prepuzzle_values(puzzle):
+    """ What the pages of demo hunts need to check guesses in the browser """
+    eurekas = puzzle.eureka_set.filter(admin_only=False).values_list('answer', flat=True)
+    return {'answerHash': hash_answer(puzzle.answer),
+            'eurekaHashes': [hash_answer(eureka) for eureka in eurekas],
+            'responseEncoded': encode(puzzle.answer.replace(" ", "").lower(), puzzle.demo_response),
+            }
+
+
+def build_postpuzzle_values(puzzle):
+    """ What the pages of finished hunts need to check guesses in the browser, and the URLs of
+    the solution files """
+    eurekas = puzzle.eureka_set.filter(admin_only=False).values_list('regex', 'answer', 'feedback')
+    values = {'answer': encode(POSTPUZZLE_KEY, puzzle.answer),
+              'answer_regex': encode(POSTPUZZLE_KEY, puzzle.answer_regex),
+              'eurekas': [{'regex': encode(POSTPUZZLE_KEY, regex), 'answer': encode(POSTPUZZLE_KEY, answer),
+                           'feedback': encode(POSTPUZZLE_KEY, feedback)} for regex, answer, feedback in eurekas],
+              }
+    solutions = [reverse('solution_file', kwargs={'puzzle_id': puzzle.puzzle_id, 'file_path': url_path})
+                 for url_path in puzzle.solutionfile_set.values_list('url_path', flat=True)]
+    return values, solutions
+
+
+def get_prepuzzle_values(puzzle):
+    return _get_puzzle_data('prepuzzle', puzzle, build_prepuzzle_values)
+
+
+def get_postpuzzle_values(puzzle):
+    """ Returns the values and the solution URLs, see build_postpuzzle_values """
+    return _get_puzzle_data('postpuzzle', puzzle, build_postpuzzle_values)
+
+
+class Sidebar(object):
+    """ The episodes and puzzles listed in the sidebar of the hunt and puzzle pages. Both the
+    data and the rendered fragment are cached per team, under its progress version, so that
+    they are only rebuilt when the team unlocks or solves something. """
+
+    def __init__(self, hunt, user, team):
+        self.hunt = hunt
+        self.user = user
+        self.team = team
+        self.key = "%s:%s" % (hunt.pk, self._visibility_key())
+
+    def _visibility_key(self):
+        """ Identifies what the user/team can currently see of the hunt """
+        mode = 'all' if self.user.is_staff or self.hunt.is_public else 'team'
+        if self.team is None:
+            return "%s:-:%s" % (mode, get_version('hunt', self.hunt.pk))
+        progress = get_progress_version(self.team.pk, self.hunt.pk)
+        if mode == 'all':
+            return "%s:%s:%s" % (mode, self.team.pk, progress)
+        # episodes unlocked in advance only show up once their start date minus headstart is past
+        visible = len(visible_episode_pks(self.team.pk, self.hunt.pk))
+        return "%s:%s:%s:%d" % (mode, self.team.pk, progress, visible)
+
+    @cached_property
+    def episodes(self):
+        """ See Hunt.get_formatted_episodes """
+        key = "sidebar-episodes:%s" % self.key
+        episodes = cache.get(key)
+        if episodes is None:
+            episodes = self.hunt.get_formatted_episodes(self.user, self.team)
+            cache.set(key, episodes, 24 * 3600)
+        return episodes
+
+    def render(self, puzzle=None):
+        """ The HTML of the sidebar, with the current puzzle highlighted """
+        key = "sidebar:%s:%s:%s" % (self.key, get_version('hunts', 0), 0 if puzzle is None else puzzle.pk)
+        html = cache.get(key)
+        if html is None:
+            html = render_to_string('hunt/hunt_sidebar.html', {
+                'hunt': self.hunt, 'episodes': self.episodes, 'puzzle': puzzle})
+            cache.set(key, html, 24 * 3600)
+        return mark_safe(html)
+
+
+def _hunt_state(hunt):
+    # the dates of the hunt change what templates show without any write
+    return "%d%d%d%d" % (hunt.is_locked, hunt.is_open, hunt.is_public, hunt.is_finished)
+
+
+def render_hunt_template(hunt, team):
+    """ Renders the template of the hunt index page """
+    nb_solve = 0
+    if team is not None:
+        nb_solve = get_solve_counts(team.pk, hunt.pk)[0]
+    template = get_compiled_template('hunts.hunt', hunt.pk, hunt.template)
+    return template.render(Context({'curr_hunt': get_current_hunt(), 'nb_solve': nb_solve}))
+
+
+def render_flatpage(flatpage, user):
+    """ Renders the content of a flatpage. Pages that do not use the user or its solves are
+    cached for everyone until the page, the hunts or the state of the current hunt change. """
+    hunt = get_current_hunt()
+    template = get_compiled_template('flatpages.flatpage', flatpage.pk, flatpage.content)
+    if USER_VARIABLES_RE.search(flatpage.content):
+        team_pk = get_team_pk(user, hunt.pk)
+        nb_solve = 0 if team_pk is None else get_solve_counts(team_pk, hunt.pk)[1]
+        return template.render(Context({'curr_hunt': hunt, 'nb_solve': nb_solve, 'user': user}))
+
+    key = "flatpage:%s:%s:%s:%s" % (flatpage.pk, sha1(flatpage.content.encode('utf-8')).hexdigest(),
+                                    get_version('hunts', 0), _hunt_state(hunt))
+    html = cache.get(key)
+    if html is None:
+        html = template.render(Context({'curr_hunt': hunt, 'nb_solve': 0, 'user': user}))
+        cache.set(key, str(html), 24 * 3600)
+    return mark_safe(html)
+
+
+def get_leaderboard_standings(hunt):
+    """ The standings shown on the leaderboard: the first teams, or all the teams that finished
+    the hunt when there are more of them """
+    standings = TeamStanding.objects.filter(hunt=hunt, solves__gt=0).select_related('team') \
+        .annotate(size=Count('team__person')).order_by('rank', 'team__pk')
+    top = list(standings[:LEADERBOARD_SIZE + 1])
+    if (len(top) > LEADERBOARD_SIZE and
+            top[LEADERBOARD_SIZE - 1].episodes_solved == len(get_hunt_graph(hunt.pk).episode_pks)):
+        return list(standings.filter(solves=top[0].solves))
+    return top[:LEADERBOARD_SIZE]
+
+
+def render_leaderboard(hunt):
+    """ The HTML of the table of the leaderboard, and whether it shows the current standings.
+    After a solve, the previous table is served until it is a second old, then a single process
+    rebuilds it while the others keep serving the previous one. """
+    version = "%s.%s" % tuple(get_versions([('hunt-solves', hunt.pk), ('hunt-progress', hunt.pk)]))
+    key = "leaderboard:%s" % hunt.pk
+    entry = cache.get(key)
+    now = time.time()
+    if entry is not None:
+        entry_version, built, html = entry
+        if (entry_version == version or now - built < LEADERBOARD_DELAY or
+                not cache.add("leaderboard-lock:%s" % hunt.pk, 1, LEADERBOARD_DELAY)):
+            return mark_safe(html), entry_version == version
+    html = render_to_string('hunt/leaderboard_teams.html', {'standings': get_leaderboard_standings(hunt)})
+    cache.set(key, (version, now, html), 24 * 3600)
+    return mark_safe(html), True
@@ -0,0 +1,104 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.functional import SimpleLazyObject
+
+from .cache import LocalCache, get_version, bump_version_on_commit
+
+# Resolves the identifiers found in requests (user, puzzle_id) to primary keys through two cache
+# levels: a small LRU in the memory of the process, whose entries live a few seconds only so that
+# invalidations done by other processes are picked up quickly, in front of the django cache.
+LOCAL_TIMEOUT = 5
+REMOTE_TIMEOUT = 3600
+
+_user_teams = LocalCache(maxsize=4096, timeout=LOCAL_TIMEOUT)
+_puzzles = LocalCache(maxsize=2048, timeout=LOCAL_TIMEOUT)
+
+
+def _user_teams_key(user_pk):
+    return "user-teams:%s" % user_pk
+
+
+def get_user_teams(user_pk):
+    """ Returns the teams of the user as a dictionary hunt pk => team pk """
+    teams = _user_teams.get(user_pk)
+    if teams is None:
+        key = _user_teams_key(user_pk)
+        teams = cache.get(key)
+        if teams is None:
+            Team = apps.get_model('teams', 'Team')
+            teams = dict(Team.objects.filter(person__user=user_pk).values_list('hunt', 'pk'))
+            cache.set(key, teams, REMOTE_TIMEOUT)
+        _user_teams.set(user_pk, teams)
+    return teams
+
+
+def get_team_pk(user, hunt_pk):
+    """ Returns the pk of the team of the user for the hunt, or None """
+    if not user.is_authenticated:
+        return None
+    return get_user_teams(user.pk).get(hunt_pk)
+
+
+def get_team(user, hunt_pk):
+    """ Returns the team of the user for the hunt, or None. The team is only fetched from the
+    database when it is actually used. """
+    team_pk = get_team_pk(user, hunt_pk)
+    if team_pk is None:
+        return None
+    Team = apps.get_model('teams', 'Team')
+    return SimpleLazyObject(lambda: Team.objects.get(pk=team_pk))
+
+
+def invalidate_users(user_pks):
+    """ To be called when the teams of these users change. Entries are dropped right away and
+    once more on commit, in case another process cached the old teams in the meantime. """
+    user_pks = list(user_pks)
+    if len(user_pks) == 0:
+        return
+
+    def invalidate():
+        for user_pk in user_pks:
+            _user_teams.delete(user_pk)
+        cache.delete_many([_user_teams_key(user_pk) for user_pk in user_pks])
+
+    invalidate()
+    if not transaction.get_autocommit():
+        transaction.on_commit(invalidate)
+
+
+def resolve_puzzle(puzzle_id):
+    """ Returns the (puzzle pk, episode pk, hunt pk) of the puzzle with this puzzle_id, or None.
+    Puzzle ids are not case sensitive in URLs. """
+    puzzle_id = puzzle_id.lower()
+    ref = _puzzles.get(puzzle_id)
+    if ref is None:
+        key = "puzzle-ref:%s:%s" % (get_version('puzzle-refs', 0), puzzle_id)
+        ref = cache.get(key)
+        if ref is None:
+            Puzzle = apps.get_model('hunts', 'Puzzle')
+            ref = Puzzle.objects.filter(puzzle_id__iexact=puzzle_id).order_by('pk') \
+                .values_list('pk', 'episode', 'episode__hunt').first()
+            # unknown ids are cached as well, as an empty tuple
+            ref = tuple(ref or ())
+            cache.set(key, ref, REMOTE_TIMEOUT)
+        _puzzles.set(puzzle_id, ref)
+    return ref or None
+
+
+def invalidate_puzzles():
+    """ To be called when puzzles, episodes or hunts change """
+    _puzzles.clear()
+    bump_version_on_commit('puzzle-refs', 0)
@@ -0,0 +1,219 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+from django.db.models import Count, F, OuterRef, Subquery, IntegerField
+
+from .columns import HuntColumns, to_datetime
+from .graph import get_hunt_graph
+from .models import Puzzle
+from .timeline import get_team_timeline
+from teams.models import Guess, PuzzleSolve, TeamPuzzleLink, TeamEurekaLink, TeamStanding
+
+import numpy as np
+
+# The artifacts built for a hunt, the views read them from the artifact store (see hunts.artifacts)
+# under these names, with the pk of the team or puzzle appended for the per-object pages
+TEAMS = 'teams'
+TEAM = 'team-%s'
+PUZZLES = 'puzzles'
+PUZZLE = 'puzzle-%s'
+CHARTS = 'charts'
+CHARTS_DATA = 'charts-data'
+
+
+def format_duration(arg):
+    try:
+      seconds = int(arg.total_seconds())
+      if seconds < 60:
+        return str(seconds) + "s"
+      elif seconds < 3600:
+        return str(int(seconds/60)) + "m" + str(seconds % 60) + "s"
+      elif seconds < 3600*24:
+        return str(int(seconds/3600)) + "h" + str(int((seconds % 3600)/60)) + "m"
+      else:
+        return str(int(seconds/3600/24)) + "d" + str(int((seconds % (3600*24))/3600)) + "h"
+    except AttributeError:
+      return ''
+
+
+def int_to_rank(n):
+  return "%d%s" % (n,"tsnrhtdd"[(n//10%10!=1)*(n%10<4)*n%10::4])
+
+
+def _chart_duration(seconds):
+    """ A duration as the time of day it would be at that long after midnight, as read by the charts """
+    if np.isnan(seconds):
+        return None
+    return to_datetime(seconds).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def _hunt_header(hunt):
+    return {'hunt_name': hunt.hunt_name, 'display_start_date': hunt.display_start_date}
+
+
+class HuntStats(object):
+    """ Computes all the stats artifacts of a hunt in one pass: the timeline of every team is
+    loaded once and shared by the team and teams pages, the per-puzzle numbers come from the
+    columns of the whole hunt (see hunts.columns) """
+
+    def __init__(self, hunt, progress=None):
+        self.hunt = hunt
+        self.progress = progress or (lambda message: None)
+        self.graph = get_hunt_graph(hunt.pk)
+        self.teams = list(hunt.team_set.annotate(people=Count('person')).order_by('pk'))
+        self.timelines = {}
+        self.columns = None
+
+    def load_columns(self):
+        self.columns = HuntColumns(self.hunt, [team.pk for team in self.teams])
+        self.puzzle_stats = self.columns.puzzle_stats()
+
+    def hints(self, team_pk, puzzle_pk):
+        """ The number of hints the team had seen when it solved the puzzle, 0 if it did not """
+        i = self.columns.team_index.get(team_pk)
+        j = self.graph.index.get(puzzle_pk)
+        if i is None or j is None:
+            return 0
+        return int(self.columns.hints_used[i, j])
+
+    def load_timelines(self):
+        for i, team in enumerate(self.teams):
+            self.timelines[team.pk] = get_team_timeline(team)
+            if (i + 1) % 50 == 0:
+                self.progress("Loaded the timelines of %d/%d teams" % (i + 1, len(self.teams)))
+
+    def team(self, team):
+        solves_data = []
+        for row in self.timelines[team.pk]:
+            if row.solve_time is not None:
+                solves_data.append({'name' : row.name, 'pk': row.puzzle_pk, 'sol_time': row.solve_time, 'duration' : format_duration(row.duration),
+                                    'rank' : int_to_rank(row.rank), 'rankduration': int_to_rank(row.duration_rank),
+                                    'hints': self.hints(team.pk, row.puzzle_pk), 'nbguesses': row.guesses})
+            else:
+                solves_data.append({'name' : row.name, 'pk': row.puzzle_pk, 'sol_time': '' , 'duration' : '', 'rank' : '', 'rankduration': '', 'hints': '', 'nbguesses': row.guesses})
+        return {'solve_data': solves_data, 'team': {'team_name': team.team_name, 'size': team.people}, 'hunt': _hunt_header(self.hunt)}
+
+    def teams_summary(self):
+        teams = {team.pk: team for team in self.teams}
+        guesses = dict(Guess.objects.filter(hunt=self.hunt).order_by()
+                       .values('team').annotate(count=Count('pk')).values_list('team', 'count'))
+        team_data = []
+        for standing in TeamStanding.objects.filter(hunt=self.hunt).order_by('rank', 'team'):
+            team = teams.get(standing.team_id)
+            if team is None:
+                continue
+            hints = int(self.columns.hints_used[self.columns.team_index[team.pk]].sum())
+            team_data.append({'team_name': team.team_name, 'solves': standing.solves, 'last_time': standing.last_solve_time,
+                              'guesses': guesses.get(team.pk, 0), 'hints': hints, 'pk': team.pk, 'size': team.people})
+        hunt = _hunt_header(self.hunt)
+        hunt['puz'] = len(self.graph.puzzle_pks)
+        return {'team_data': team_data, 'hunt': hunt}
+
+    def puzzles_summary(self):
+        unlocks = dict(TeamPuzzleLink.objects.filter(puzzle__episode__hunt=self.hunt).order_by()
+                       .values('puzzle').annotate(count=Count('pk')).values_list('puzzle', 'count'))
+        guesses = dict(Guess.objects.filter(hunt=self.hunt).order_by()
+                       .values('puzzle').annotate(count=Count('pk')).values_list('puzzle', 'count'))
+        stats = self.puzzle_stats
+
+        data = []
+        for j, puzzle_pk in enumerate(self.graph.puzzle_pks):
+            dic = {'success': int(stats['success'][j]), 'name': self.graph.name(puzzle_pk)}
+            if dic['success'] == 0:
+              dic.update({'min_time': None, 'av_time': None, 'min_dur': '', 'av_dur': '', 'min_hints': 0, 'av_hints': 0})
+            else:
+              dic['min_time'] = to_datetime(stats['min_time'][j])
+              dic['av_time'] = to_datetime(stats['av_time'][j])
+              dic['min_dur'] = format_duration(timedelta(seconds=stats['min_dur'][j]))
+              dic['av_dur'] = format_duration(timedelta(seconds=stats['av_dur'][j]))
+              dic['min_hints'] = int(stats['min_hints'][j])
+              dic['av_hints'] = round(float(stats['av_hints'][j]), 2)
+            if unlocks.get(puzzle_pk, 0) == 0:
+              dic['guesses'] = 0
+            else:
+              dic['guesses'] = round(guesses.get(puzzle_pk, 0) / unlocks[puzzle_pk], 2)
+            dic['pk'] = puzzle_pk
+            data.append(dic)
+        return {'hunt': _hunt_header(self.hunt), 'data': data}
+
+    def puzzle(self, puz):
+        guesses_before = Guess.objects.filter(team=OuterRef('team'), puzzle=puz, guess_time__lte=OuterRef('guess__guess_time')) \
+            .order_by().values('team').annotate(count=Count('pk')).values('count')
+        solves = PuzzleSolve.objects.filter(puzzle=puz).select_related('team', 'guess') \
+            .annotate(guesses=Subquery(guesses_before, output_field=IntegerField()))
+        eureka_links = {}
+        for link in TeamEurekaLink.objects.filter(eureka__puzzle=puz).select_related('eureka'):
+            eureka_links.setdefault(link.team_id, []).append(link)
+
+        data = []
+        for sol in solves:
+            duration = sol.duration
+            sol_time = sol.guess.guess_time
+            eurekas = [{'txt' : eur.eureka.answer , 'time': format_duration(eur.time - sol_time + duration)}
+                       for eur in eureka_links.get(sol.team_id, []) if eur.time < sol_time]
+            data.append({'duration':format_duration(duration), 'sol_time': sol_time, 'guesses': sol.guesses or 0,
+                         'hints': self.hints(sol.team_id, puz.pk), 'eurekas':eurekas, 'team':sol.team.team_name, 'team_pk':sol.team_id})
+
+        common_guess = Guess.objects.common_wrong_answers(puz)
+
+        return {'hunt': _hunt_header(self.hunt), 'data':data, 'name': puz.puzzle_name, 'common_guess': common_guess}
+
+    def charts(self):
+        guesses = Guess.objects.filter(hunt=self.hunt)
+        spams = list(guesses.values(name=F('user__username' )).annotate(c=Count('name')).order_by('-c')[:10])
+        spam_teams = list(guesses.values(team_name=F('team__team_name'),team_iid=F('team')).annotate(c=Count('team_name')).order_by('-c')[:10])
+
+        #Chart fast / average puzzle solves
+        stats = self.puzzle_stats
+        data_puz = [{'av_dur': _chart_duration(stats['av_dur'][j]), 'min_dur': _chart_duration(stats['min_dur'][j]),
+                     'med_dur': _chart_duration(stats['med_dur'][j]), 'name': self.graph.name(puzzle_pk)}
+                    for j, puzzle_pk in enumerate(self.graph.puzzle_pks)]
+
+        return {'hunt': _hunt_header(self.hunt), 'spammers' : spams, 'spam_teams': spam_teams, 'data_puz': data_puz}
+
+    def charts_data(self):
+        """ The progress curves of the teams that solved something, best ranked first, in a compact
+        columnar format decoded once by the charts page: per episode and per team, the solve times in
+        seconds since the start of the episode, each one stored as the difference with the previous """
+        standings = TeamStanding.objects.filter(hunt=self.hunt, solves__gt=0).select_related('team').order_by('rank', 'team')
+        teams = [standing.team for standing in standings if standing.team_id in self.columns.team_index]
+        rows = [self.columns.team_index[team.pk] for team in teams]
+        episodes = []
+        for ep in self.hunt.episode_set.order_by('ep_number'):
+            curves = self.columns.episode_curves(ep.pk)[rows]
+            solves = []
+            for curve in curves:
+                # the curves are sorted, rounding keeps them so and the deltas non negative
+                offsets = np.round(curve[~np.isnan(curve)] - ep.start_date.timestamp()).astype(np.int64)
+                solves.append(np.diff(offsets, prepend=0).tolist())
+            puzzles = self.graph.episode_puzzles(ep.pk)
+            episodes.append({'name': ep.ep_name, 'start': ep.start_date, 'puzzles': puzzles,
+                             'names': [self.graph.name(pk) for pk in puzzles], 'solves': solves})
+        return {'teams': [team.pk for team in teams], 'names': [team.team_name for team in teams],
+                'episodes': episodes}
+
+    def build(self):
+        """ Returns all the artifacts of the hunt as a dictionary name => data """
+        self.progress("Loading the timelines of %d teams" % len(self.teams))
+        self.load_timelines()
+        self.load_columns()
+        artifacts = {TEAM % team.pk: self.team(team) for team in self.teams}
+        artifacts[TEAMS] = self.teams_summary()
+        self.progress("Computing the stats of %d puzzles" % len(self.graph.puzzle_pks))
+        artifacts[PUZZLES] = self.puzzles_summary()
+        for puz in Puzzle.objects.filter(episode__hunt=self.hunt):
+            artifacts[PUZZLE % puz.pk] = self.puzzle(puz)
+        self.progress("Computing the charts")
+        artifacts[CHARTS] = self.charts()
+        artifacts[CHARTS_DATA] = self.charts_data()
+        return artifacts
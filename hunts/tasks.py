@@ -0,0 +1,191 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from huey import crontab
+from huey.contrib.djhuey import db_task, db_periodic_task, lock_task
+
+from .artifacts import get_artifact_store
+from .graph import get_hunt_graph
+from .progress import bump_hunt_progress
+from .models import Hunt
+from .stats import HuntStats
+from teams.models import Team, Guess, PuzzleSolve, EpisodeSolve
+from teams.models import TeamPuzzleLink, TeamEpisodeLink, TeamEurekaLink, TeamUnlockCounter, TeamStanding
+from teams.models import HuntEvent
+
+import logging
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+# Everything a hunt reset deletes, ordered so that no row is deleted before the rows referencing it
+RESET_MODELS = (HuntEvent, PuzzleSolve, TeamPuzzleLink, TeamEurekaLink, TeamUnlockCounter,
+                EpisodeSolve, TeamEpisodeLink, Guess)
+
+# The delete receivers of these models (see teams.models) that the reset skips, deleting the rows
+# without loading them: bump_hunt_progress does their work for all the teams at once, as the
+# progress version of every team (progress_deleted), the key of the sets of unlocked puzzles
+# (puzzle_relocked) and the version of the leaderboard (puzzle_unsolved) depend on it
+RESET_SKIPPED_RECEIVERS = ('progress_deleted', 'puzzle_relocked', 'puzzle_unsolved')
+
+# How long a queued stats build keeps the periodic task from queueing another one, in seconds.
+# A build releases it when it ends, this only matters when a worker died with the build
+STATS_BUILD_TIMEOUT = 3600
+
+
+def _progress_key(task_id):
+    return "task-progress:%s" % task_id
+
+
+def get_task_progress(task_id):
+    """ The last progress message reported by a running task, or an empty string """
+    return cache.get(_progress_key(task_id), "")
+
+
+class Progress(object):
+    """ Reports the progress of a task to the staff pages polling it (see control/check_task) """
+
+    def __init__(self, task=None):
+        self.task_id = None if task is None else task.id
+
+    def __call__(self, message):
+        logger.info(message)
+        if self.task_id is not None:
+            cache.set(_progress_key(self.task_id), message, 3600)
+
+
+def release_initial_puzzles(hunt, teams, progress=None):
+    """ Gives every team of the queryset the episodes without prerequisites and all the puzzles
+    of its unlocked episodes that it should already have, in a constant number of queries
+    (plus one INSERT per batch). Returns the number of episode and puzzle links created. """
+    progress = progress or Progress()
+    graph = get_hunt_graph(hunt.pk)
+    team_pks = list(teams.values_list('pk', flat=True))
+    progress("Releasing initial puzzles to %d teams" % len(team_pks))
+
+    # Episodes without prerequisites
+    episode_links = set(TeamEpisodeLink.objects.filter(team__in=team_pks).values_list('team', 'episode'))
+    new_episode_links = [TeamEpisodeLink(team_id=team, episode_id=episode)
+                         for team in team_pks for episode in graph.initial_episode_pks
+                         if (team, episode) not in episode_links]
+    TeamEpisodeLink.objects.bulk_create(new_episode_links, batch_size=BATCH_SIZE, ignore_conflicts=True)
+    episode_links.update((link.team_id, link.episode_id) for link in new_episode_links)
+
+    # Puzzles of the unlocked episodes whose prerequisites are met
+    counters = {(team, puzzle): count for team, puzzle, count in TeamUnlockCounter.objects
+                .filter(team__in=team_pks).values_list('team', 'puzzle', 'solved_prerequisites')}
+    puzzle_links = set(TeamPuzzleLink.objects.filter(team__in=team_pks).values_list('team', 'puzzle'))
+    now = timezone.now()
+    new_puzzle_links = []
+    for team, episode in episode_links:
+        for puzzle in graph.episode_puzzles(episode):
+            if ((team, puzzle) not in puzzle_links and
+                    graph.required_for(puzzle) <= counters.get((team, puzzle), 0)):
+                new_puzzle_links.append(TeamPuzzleLink(team_id=team, puzzle_id=puzzle, time=now))
+
+    for start in range(0, len(new_puzzle_links), BATCH_SIZE):
+        TeamPuzzleLink.objects.bulk_create(new_puzzle_links[start:start + BATCH_SIZE], ignore_conflicts=True)
+        HuntEvent.objects.record_unlocks(hunt.pk, new_puzzle_links[start:start + BATCH_SIZE])
+        progress("Unlocked %d/%d puzzles" % (min(start + BATCH_SIZE, len(new_puzzle_links)), len(new_puzzle_links)))
+
+    bump_hunt_progress(hunt.pk)
+    return len(new_episode_links), len(new_puzzle_links)
+
+
+@db_task(context=True)
+def release_initial_puzzles_task(hunt_pk, playtesters_only=False, task=None):
+    """ Background version of release_initial_puzzles for all (playtesting) teams of a hunt """
+    hunt = Hunt.objects.get(pk=hunt_pk)
+    teams = Team.objects.filter(hunt=hunt)
+    if playtesters_only:
+        teams = teams.filter(playtester=True)
+    episodes, puzzles = release_initial_puzzles(hunt, teams, Progress(task))
+    return "Initial puzzles released: %d episode and %d puzzle unlocks created" % (episodes, puzzles)
+
+
+def reset_hunt_progress(hunt, dry_run=False, progress=None):
+    """ Deletes the progress of all the teams of the hunt (guesses, solves, unlocks, eurekas)
+    with one DELETE statement per table, in a single transaction. With dry_run nothing is deleted
+    and the rows are only counted. Returns a dictionary table name => number of rows. """
+    progress = progress or Progress()
+    counts = {}
+    with transaction.atomic():
+        for model in RESET_MODELS:
+            queryset = model.objects.filter(team__hunt=hunt)
+            name = str(model._meta.verbose_name_plural).strip()
+            if dry_run:
+                counts[name] = queryset.count()
+            else:
+                # no cascades are left at this point, skip the collector, which would load every
+                # row to send RESET_SKIPPED_RECEIVERS their signals one by one
+                counts[name] = queryset._raw_delete(queryset.db)
+            progress("%s: %d" % (name, counts[name]))
+        if not dry_run:
+            TeamStanding.objects.clear(hunt)
+            # instead of the skipped receivers
+            bump_hunt_progress(hunt.pk)
+    return counts
+
+
+@db_task(context=True)
+def reset_hunt_task(hunt_pk, dry_run=False, release=False, playtesters_only=False, task=None):
+    """ Background version of reset_hunt_progress, optionally followed by the initial release """
+    hunt = Hunt.objects.get(pk=hunt_pk)
+    progress = Progress(task)
+    counts = reset_hunt_progress(hunt, dry_run, progress)
+    lines = ["%s: %d" % (name, count) for name, count in counts.items()]
+    if dry_run:
+        return "Rows that would be deleted:\n" + "\n".join(lines)
+
+    lines.insert(0, "Progress reset, deleted rows:")
+    if release:
+        teams = Team.objects.filter(hunt=hunt)
+        if playtesters_only:
+            teams = teams.filter(playtester=True)
+        episodes, puzzles = release_initial_puzzles(hunt, teams, progress)
+        lines.append("Initial puzzles released: %d episode and %d puzzle unlocks created" % (episodes, puzzles))
+    return "\n".join(lines)
+
+
+def claim_stats_build(hunt_pk):
+    """ Whether a build of the stats of the hunt may be queued, false while another one is queued
+    or running. The build releases the claim when it ends. """
+    return cache.add("stats-build-queued:%s" % hunt_pk, 1, STATS_BUILD_TIMEOUT)
+
+
+@db_task(context=True)
+def build_hunt_stats(hunt_pk, task=None):
+    """ Computes the stats pages of the hunt and publishes them in the artifact store, the stats
+    views only read what this task built """
+    progress = Progress(task)
+    try:
+        with lock_task('build-hunt-stats-%s' % hunt_pk):
+            hunt = Hunt.objects.get(pk=hunt_pk)
+            artifacts = HuntStats(hunt, progress).build()
+            get_artifact_store().publish(hunt.pk, artifacts)
+    finally:
+        cache.delete("stats-build-queued:%s" % hunt_pk)
+    return "Stats of %s built: %d pages" % (hunt.hunt_name, len(artifacts))
+
+
+@db_periodic_task(crontab(minute='*/5'))
+def build_finished_hunt_stats():
+    """ Builds the stats of the hunts that ended since their last build, skipping the hunts whose
+    build is still queued or running """
+    store = get_artifact_store()
+    for hunt in Hunt.objects.filter(end_date__lte=timezone.now()):
+        built_at = store.built_at(hunt.pk)
+        if (built_at is None or built_at < hunt.end_date) and claim_stats_build(hunt.pk):
+            build_hunt_stats(hunt.pk)
@@ -12,9 +12,10 @@
 
 from django import template
 from django.conf import settings
-from django.template import Template, Context
-from hunts.models import Hunt
-from datetime import datetime
+from django.template import Context
+from hunts.models import Hunt, get_current_hunt, get_recent_hunts
+from hunts.cache import get_compiled_template
+from hunts.rendering import render_flatpage, render_hunt_template
 register = template.Library()
 
 
@@ -33,6 +34,11 @@ def contact_email(context):
     return settings.CONTACT_EMAIL
 
 
+@register.simple_tag(takes_context=True)
+def hunt_sidebar(context):
+    return context['sidebar'].render(context.get('puzzle'))
+
+
 @register.filter
 def duration(td):
 
@@ -54,26 +60,16 @@ def duration(td):
 
 @register.filter()
 def render_with_context(value, user):
-    return Template(value).render(Context({'curr_hunt': Hunt.objects.get(is_current_hunt=True), 'user': user}))
-    
-@register.filter()
-def render_hunt_with_context(value, team):
-    hunt = Hunt.objects.get(is_current_hunt=True)
-    nbsolve = 0
-    if team is not None:
-      nbsolve = team.ep_solved.count()
-    return Template(value).render(Context({'curr_hunt': Hunt.objects.get(is_current_hunt=True),  'nb_solve': nbsolve}))
-    
+    template = get_compiled_template(None, None, value)
+    return template.render(Context({'curr_hunt': get_current_hunt(), 'user': user}))
+
+@register.simple_tag(takes_context=True)
+def render_hunt_with_context(context):
+    return render_hunt_template(context['hunt'], context['team'])
+
 @register.simple_tag(takes_context=True)
 def render_with_context_simpletag(context):
-    user = context['user']
-    value = context['flatpage'].content
-    hunt = Hunt.objects.get(is_current_hunt=True)
-    team = hunt.team_from_user(user)
-    nbsolve = 0
-    if team is not None:
-      nbsolve = team.puz_solved.count()
-    return Template(value).render(Context({'curr_hunt': hunt, 'nb_solve': nbsolve, 'user': user}))
+    return render_flatpage(context['flatpage'], context['user'])
 
 @register.tag
 def set_curr_hunt(parser, token):
@@ -82,7 +78,7 @@ def set_curr_hunt(parser, token):
 
 class CurrentHuntEventNode(template.Node):
     def render(self, context):
-        context['tmpl_curr_hunt'] = Hunt.objects.get(is_current_hunt=True)
+        context['tmpl_curr_hunt'] = get_current_hunt()
         return ''
 
 
@@ -93,8 +89,7 @@ def set_hunts(parser, token):
 
 class HuntsEventNode(template.Node):
     def render(self, context):
-        old_hunts = Hunt.objects.filter(end_date__lt=datetime.now()).exclude(is_current_hunt=True)
-        context['tmpl_hunts'] = old_hunts.order_by("-hunt_number")[:5]
+        context['tmpl_hunts'] = get_recent_hunts(5)
         return ''
 
 
@@ -112,5 +107,5 @@ class HuntFromContextEventNode(template.Node):
             context['tmpl_hunt'] = context['puzzle'].hunt
             return ''
         else:
-            context['tmpl_hunt'] = Hunt.objects.get(is_current_hunt=True)
+            context['tmpl_hunt'] = get_current_hunt()
             return ''
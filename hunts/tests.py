@@ -10,6 +10,759 @@
 #
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.test import TestCase
+from contextlib import contextmanager
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models.signals import post_delete, pre_delete
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from hunts.artifacts import FileArtifactStore, get_artifact_store
+from hunts.cache import bump_version, get_compiled_template, get_version
+from hunts.columns import HuntColumns
+from hunts.files import parse_range, serve_file
+from hunts.graph import HuntGraph, get_hunt_graph
+from hunts.matching import get_matcher
+from hunts.rendering import Sidebar, get_puzzle_body, get_postpuzzle_values, render_hunt_template
+from hunts.rendering import render_leaderboard
+from hunts.resolver import get_team_pk, resolve_puzzle
+from hunts.stats import HuntStats
+from hunts.middleware import HuntMiddleware, PuzzleMiddleware
+from hunts.models import Hunt, Episode, Puzzle, Eureka, Hint, PuzzleFile, get_current_hunt, get_recent_hunts
+from hunts.models import get_hunt, get_hunt_by_number
+from hunts.progress import get_progress_version
+from hunts.tasks import RESET_MODELS, RESET_SKIPPED_RECEIVERS, release_initial_puzzles, reset_hunt_progress
+from hunts.tasks import build_hunt_stats, claim_stats_build
+from hunts.timeline import get_team_timeline, count_hints
+from teams.models import Team, Person, Guess, PuzzleSolve, TeamPuzzleLink, TeamEurekaLink
+from teams.models import EpisodeSolve, TeamEpisodeLink, TeamUnlockCounter, TeamStanding, encode_queue_cursor
+from teams.models import HuntEvent
+from types import SimpleNamespace
 
-# Create your tests here.
+import gzip
+import json
+import os
+import tempfile
+
+
+class HuntTestCase(TestCase):
+    """ A hunt with one open episode of two chained puzzles, and one team playing it """
+
+    def setUp(self):
+        now = timezone.now()
+        self.hunt = Hunt.objects.create(
+            hunt_name="Test hunt", hunt_number=1, team_size=5,
+            start_date=now - timedelta(days=1), end_date=now + timedelta(days=1),
+            display_start_date=now - timedelta(days=1), display_end_date=now + timedelta(days=1),
+            is_current_hunt=True, eureka_feedback="Keep going")
+        self.episode = Episode.objects.create(
+            ep_name="Episode 1", ep_number=1, start_date=now - timedelta(hours=1), hunt=self.hunt)
+        self.first = Puzzle.objects.create(
+            episode=self.episode, puzzle_name="First", puzzle_number=1, puzzle_id="first",
+            answer="Right Answer", num_required_to_unlock=0)
+        self.second = Puzzle.objects.create(
+            episode=self.episode, puzzle_name="Second", puzzle_number=2, puzzle_id="second",
+            answer="Other", num_required_to_unlock=1)
+        self.first.unlocks.add(self.second)
+        Eureka.objects.create(puzzle=self.first, regex="ALMOST", answer="almost")
+
+        self.user = User.objects.create_user("player", password="password")
+        self.team = Team.objects.create(team_name="Team", join_code="ABCDE", hunt=self.hunt)
+        Person.objects.create(user=self.user).teams.add(self.team)
+
+        # what the middlewares hand over to the views
+        self.puzzle = Puzzle.objects.select_related('episode__hunt').get(pk=self.first.pk)
+        get_matcher(self.puzzle)
+
+    @contextmanager
+    def assertMaxQueries(self, num):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        self.assertLessEqual(len(context), num, "\n".join(
+            query['sql'] for query in context.captured_queries))
+
+    def write_events(self):
+        """ Writes the HuntEvents waiting for the commit of the test transaction, which never comes """
+        callbacks = [func for sids, func in connection.run_on_commit if hasattr(func, 'hunt_events')]
+        connection.run_on_commit = [(sids, func) for sids, func in connection.run_on_commit
+                                    if not hasattr(func, 'hunt_events')]
+        for func in callbacks:
+            func()
+
+
+class GuessSubmissionTests(HuntTestCase):
+    def test_wrong_guess(self):
+        with self.assertMaxQueries(6):
+            guess, response = Guess.objects.submit(self.team, self.user, self.puzzle, "nope")
+        self.assertEqual(response['status'], 'wrong')
+        self.assertIsNotNone(guess.pk)
+
+    def test_eureka_guess(self):
+        with self.assertMaxQueries(6):
+            guess, response = Guess.objects.submit(self.team, self.user, self.puzzle, "almost")
+        self.assertEqual(response, {'status': 'eureka', 'message': "Keep going"})
+        self.assertTrue(TeamEurekaLink.objects.filter(team=self.team).exists())
+        self.write_events()
+        event = HuntEvent.objects.get(event_type=HuntEvent.EUREKA)
+        self.assertEqual((event.team, event.puzzle, event.episode), (self.team, self.first, self.episode))
+
+    def test_correct_guess(self):
+        with self.assertMaxQueries(19):
+            guess, response = Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        self.assertEqual(response['status'], 'correct')
+        self.assertTrue(PuzzleSolve.objects.filter(team=self.team, puzzle=self.first, guess=guess).exists())
+        self.assertTrue(TeamPuzzleLink.objects.filter(team=self.team, puzzle=self.second).exists())
+
+    def test_correct_guess_twice(self):
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        guess, response = Guess.objects.submit(self.team, self.user, self.puzzle, "RIGHTANSWER")
+        self.assertEqual(response['status'], 'correct')
+        self.assertEqual(PuzzleSolve.objects.filter(team=self.team).count(), 1)
+
+
+class UnlockTests(HuntTestCase):
+    def setUp(self):
+        super().setUp()
+        self.next_episode = Episode.objects.create(
+            ep_name="Episode 2", ep_number=2, start_date=timezone.now(), hunt=self.hunt)
+        self.episode.unlocks = self.next_episode
+        self.episode.headstarts = [timedelta(minutes=10)]
+        self.episode.save()
+        self.third = Puzzle.objects.create(
+            episode=self.next_episode, puzzle_name="Third", puzzle_number=1, puzzle_id="third",
+            answer="Third", num_required_to_unlock=0)
+
+    def test_new_team(self):
+        self.assertEqual(list(self.team.puz_unlocked.all()), [self.first])
+        self.assertEqual(list(self.team.ep_unlocked.all()), [self.episode])
+
+    def test_team_save_does_not_unlock(self):
+        TeamPuzzleLink.objects.filter(team=self.team).delete()
+        self.team.location = "Somewhere"
+        self.team.save()
+        self.assertFalse(TeamPuzzleLink.objects.filter(team=self.team).exists())
+
+    def test_episode_completion(self):
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        second = Puzzle.objects.select_related('episode__hunt').get(pk=self.second.pk)
+        Guess.objects.submit(self.team, self.user, second, "other")
+        self.assertTrue(EpisodeSolve.objects.filter(team=self.team, episode=self.episode).exists())
+        link = TeamEpisodeLink.objects.get(team=self.team, episode=self.next_episode)
+        self.assertEqual(link.headstart, timedelta(minutes=10))
+        self.assertTrue(TeamPuzzleLink.objects.filter(team=self.team, puzzle=self.third).exists())
+
+    def test_repair(self):
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        TeamUnlockCounter.objects.filter(team=self.team).delete()
+        TeamPuzzleLink.objects.filter(team=self.team, puzzle=self.second).delete()
+        self.team.unlock_puzzles_and_episodes()
+        self.assertTrue(TeamPuzzleLink.objects.filter(team=self.team, puzzle=self.second).exists())
+        self.assertEqual(TeamUnlockCounter.objects.get(team=self.team, puzzle=self.second).solved_prerequisites, 1)
+
+
+class HuntGraphTests(HuntTestCase):
+    def test_load(self):
+        with self.assertNumQueries(2):
+            graph = HuntGraph.load(self.hunt.pk)
+        self.assertEqual(graph.episode_puzzles(self.episode.pk), [self.first.pk, self.second.pk])
+        self.assertEqual(graph.successors(self.first.pk), [self.second.pk])
+        self.assertEqual(graph.predecessors(self.second.pk), [self.first.pk])
+        self.assertEqual(graph.required_for(self.second.pk), 1)
+        self.assertEqual(graph.initial_episode_pks, [self.episode.pk])
+
+    def test_invalidation(self):
+        get_hunt_graph(self.hunt.pk)
+        with self.assertNumQueries(0):
+            get_hunt_graph(self.hunt.pk)
+        self.second.unlocks.add(self.first)
+        self.assertEqual(get_hunt_graph(self.hunt.pk).successors(self.second.pk), [self.first.pk])
+
+
+class HuntTaskTests(HuntTestCase):
+    def test_release_initial_puzzles(self):
+        for i in range(5):
+            Team.objects.create(team_name="Team %d" % i, join_code="ABCDE", hunt=self.hunt)
+        TeamPuzzleLink.objects.all().delete()
+        TeamEpisodeLink.objects.all().delete()
+        get_hunt_graph(self.hunt.pk)
+
+        with self.assertMaxQueries(6):
+            episodes, puzzles = release_initial_puzzles(self.hunt, Team.objects.filter(hunt=self.hunt))
+        self.assertEqual((episodes, puzzles), (6, 6))
+        self.assertEqual(TeamPuzzleLink.objects.filter(puzzle=self.first).count(), 6)
+        self.assertFalse(TeamPuzzleLink.objects.filter(puzzle=self.second).exists())
+
+    def test_reset_hunt_progress(self):
+        Guess.objects.submit(self.team, self.user, self.puzzle, "almost")
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+
+        counts = reset_hunt_progress(self.hunt, dry_run=True)
+        self.assertEqual(counts['Guesses'], 2)
+        self.assertEqual(counts['Puzzles unlocked by teams'], 2)
+        self.assertEqual(Guess.objects.count(), 2)
+
+        with self.assertMaxQueries(11):
+            reset_hunt_progress(self.hunt)
+        self.assertFalse(Guess.objects.exists())
+        self.assertFalse(PuzzleSolve.objects.exists())
+        self.assertFalse(TeamEpisodeLink.objects.exists())
+        self.assertFalse(TeamUnlockCounter.objects.exists())
+
+    def test_reset_skipped_receivers(self):
+        receivers = {receiver.__name__ for model in RESET_MODELS for signal in (pre_delete, post_delete)
+                     for receiver in signal._live_receivers(model)}
+        self.assertEqual(receivers, set(RESET_SKIPPED_RECEIVERS))
+
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        progress = get_progress_version(self.team.pk, self.hunt.pk)
+        leaderboard = get_version('hunt-progress', self.hunt.pk)
+        reset_hunt_progress(self.hunt)
+        self.assertNotEqual(get_progress_version(self.team.pk, self.hunt.pk), progress)
+        self.assertNotEqual(get_version('hunt-progress', self.hunt.pk), leaderboard)
+
+
+class ResolverTests(HuntTestCase):
+    def test_team(self):
+        self.assertEqual(get_team_pk(self.user, self.hunt.pk), self.team.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_team_pk(self.user, self.hunt.pk), self.team.pk)
+
+        self.user.person.teams.remove(self.team)
+        self.assertIsNone(get_team_pk(self.user, self.hunt.pk))
+        self.team.person_set.add(self.user.person)
+        self.assertEqual(self.hunt.team_from_user(self.user), self.team)
+
+    def test_puzzle(self):
+        self.assertEqual(resolve_puzzle("first"), (self.first.pk, self.episode.pk, self.hunt.pk))
+        self.assertIsNone(resolve_puzzle("missing"))
+        self.assertEqual(resolve_puzzle("FiRsT"), resolve_puzzle("first"))
+        self.first.puzzle_id = "renamed"
+        self.first.save()
+        self.assertIsNone(resolve_puzzle("first"))
+        self.assertEqual(resolve_puzzle("renamed")[0], self.first.pk)
+
+
+class CurrentHuntTests(HuntTestCase):
+    def test_current_hunt(self):
+        self.assertEqual(get_current_hunt(), self.hunt)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_current_hunt(), self.hunt)
+
+        now = timezone.now()
+        Hunt.objects.create(
+            hunt_name="Next hunt", hunt_number=2, team_size=5,
+            start_date=now, end_date=now + timedelta(days=1),
+            display_start_date=now, display_end_date=now + timedelta(days=1), is_current_hunt=True)
+        self.assertEqual(get_current_hunt().hunt_number, 2)
+        self.assertEqual(get_recent_hunts(), [])
+
+    def test_hunt_by_number(self):
+        get_current_hunt()
+        request = RequestFactory().get('/')
+        with self.assertNumQueries(0):
+            HuntMiddleware(None).process_view(request, None, (), {'hunt_num': "1"})
+            self.assertEqual(request.hunt, self.hunt)
+            HuntMiddleware(None).process_view(request, None, (), {'hunt_num': "7"})
+            self.assertIsNone(request.hunt)
+        with self.assertRaises(Hunt.DoesNotExist):
+            get_hunt_by_number(7)
+
+    def test_puzzle_hunt(self):
+        get_hunt(self.hunt.pk)
+        resolve_puzzle("first")
+        request = RequestFactory().get('/')
+        with self.assertNumQueries(0):
+            PuzzleMiddleware(None).process_view(request, None, (), {'puzzle_id': "first"})
+            HuntMiddleware(None).process_view(request, None, (), {'puzzle_id': "first"})
+            self.assertEqual(request.hunt, self.hunt)
+        self.assertEqual(request.puzzle.pk, self.first.pk)
+
+
+class PuzzleBodyTests(HuntTestCase):
+    def test_body(self):
+        self.first.template = "<img src='${map}'>"
+        self.first.save()
+        PuzzleFile.objects.create(puzzle=self.first, slug="map", url_path="map.png", file="map.png")
+        body = get_puzzle_body(self.first)
+        url = reverse('puzzle_file', kwargs={'puzzle_id': "first", 'file_path': "map.png"})
+        self.assertEqual(body.text, "<img src='%s'>" % url)
+        self.assertTrue(body.eureka)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_puzzle_body(self.first), body)
+
+        Eureka.objects.filter(puzzle=self.first).update(admin_only=True)
+        Eureka.objects.first().save()
+        self.assertFalse(get_puzzle_body(self.first).eureka)
+
+
+class SidebarTests(HuntTestCase):
+    def test_episodes(self):
+        with self.assertMaxQueries(2):
+            episodes = self.hunt.get_formatted_episodes(self.user, self.team)
+        self.assertEqual(episodes, [{'ep': self.episode, 'puz': [self.first], 'solves': 0, 'total': 2}])
+
+    def test_cache(self):
+        sidebar = Sidebar(self.hunt, self.user, self.team)
+        self.assertIn("First", sidebar.render(self.first))
+        self.assertNotIn("Second", sidebar.render(self.first))
+        with self.assertNumQueries(0):
+            Sidebar(self.hunt, self.user, self.team).render(self.first)
+
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        sidebar = Sidebar(self.hunt, self.user, self.team)
+        self.assertIn("Second", sidebar.render(self.first))
+        self.assertEqual(sidebar.episodes[0]['solves'], 1)
+
+
+class AccessTests(HuntTestCase):
+    def test_can_see_puzzle(self):
+        self.assertTrue(self.team.can_see_puzzle(self.first))
+        # at most the fallback EXISTS query once the visible episodes are cached
+        with self.assertMaxQueries(1):
+            self.assertTrue(self.team.can_see_puzzle(self.first))
+        self.assertFalse(self.team.can_see_puzzle(self.second))
+
+        # the set of unlocked puzzles is only updated on commit, the database answers meanwhile
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        self.assertTrue(self.team.can_see_puzzle(self.second))
+
+        TeamPuzzleLink.objects.filter(team=self.team, puzzle=self.first).delete()
+        self.assertFalse(self.team.can_see_puzzle(self.first))
+
+    def test_episode_not_started(self):
+        self.episode.start_date = timezone.now() + timedelta(hours=1)
+        self.episode.save()
+        self.assertFalse(self.team.can_see_puzzle(self.first))
+
+
+@override_settings(PROTECTED_FILE_BACKEND='stream')
+class FileServingTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        os.makedirs(os.path.join(directory.name, "puzzles/1"))
+        # what serve_file uses of a FieldFile
+        self.file = SimpleNamespace(name="puzzles/1/sheet.pdf",
+                                    path=os.path.join(directory.name, "puzzles/1/sheet.pdf"))
+        with open(self.file.path, "wb") as f:
+            f.write(b"0123456789")
+        self.factory = RequestFactory()
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range("bytes=2-5", 10), (2, 5))
+        self.assertEqual(parse_range("bytes=7-", 10), (7, 9))
+        self.assertEqual(parse_range("bytes=-3", 10), (7, 9))
+        self.assertEqual(parse_range("bytes=12-", 10), ())
+        self.assertIsNone(parse_range("bytes=0-1,4-5", 10))
+        self.assertIsNone(parse_range(None, 10))
+
+    def test_stream(self):
+        response = serve_file(self.factory.get("/"), self.file)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(b"".join(response.streaming_content), b"0123456789")
+
+        response = serve_file(self.factory.get("/", HTTP_RANGE="bytes=2-4"), self.file)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], "bytes 2-4/10")
+        self.assertEqual(b"".join(response.streaming_content), b"234")
+
+        etag = response['ETag']
+        response = serve_file(self.factory.get("/", HTTP_IF_NONE_MATCH=etag), self.file)
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(PROTECTED_FILE_BACKEND='x-accel', MEDIA_URL='/media/')
+    def test_x_accel(self):
+        response = serve_file(self.factory.get("/"), self.file)
+        self.assertEqual(response['X-Accel-Redirect'], "/media/puzzles/1/sheet.pdf")
+        self.assertEqual(response.content, b"")
+
+
+class ConditionalGetTests(HuntTestCase):
+    def test_puzzle_page(self):
+        self.client.force_login(self.user)
+        url = reverse('puzzle', kwargs={'puzzle_id': "first"})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class TemplateCacheTests(HuntTestCase):
+    def test_compiled_template(self):
+        template = get_compiled_template('hunts.hunt', self.hunt.pk, "{{ nb_solve }}")
+        self.assertIs(get_compiled_template('hunts.hunt', self.hunt.pk, "{{ nb_solve }}"), template)
+        self.assertIsNot(get_compiled_template('hunts.hunt', self.hunt.pk, "{{ curr_hunt }}"), template)
+
+    def test_hunt_template(self):
+        self.hunt.template = "Solved {{ nb_solve }} episodes of {{ curr_hunt.hunt_name }}"
+        self.hunt.save()
+        self.assertEqual(render_hunt_template(self.hunt, self.team), "Solved 0 episodes of Test hunt")
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        second = Puzzle.objects.select_related('episode__hunt').get(pk=self.second.pk)
+        Guess.objects.submit(self.team, self.user, second, "other")
+        self.assertEqual(render_hunt_template(self.hunt, self.team), "Solved 1 episodes of Test hunt")
+
+
+class PayloadTests(HuntTestCase):
+    def test_postpuzzle_values(self):
+        values, solutions = get_postpuzzle_values(self.first)
+        self.assertEqual(len(values['eurekas']), 1)
+        self.assertEqual(solutions, [])
+        with self.assertNumQueries(0):
+            get_postpuzzle_values(self.first)
+        Eureka.objects.create(puzzle=self.first, regex="CLOSE", answer="close")
+        self.assertEqual(len(get_postpuzzle_values(self.first)[0]['eurekas']), 2)
+
+
+class RankTests(HuntTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = Team.objects.create(team_name="Other", join_code="FGHIJ", hunt=self.hunt)
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        Guess.objects.submit(self.other, self.user, self.puzzle, "right answer")
+        # fixed times and durations, the ones of the submits depend on the speed of the test
+        now = timezone.now()
+        Guess.objects.filter(team=self.team).update(guess_time=now - timedelta(minutes=20))
+        Guess.objects.filter(team=self.other).update(guess_time=now - timedelta(minutes=10))
+        PuzzleSolve.objects.filter(team=self.team).update(duration=timedelta(minutes=30), rank=1, duration_rank=1)
+        PuzzleSolve.objects.filter(team=self.other).update(duration=timedelta(minutes=40), rank=2, duration_rank=2)
+
+    def test_ranks(self):
+        first, second = PuzzleSolve.objects.filter(puzzle=self.first).order_by('rank')
+        self.assertEqual((first.team, first.rank, second.team, second.rank), (self.team, 1, self.other, 2))
+        self.assertEqual(PuzzleSolve.objects.recompute_ranks(self.hunt), 0)
+
+        # the other team unlocked the puzzle later and solved it faster
+        PuzzleSolve.objects.filter(pk=second.pk).update(duration=timedelta(minutes=5), rank=0, duration_rank=0)
+        self.assertEqual(PuzzleSolve.objects.recompute_ranks(self.hunt), 2)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.rank, first.duration_rank), (1, 2))
+        self.assertEqual((second.rank, second.duration_rank), (2, 1))
+
+    def test_same_rules_as_create(self):
+        # equal guess times keep distinct ranks, in the order the solves were created
+        Guess.objects.filter(puzzle=self.first).update(guess_time=timezone.now())
+        self.assertEqual(PuzzleSolve.objects.recompute_ranks(self.hunt), 0)
+        # equal durations share their duration rank
+        PuzzleSolve.objects.filter(puzzle=self.first).update(duration=timedelta(minutes=30))
+        self.assertEqual(PuzzleSolve.objects.recompute_ranks(self.hunt), 1)
+        self.assertEqual(set(PuzzleSolve.objects.values_list('duration_rank', flat=True)), {1})
+
+        # a solve guessed before the others but created after them comes first
+        third = Team.objects.create(team_name="Third", join_code="KLMNO", hunt=self.hunt)
+        guess = Guess.objects.create(team=third, user=self.user, puzzle=self.first, guess_text="right answer",
+                                     guess_time=timezone.now() - timedelta(hours=1))
+        solve = PuzzleSolve.objects.create_ranked(puzzle=self.first, team=third, guess=guess, duration=timedelta(minutes=1))
+        self.assertEqual((solve.rank, solve.duration_rank), (1, 1))
+        self.assertEqual(PuzzleSolve.objects.recompute_ranks(self.hunt), 0)
+
+
+class StandingTests(HuntTestCase):
+    def test_standings(self):
+        other = Team.objects.create(team_name="Other", join_code="FGHIJ", hunt=self.hunt)
+        self.assertEqual((self.team.standing.rank, other.standing.rank), (1, 1))
+
+        Guess.objects.submit(other, self.user, self.puzzle, "right answer")
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        self.assertEqual(TeamStanding.objects.get(team=other).rank, 1)
+        self.assertEqual(TeamStanding.objects.get(team=self.team).rank, 2)
+
+        second = Puzzle.objects.select_related('episode__hunt').get(pk=self.second.pk)
+        Guess.objects.submit(self.team, self.user, second, "other")
+        standing = TeamStanding.objects.get(team=self.team)
+        self.assertEqual((standing.solves, standing.episodes_solved, standing.rank), (2, 1, 1))
+        self.assertEqual(TeamStanding.objects.get(team=other).rank, 2)
+        self.assertEqual(TeamStanding.objects.rebuild(self.hunt), 0)
+
+        self.team.reset()
+        self.assertEqual(TeamStanding.objects.get(team=self.team).solves, 0)
+        self.assertEqual(TeamStanding.objects.get(team=other).rank, 1)
+
+    def test_earlier_solve_committed_later(self):
+        other = Team.objects.create(team_name="Other", join_code="FGHIJ", hunt=self.hunt)
+        now = timezone.now()
+        TeamStanding.objects.filter(team=other).update(solves=1, last_solve_time=now, rank=1)
+        TeamStanding.objects.filter(team=self.team).update(rank=2)
+        TeamStanding.objects.record_puzzle_solve(self.team, now - timedelta(minutes=1))
+        self.assertEqual(TeamStanding.objects.get(team=self.team).rank, 1)
+        self.assertEqual(TeamStanding.objects.get(team=other).rank, 2)
+
+    def test_teams_deleted(self):
+        for i in range(3):
+            Team.objects.create(team_name="Team %d" % i, join_code="ABCDE", hunt=self.hunt)
+        Team.objects.filter(hunt=self.hunt).delete()
+        rebuilds = [func for sids, func in connection.run_on_commit
+                    if getattr(func, 'standings_hunt', None) == self.hunt.pk]
+        self.assertEqual(len(rebuilds), 1)
+        rebuilds[0]()
+
+    def test_team_edit(self):
+        version = get_version('hunt-solves', self.hunt.pk)
+        team = Team.objects.get(pk=self.team.pk)
+        team.location = "Room 12"
+        with self.assertNumQueries(1):
+            team.save()
+        self.assertEqual(get_version('hunt-solves', self.hunt.pk), version)
+
+        now = timezone.now()
+        other_hunt = Hunt.objects.create(
+            hunt_name="Other hunt", hunt_number=2, team_size=5, start_date=now, end_date=now,
+            display_start_date=now, display_end_date=now)
+        team.hunt = other_hunt
+        team.save()
+        self.assertEqual(TeamStanding.objects.get(team=team).hunt, other_hunt)
+        self.assertNotEqual(get_version('hunt-solves', self.hunt.pk), version)
+
+    def test_leaderboard(self):
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        html, current = render_leaderboard(self.hunt)
+        self.assertIn("Team", html)
+        self.assertTrue(current)
+        with self.assertNumQueries(0):
+            render_leaderboard(self.hunt)
+
+    def test_stale_leaderboard(self):
+        self.client.force_login(self.user)
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        render_leaderboard(self.hunt)
+        # a newer solve, within the delay during which the previous table is kept
+        bump_version('hunt-solves', self.hunt.pk)
+        html, current = render_leaderboard(self.hunt)
+        self.assertFalse(current)
+        response = self.client.get(reverse('leaderboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class TimelineTests(HuntTestCase):
+    def test_timeline(self):
+        Guess.objects.submit(self.team, self.user, self.puzzle, "nope")
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        with self.assertNumQueries(1):
+            first, second = get_team_timeline(self.team)
+        solve = PuzzleSolve.objects.get(team=self.team, puzzle=self.first)
+        self.assertEqual((first.name, first.guesses, first.rank, first.duration), ("First", 2, 1, solve.duration))
+        self.assertEqual(first.start, self.first.unlock_time_for_team(self.team))
+        self.assertEqual((second.name, second.guesses, second.solve_time), ("Second", 0, None))
+
+    def test_hints(self):
+        Hint.objects.create(puzzle=self.first, text="Early", time=timedelta(0), short_time=timedelta(0))
+        Hint.objects.create(puzzle=self.first, text="Late", time=timedelta(days=1), short_time=timedelta(0))
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        timeline = get_team_timeline(self.team)
+        with self.assertNumQueries(3):
+            self.assertEqual(count_hints(self.team, timeline), {self.first.pk: 1})
+
+
+class StatsTests(HuntTestCase):
+    def test_build(self):
+        Guess.objects.submit(self.team, self.user, self.puzzle, "nope")
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        artifacts = HuntStats(self.hunt).build()
+        self.assertEqual(set(artifacts), {'teams', 'team-%d' % self.team.pk, 'puzzles', 'charts', 'charts-data',
+                                          'puzzle-%d' % self.first.pk, 'puzzle-%d' % self.second.pk})
+        team, = artifacts['teams']['team_data']
+        self.assertEqual((team['solves'], team['guesses'], team['size']), (1, 2, 1))
+        self.assertEqual([row['nbguesses'] for row in artifacts['team-%d' % self.team.pk]['solve_data']], [2, 0])
+        self.assertEqual(artifacts['puzzle-%d' % self.first.pk]['data'][0]['guesses'], 2)
+
+    def test_charts_data(self):
+        other = Team.objects.create(team_name="Other", join_code="FGHIJ", hunt=self.hunt)
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        second = Puzzle.objects.select_related('episode__hunt').get(pk=self.second.pk)
+        Guess.objects.submit(self.team, self.user, second, "other")
+        Guess.objects.submit(other, self.user, self.puzzle, "right answer")
+        data = HuntStats(self.hunt).build()['charts-data']
+        self.assertEqual((data['teams'], data['names']), ([self.team.pk, other.pk], ["Team", "Other"]))
+        episode, = data['episodes']
+        self.assertEqual(episode['puzzles'], [self.first.pk, self.second.pk])
+        solve = PuzzleSolve.objects.get(team=other)
+        self.assertEqual(episode['solves'][1], [round((solve.guess.guess_time - self.episode.start_date).total_seconds())])
+        first, delta = episode['solves'][0]
+        self.assertGreaterEqual(delta, 0)
+
+        self.user.is_staff = True
+        self.user.save()
+        get_artifact_store().publish(self.hunt.pk, {'charts-data': data})
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('charts_data') + '?teams=1', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content))['teams'], [self.team.pk, other.pk])
+        # any limit is rounded to a few sizes, with one cached payload each
+        data['teams'] = list(range(30))
+        get_artifact_store().publish(self.hunt.pk, {'charts-data': data})
+        response = self.client.get(reverse('charts_data') + '?teams=11')
+        self.assertEqual(len(json.loads(response.content)['teams']), 25)
+        response = self.client.get(reverse('charts_data') + '?teams=24')
+        self.assertEqual(len(json.loads(response.content)['teams']), 25)
+        response = self.client.get(reverse('charts_data') + '?teams=1000')
+        self.assertEqual(len(json.loads(response.content)['teams']), 30)
+
+    def test_queued_build(self):
+        self.addCleanup(cache.delete, "stats-build-queued:%s" % self.hunt.pk)
+        self.assertTrue(claim_stats_build(self.hunt.pk))
+        # the periodic task does not queue the build again while it waits in the queue
+        self.assertFalse(claim_stats_build(self.hunt.pk))
+        build_hunt_stats.call_local(self.hunt.pk)
+        self.assertIsNotNone(get_artifact_store().built_at(self.hunt.pk))
+        self.assertTrue(claim_stats_build(self.hunt.pk))
+
+    def test_file_store(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = FileArtifactStore(root)
+            self.assertIsNone(store.get(self.hunt.pk, 'teams'))
+            first = store.publish(self.hunt.pk, {'teams': {'build': 1}})
+            store.publish(self.hunt.pk, {'teams': {'build': 2}})
+            self.assertEqual(store.get(self.hunt.pk, 'teams'), {'build': 2})
+            self.assertTrue(os.path.isdir(os.path.join(root, str(self.hunt.pk), first['id'])))
+            store.publish(self.hunt.pk, {'teams': {'build': 3}})
+            # only the current and the previous builds are kept
+            self.assertFalse(os.path.isdir(os.path.join(root, str(self.hunt.pk), first['id'])))
+            self.assertEqual(len(os.listdir(os.path.join(root, str(self.hunt.pk)))), 3)
+
+
+class ColumnsTests(HuntTestCase):
+    def test_matches_per_team_code(self):
+        other = Team.objects.create(team_name="Other", join_code="FGHIJ", hunt=self.hunt)
+        eureka = Eureka.objects.get(puzzle=self.first)
+        Hint.objects.create(puzzle=self.first, text="Early", time=timedelta(0), short_time=timedelta(0))
+        Hint.objects.create(puzzle=self.first, text="Late", time=timedelta(days=1), short_time=timedelta(0))
+        shortened = Hint.objects.create(puzzle=self.first, text="Eureka", time=timedelta(days=1),
+                                        short_time=timedelta(0), number_eurekas=1)
+        shortened.eurekas.add(eureka)
+        Guess.objects.submit(self.team, self.user, self.puzzle, "almost")
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        Guess.objects.submit(other, self.user, self.puzzle, "right answer")
+
+        with self.assertMaxQueries(9):
+            columns = HuntColumns(self.hunt)
+            stats = columns.puzzle_stats()
+        first = get_hunt_graph(self.hunt.pk).index[self.first.pk]
+        for team in (self.team, other):
+            counts = count_hints(team, get_team_timeline(team))
+            self.assertEqual(columns.hints_used[columns.team_index[team.pk], first], counts[self.first.pk])
+        self.assertEqual((stats['success'][first], stats['min_hints'][first], stats['av_hints'][first]), (2, 1, 1.5))
+
+        solves = PuzzleSolve.objects.filter(puzzle=self.first).order_by('rank')
+        ranks, duration_ranks = columns.ranks()
+        for solve in solves:
+            self.assertEqual(ranks[columns.team_index[solve.team_id], first], solve.rank)
+        self.assertEqual(stats['med_dur'][first], sum(s.duration.total_seconds() for s in solves) / 2)
+
+    def test_start_without_unlock(self):
+        Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        TeamPuzzleLink.objects.filter(team=self.team, puzzle=self.first).delete()
+        columns = HuntColumns(self.hunt)
+        first = columns.graph.index[self.first.pk]
+        self.assertEqual(columns.start[columns.team_index[self.team.pk], first], self.episode.start_date.timestamp())
+
+
+class WrongAnswerTests(HuntTestCase):
+    def test_common_wrong_answers(self):
+        other = Team.objects.create(team_name="Other", join_code="FGHIJ", hunt=self.hunt)
+        for team in (self.team, other):
+            Guess.objects.submit(team, self.user, self.puzzle, "wrong one")
+            Guess.objects.submit(team, self.user, self.puzzle, "almost")
+        Guess.objects.submit(self.team, self.user, self.puzzle, "Wrong One")
+        Guess.objects.submit(self.team, self.user, self.puzzle, "lonely")
+        Guess.objects.submit(other, self.user, self.puzzle, "right answer")
+        Guess.objects.submit(self.team, self.user, self.puzzle, "rightanswer")
+        self.assertEqual(Guess.objects.get(guess_text="lonely").normalized_text, "LONELY")
+        with self.assertNumQueries(1):
+            answers = Guess.objects.common_wrong_answers(self.puzzle)
+        self.assertEqual(answers, [{'txt': "WRONGONE", 'teams': 2}])
+        self.assertEqual(len(Guess.objects.common_wrong_answers(self.puzzle, min_teams=1)), 2)
+
+
+class QueueTests(HuntTestCase):
+    def test_cursor(self):
+        first, response = Guess.objects.submit(self.team, self.user, self.puzzle, "nope")
+        second, response = Guess.objects.submit(self.team, self.user, self.puzzle, "right answer")
+        self.assertEqual(list(Guess.objects.modified_after(first.queue_cursor)), [second])
+        first.update_response("Try again")
+        self.assertEqual(list(Guess.objects.modified_after(second.queue_cursor)), [first])
+        self.assertEqual(first.serialize_for_queue()['status'], "wrong")
+        with self.assertRaises(ValueError):
+            Guess.objects.modified_after("yesterday")
+
+    def test_poll(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        guess, response = Guess.objects.submit(self.team, self.user, self.puzzle, "nope")
+        response = self.client.get(reverse('queue'), {'cursor': '0-0'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = response.json()
+        self.assertEqual([row['pk'] for row in data['guesses']], [guess.pk])
+        self.assertEqual(data['cursor'], guess.queue_cursor)
+        response = self.client.get(reverse('queue'), {'cursor': data['cursor']}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.json()['guesses'], [])
+        response = self.client.get(reverse('queue'), {'cursor': 'nope'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 400)
+
+    def test_pages(self):
+        guesses = [Guess.objects.submit(self.team, self.user, self.puzzle, "nope %d" % i)[0] for i in range(5)]
+        page, older, newer = Guess.objects.queue_page(self.hunt, size=2)
+        self.assertEqual((page, newer), ([guesses[4], guesses[3]], None))
+        with self.assertNumQueries(1):
+            page, older, newer = Guess.objects.queue_page(self.hunt, before=older, size=2)
+        self.assertEqual(page, [guesses[2], guesses[1]])
+        page, last, newest = Guess.objects.queue_page(self.hunt, before=older, size=2)
+        self.assertEqual((page, last), ([guesses[0]], None))
+        page, older, newer = Guess.objects.queue_page(self.hunt, after=newest, size=2)
+        self.assertEqual((page, newer), ([guesses[2], guesses[1]], encode_queue_cursor(guesses[2].pk)))
+        self.assertEqual(Guess.objects.queue_page(self.hunt, puzzle_id=self.second.pk)[0], [])
+        with self.assertRaises(ValueError):
+            Guess.objects.queue_page(self.hunt, before="!!")
+
+
+class ProgressEventTests(HuntTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write_events()
+
+    def test_events(self):
+        start = HuntEvent.objects.order_by('pk').last()
+        Guess.objects.submit(self.team, self.user, self.first, "nope")
+        Guess.objects.submit(self.team, self.user, self.first, "right answer")
+        self.write_events()
+        events = HuntEvent.objects.filter(pk__gt=start.pk).order_by('pk')
+        self.assertEqual([event.event_type for event in events],
+                         [HuntEvent.GUESS, HuntEvent.GUESS, HuntEvent.SOLVE, HuntEvent.UNLOCK])
+        self.assertEqual({event.episode_id for event in events}, {self.episode.pk})
+        self.assertEqual(events.last().serialize_for_ajax()['puzzle'], {'id': self.second.puzzle_id})
+
+    def test_unlocked_by_hand(self):
+        TeamPuzzleLink.objects.create(team=self.team, puzzle=self.second, time=timezone.now())
+        Guess.objects.submit(self.team, self.user, self.first, "right answer")
+        self.write_events()
+        self.assertEqual(HuntEvent.objects.filter(event_type=HuntEvent.UNLOCK, puzzle=self.second).count(), 1)
+
+    def test_poll(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        url = reverse('progress', args=[self.episode.pk])
+        response = self.client.get(url, {'cursor': '0'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = response.json()
+        self.assertEqual({message['status_type'] for message in data['messages']}, {HuntEvent.UNLOCK})
+        Guess.objects.submit(self.team, self.user, self.first, "right answer")
+        self.write_events()
+        response = self.client.get(url, {'cursor': data['cursor']}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        messages = response.json()['messages']
+        self.assertEqual([message['status_type'] for message in messages],
+                         [HuntEvent.GUESS, HuntEvent.SOLVE, HuntEvent.UNLOCK])
+        self.assertTrue(all(message['id'] > data['cursor'] for message in messages))
+        response = self.client.get(url, {'cursor': 'nope'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,72 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+from django.db.models import Count, F, FilteredRelation, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Puzzle, Hint
+from teams.models import Guess, TeamEpisodeLink, TeamEurekaLink
+
+# One puzzle unlocked by a team: when the team could start working on it (the unlock time, or
+# the start of the episode for teams given a headstart), and its solve if any
+TimelineRow = namedtuple('TimelineRow', [
+    'puzzle_pk', 'puzzle_id', 'name', 'unlock_time', 'start', 'solve_time', 'duration',
+    'rank', 'duration_rank', 'guesses'])
+
+
+def _start_time(unlock_time, episode_start, headstart):
+    """ See Puzzle.unlock_time_for_team """
+    if headstart is None:
+        return episode_start
+    return max(unlock_time, episode_start - headstart)
+
+
+def get_team_timeline(team):
+    """ The puzzles unlocked by the team, in unlock order, with their solves and the number of
+    guesses of the team on each of them, in a single query """
+    headstart = TeamEpisodeLink.objects.filter(team=team, episode=OuterRef('episode')).values('headstart')[:1]
+    guesses = Guess.objects.filter(team=team, puzzle=OuterRef('pk')).order_by() \
+        .values('puzzle').annotate(count=Count('pk')).values('count')
+    rows = Puzzle.objects.filter(teampuzzlelink__team=team) \
+        .annotate(solve=FilteredRelation('puzzlesolve', condition=Q(puzzlesolve__team=team)),
+                  unlock_time=F('teampuzzlelink__time'),
+                  headstart=Subquery(headstart),
+                  guesses=Coalesce(Subquery(guesses, output_field=IntegerField()), 0)) \
+        .order_by('unlock_time', 'pk') \
+        .values_list('pk', 'puzzle_id', 'puzzle_name', 'unlock_time', 'episode__start_date', 'headstart',
+                     'solve__guess__guess_time', 'solve__duration', 'solve__rank', 'solve__duration_rank',
+                     'guesses')
+    return [TimelineRow(pk, puzzle_id, name, unlock_time, _start_time(unlock_time, episode_start, headstart),
+                        solve_time, duration, rank, duration_rank, guesses)
+            for (pk, puzzle_id, name, unlock_time, episode_start, headstart,
+                 solve_time, duration, rank, duration_rank, guesses) in rows]
+
+
+def count_hints(team, timeline):
+    """ The number of hints each solved puzzle of the timeline had shown before its solve, as a
+    dictionary puzzle pk => count. Costs three queries however many puzzles were solved. """
+    rows = {row.puzzle_pk: row for row in timeline if row.solve_time is not None}
+    hints = list(Hint.objects.filter(puzzle__in=list(rows)))
+    hint_eurekas = {}
+    for hint, eureka in Hint.eurekas.through.objects.filter(hint__in=hints).values_list('hint', 'eureka'):
+        hint_eurekas.setdefault(hint, []).append(eureka)
+    found = dict(TeamEurekaLink.objects.filter(team=team).values_list('eureka', 'time'))
+
+    counts = {pk: 0 for pk in rows}
+    for hint in hints:
+        row = rows[hint.puzzle_id]
+        eureka_times = [found[eureka] - row.start for eureka in hint_eurekas.get(hint.pk, []) if eureka in found]
+        delay = hint.delay_after_eurekas(eureka_times) if hint.pk in hint_eurekas else hint.time
+        if delay < row.duration:
+            counts[hint.puzzle_id] += 1
+    return counts
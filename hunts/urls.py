@@ -66,6 +66,7 @@ urlpatterns = [
         url(r'^info/$', views.staff.hunt_info, name='hunt_info'),
         url(r'^lookup/$', views.staff.lookup, name='lookup'),
         url(r'^puzzle_dag/$', views.staff.puzzle_dag, name='puzzle_dag'),
+        url(r'^puzzle_dag/json/$', views.staff.puzzle_dag_json, name='puzzle_dag_json'),
     ])),
 
     # Stats pages
@@ -77,5 +78,6 @@ urlpatterns = [
         url(r'^puzzles/$', views.stats.puzzles, name='puzzles'),
         url(r'^puzzle/$', views.stats.puzzle, name='puzzle'),
         url(r'^charts/$', views.stats.charts, name='charts_stats'),
+        url(r'^charts/data/$', views.stats.charts_data, name='charts_data'),
     ])),
 ]
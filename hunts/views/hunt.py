@@ -10,7 +10,6 @@
 #
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
-from string import Template
 from datetime import datetime
 from dateutil import tz
 from django.conf import settings
@@ -19,29 +18,29 @@ from ratelimit.utils import is_ratelimited
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden
-from django.http import HttpResponseBadRequest, JsonResponse
+from django.http import HttpResponseNotFound, HttpResponseForbidden
+from django.http import HttpResponseBadRequest, JsonResponse, Http404
 from django.shortcuts import get_object_or_404, render, redirect
 from django.template import RequestContext
 from django.template.loader import render_to_string
 from django.utils import timezone
 from django.views import View
-from django.utils.encoding import smart_str
-from django.db.models import F
 from django.urls import reverse_lazy, reverse
 from pathlib import Path
-from django.db.models import F, Max, Count, Min, Subquery, OuterRef
+from django.db.models import F, Min, Subquery, OuterRef
 from django.db.models.fields import PositiveIntegerField
-from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.mixins import LoginRequiredMixin
 import json
-import os
 import re
 
-from hunts.models import Puzzle, Hunt, Guess, Unlockable
+from hunts.models import Hunt, Guess, Unlockable, get_current_hunt
 from teams.models import PuzzleSolve, EpisodeSolve, TeamEpisodeLink
+from hunts.files import serve_file
+from hunts.rendering import Sidebar, get_puzzle_body, get_prepuzzle_values, get_postpuzzle_values
+from hunts.rendering import render_leaderboard
+from hunts.timeline import get_team_timeline
 from .mixin import RequiredPuzzleAccessMixin, RequiredSolutionAccessMixin
-from hashlib import sha256
+from .mixin import ConditionalGetMixin, etag_versions
 
 import logging
 logger = logging.getLogger(__name__)
@@ -67,42 +66,24 @@ def format_duration(arg):
 
 class PuzzleFile(RequiredPuzzleAccessMixin, View):
     def get(self, request, puzzle_id, file_path):
-        puzzle = request.puzzle
-        puzzle_file = get_object_or_404(puzzle.puzzlefile_set, url_path=file_path)
-
-        pathname = smart_str(os.path.join(settings.MEDIA_ROOT, puzzle_file.file.path))
-        try:
-           with open(pathname, "rb") as f:
-              return HttpResponse(f.read(), content_type="image/png")
-        except IOError:
-           return HttpResponseNotFound('<h1>Page not found</h1>')
-
-
+        puzzle_file = get_object_or_404(request.puzzle.puzzlefile_set, url_path=file_path)
+        return serve_file(request, puzzle_file.file)
 
 
 class SolutionFile(RequiredSolutionAccessMixin, View):
     def get(self, request, puzzle_id, file_path):
-        puzzle = request.puzzle
-        puzzle_file = get_object_or_404(puzzle.solutionfile_set, url_path=file_path)
-
-        pathname = smart_str(os.path.join(settings.MEDIA_ROOT, puzzle_file.file.path))
-        try:
-#            return sendfile(request, puzzle_file.file.path)
-           with open(pathname, "rb") as f:
-               return HttpResponse(f.read(), content_type="application/pdf")
-        except IOError:
-           return HttpResponseNotFound('<h1>Page not found</h1>')
-
-
-
+        solution_file = get_object_or_404(request.puzzle.solutionfile_set, url_path=file_path)
+        return serve_file(request, solution_file.file)
 
 
 def current_hunt(request):
     """ A simple view that calls ``teams.hunt_views.hunt`` with the current hunt's number. """
-    return redirect(reverse('hunt', kwargs={'hunt_num' : Hunt.objects.get(is_current_hunt=True).hunt_number}))
+    return redirect(reverse('hunt', kwargs={'hunt_num' : get_current_hunt().hunt_number}))
+
 
+class HuntIndex(ConditionalGetMixin, View):
+    etag_inputs = ('hunt', 'progress')
 
-class HuntIndex(View):
     def get(self, request, hunt_num):
         """
         The main view to render hunt templates. Does various permission checks to determine the set
@@ -120,7 +101,8 @@ class HuntIndex(View):
             if(hunt.is_open):
                 return redirect(reverse('registration'))
 
-        episodes = request.hunt.get_formatted_episodes(request.user, request.team)
+        sidebar = Sidebar(hunt, user, team)
+        episodes = sidebar.episodes
         text = hunt.template
         # if template is empty, redirect to first unsolved puzzle
         if text == '':
@@ -139,15 +121,15 @@ class HuntIndex(View):
             if len(episodes)>0 and ep_solved == len(episodes):
               if len(episodes) == hunt.episode_set.count():
                 try:
-                  time = team.episodesolve_set.get(episode = episodes[-1]['ep']).time
+                  rank = team.episodesolve_set.get(episode = episodes[-1]['ep']).rank
                 except:
                   return HttpResponseNotFound('<h1>Inconsistent database stucture</h1>')
-                message = message + 'Congratulations! <br>You have finished the hunt at rank ' + str(EpisodeSolve.objects.filter(episode= episodes[-1]['ep'], time__lte= time).count())
+                message = message + 'Congratulations! <br>You have finished the hunt at rank ' + str(rank)
               else:
                 try:
                   ep_unlock = TeamEpisodeLink.objects.get(episode=episodes[-1]['ep'].unlocks, team=team)
                   ep_solve = EpisodeSolve.objects.get(episode=episodes[-1]['ep'], team=team)
-                  rank = str(EpisodeSolve.objects.filter(episode= episodes[-1]['ep'], time__lte= ep_solve.time).count())
+                  rank = str(ep_solve.rank)
                   message = message + 'Congratulations on finishing Episode ' + str(len(episodes)) + ' at rank ' + rank + '! <br> Next Episode will start at ' + (ep_unlock.episode.start_date - ep_unlock.headstart).astimezone(time_zone).strftime('%H:%M, %d/%m %Z')
                 except:
                   return HttpResponseNotFound('<h1>Last Episode finished without unlocking the next one</h1>')
@@ -159,7 +141,7 @@ class HuntIndex(View):
                   message = message + 'Welcome to the hunt! <br> The first Episode will start at ' + unlocks.first().start_date.astimezone(time_zone).strftime('%H:%M, %d/%m %Z')
                 
 
-        context = {'hunt': hunt, 'episodes': episodes, 'team': team, 'text': text, 'message': message}
+        context = {'hunt': hunt, 'episodes': episodes, 'sidebar': sidebar, 'team': team, 'text': text, 'message': message}
         return render(request, 'hunt/hunt.html', context)
 
 
@@ -169,27 +151,22 @@ def get_ratelimit_key(group, request):
 
 
 
-# simple way to encode a prepuzzle response string
-def encode(key, string):
-    encoded_chars = []
-    for i in range(len(string)):
-        key_c = key[i % len(key)]
-        encoded_c = chr(ord(string[i]) + ord(key_c) % 256)
-        encoded_chars.append(encoded_c)
-    return "".join(encoded_chars)
-
 @method_decorator(csrf_exempt, name='dispatch')
-class PuzzleView(RequiredPuzzleAccessMixin, View):
+class PuzzleView(RequiredPuzzleAccessMixin, ConditionalGetMixin, View):
     """
     A view to handle answer guesss via POST, handle response update requests via AJAX, and
     render the basic per-puzzle pages.
     """
+    etag_inputs = ('hunt', 'puzzle', 'progress')
 
-    def check_rate(self,request, puzzle_id):
-        request.puzzle = get_object_or_404(Puzzle, puzzle_id__iexact=puzzle_id)
-        request.hunt = request.puzzle.episode.hunt
-        request.team = request.hunt.team_from_user(request.user)
+    def get_etag_inputs(self, request):
+        # the page of finished hunts lists the guesses of the team
+        if request.hunt.is_finished and not request.hunt.is_demo:
+            return None
+        return self.etag_inputs
 
+    def check_rate(self,request, puzzle_id):
+        # request.puzzle, request.hunt and request.team are already set by the middlewares
         limited = False
         if(request.team is not None):
             request.ratelimit_key = request.user.username
@@ -206,30 +183,22 @@ class PuzzleView(RequiredPuzzleAccessMixin, View):
             logger.info("User %s rate-limited for puzzle %s" % (str(request.user), puzzle_id))
             return HttpResponseForbidden()
 
-        puzzle_files = {f.slug: reverse(
-            'puzzle_file',
-            kwargs={
-                'puzzle_id': puzzle_id,
-                'file_path': f.url_path,
-            }) for f in request.puzzle.puzzlefile_set.filter(slug__isnull=False)
-        }
-        text = Template(request.puzzle.template).safe_substitute(**puzzle_files)
-        episodes = request.hunt.get_formatted_episodes(request.user, request.team)
+        body = get_puzzle_body(request.puzzle)
+        sidebar = Sidebar(request.hunt, request.user, request.team)
 
-        try:
-          puzzle_solve = PuzzleSolve.objects.get(puzzle__puzzle_id=puzzle_id, team=request.team)
+        status = 'unsolved'
+        if request.team is not None and PuzzleSolve.objects.filter(puzzle=request.puzzle, team=request.team).exists():
           status = 'solved'
-        except PuzzleSolve.DoesNotExist:
-          status = 'unsolved'
 
 
         context = {
             'hunt': request.hunt,
-            'episodes': episodes,
+            'episodes': sidebar.episodes,
+            'sidebar': sidebar,
             'puzzle': request.puzzle,
-            'eureka': request.puzzle.eureka_set.filter(admin_only=False).count()>0,
+            'eureka': body.eureka,
             'team': request.team,
-            'text':text,
+            'text': body.text,
             'status': status
         }
 
@@ -237,30 +206,11 @@ class PuzzleView(RequiredPuzzleAccessMixin, View):
             return render(request, 'puzzle/puzzle.html', context)
         elif request.hunt.is_demo:
             # Prepuzzle
-            context['prepuzzle_values'] = {'answerHash': sha256(("SuperRandomInitialSalt" + request.puzzle.answer.replace(" ", "").lower()).encode('utf-8')).hexdigest(), 
-                                          'eurekaHashes': [sha256(("SuperRandomInitialSalt" + eur.replace(" ", "").lower()).encode('utf-8')).hexdigest() for eur in request.puzzle.eureka_set.filter(admin_only=False).values_list('answer', flat=True)],
-                                          'responseEncoded': encode(request.puzzle.answer.replace(" ", "").lower(), request.puzzle.demo_response),
-                                          }
+            context['prepuzzle_values'] = get_prepuzzle_values(request.puzzle)
             return render(request, 'puzzle/prepuzzle.html', context)
         else:
             # Postpuzzle
-            
-            
-            context['solutions'] = [ reverse(
-                'solution_file',
-                kwargs={
-                    'puzzle_id': puzzle_id,
-                    'file_path': f.url_path,
-                }) for f in request.puzzle.solutionfile_set.all()
-            ]
-            
-            
-            
-            context['postpuzzle_values'] = {'answer': encode( "secretkey", request.puzzle.answer), 
-                                            'answer_regex': encode("secretkey", request.puzzle.answer_regex), 
-#                                            'hints': [{'text': hi.text, 'time':hi.time} for hi in request.puzzle.hint_set.all()],
-                                            'eurekas': [{'regex': encode("secretkey", eur.regex), 'answer':encode("secretkey", eur.answer), 'feedback': encode("secretkey", eur.feedback)} for eur in request.puzzle.eureka_set.filter(admin_only=False).all()],
-                                          }
+            context['postpuzzle_values'], context['solutions'] = get_postpuzzle_values(request.puzzle)
             if request.team is not None:
               context['guesses'] = Guess.objects.filter(puzzle=request.puzzle, team=request.team).order_by('-guess_time').annotate(name=F('user__username' ))
             return render(request, 'puzzle/postpuzzle.html', context)
@@ -278,7 +228,7 @@ class PuzzleView(RequiredPuzzleAccessMixin, View):
         
         # Dealing with answer guesss, proper procedure is to create a guess
         # object and then rely on Guess.respond for automatic responses.
-        if(team is None or puzzle.episode.hunt.is_finished or team.hunt != puzzle.episode.hunt):
+        if(team is None or puzzle.episode.hunt.is_finished or team.hunt_id != puzzle.episode.hunt_id):
                 # If the hunt isn't public and you aren't signed in, please stop...
                 return JsonResponse({'error':'fail'})
 
@@ -287,16 +237,8 @@ class PuzzleView(RequiredPuzzleAccessMixin, View):
         if given_answer == '':
             return JsonResponse({'error': 'no answer given'}, status=400)
 
-        guess = Guess(
-            guess_text=given_answer,
-            team=team,
-            user=user,
-            puzzle=puzzle,
-            guess_time=timezone.now()
-        )
-        guess.save()
-        response = guess.respond()
-        if not guess.is_correct:
+        guess, response = Guess.objects.submit(team, user, puzzle, given_answer)
+        if response['status'] != 'correct':
             now = timezone.now()
             minimum_time = timedelta(seconds=5)
 
@@ -311,7 +253,7 @@ class PuzzleView(RequiredPuzzleAccessMixin, View):
 @login_required
 def unlockables(request):
     """ A view to render the unlockables page for hunt participants. """
-    team = Hunt.objects.get(is_current_hunt=True).team_from_user(request.user)
+    team = request.team
     if(team is None):
         return render(request, 'access_error.html', {'reason': "team"})
     unlockables = Unlockable.objects.filter(puzzle__in=team.puz_solved.all())
@@ -323,36 +265,25 @@ def int_to_rank(n):
   return "%d%s" % (n,"tsnrhtdd"[(n//10%10!=1)*(n%10<4)*n%10::4])
 #TODO: clean time format + clear useless info out of all_teams before sending
 @login_required
+@etag_versions('solves', 'progress', 'minute')
 def leaderboard(request):
-    curr_hunt = get_object_or_404(Hunt, is_current_hunt=True)
-    teams = curr_hunt.team_set.all()
-    all_teams = teams.annotate(solves=Count('puz_solved')).filter(solves__gt=0)
-    all_teams = all_teams.annotate(last_time=Max('puzzlesolve__guess__guess_time'))
-    all_teams = all_teams.order_by(F('solves').desc(nulls_last=True),
-                                   F('last_time').asc(nulls_last=True))
-    
-    if all_teams.count() > 10 and all_teams[9].ep_solved.count() == curr_hunt.episode_set.count():
-      all_teams = all_teams.filter(solves=all_teams[0].solves)
-    else:
-      all_teams = all_teams[:10]
-
-    team = Hunt.objects.get(is_current_hunt=True).team_from_user(request.user)
-    if(team is None):
-      solves_data = []
-    else:
-      solves = team.puzzlesolve_set.annotate(time=F('guess__guess_time'), puzId = F('puzzle__puzzle_id')).order_by('time')
-      unlocks = team.teampuzzlelink_set.annotate(puzId = F('puzzle__puzzle_id'), name = F('puzzle__puzzle_name')).order_by('time')
-
-      solves_data = []
-      for unlock in unlocks.all():
-        try:
-          solve = solves.get(puzId=unlock.puzId)
-          rank = int_to_rank(PuzzleSolve.objects.filter(puzzle= unlock.puzzle, guess__guess_time__lt= solve.time).count()+1)
-          solves_data.append({'name' : unlock.name, 'sol_time': solve.time, 'duration':  format_duration(solve.duration), 'rank': rank})
-        except ObjectDoesNotExist:
-          start = unlock.puzzle.starting_time_for_team(unlock.team)
-          if (timezone.now() > start):
-            solves_data.append({'name' : unlock.name, 'sol_time': '' , 'duration':  format_duration(timezone.now()-start)})
-
-    context = {'team_data': all_teams, 'solve_data': solves_data}
-    return render(request, 'hunt/leaderboard.html', context)
+    try:
+        curr_hunt = get_current_hunt()
+    except Hunt.DoesNotExist:
+        raise Http404
+    team = request.team
+    solves_data = []
+    if(team is not None):
+      now = timezone.now()
+      for row in get_team_timeline(team):
+        if row.solve_time is not None:
+          solves_data.append({'name' : row.name, 'sol_time': row.solve_time, 'duration':  format_duration(row.duration), 'rank': int_to_rank(row.rank)})
+        elif (now > row.start):
+          solves_data.append({'name' : row.name, 'sol_time': '' , 'duration':  format_duration(now-row.start)})
+
+    html, current = render_leaderboard(curr_hunt)
+    context = {'leaderboard': html, 'solve_data': solves_data}
+    response = render(request, 'hunt/leaderboard.html', context)
+    # the previous table is served while the new one is built: not under the ETag of the new standings
+    response.stale = not current
+    return response
@@ -11,11 +11,20 @@
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.messages import get_messages
 from django.shortcuts import redirect, reverse
 from django.conf import settings
 from django.urls import reverse_lazy
 from django.http import JsonResponse, HttpResponseNotFound
+from django.utils.cache import get_conditional_response
+from functools import wraps
+from hashlib import sha1
+from hunts.cache import get_versions
 from hunts.models import APIToken
+from hunts.progress import can_see_puzzle, visible_episode_pks
+from hunts.resolver import get_team_pk
+
+import time
 
 class RequiredPuzzleAccessMixin():
     def dispatch(self, request, *args, **kwargs):
@@ -29,8 +38,7 @@ class RequiredPuzzleAccessMixin():
             elif (not request.user.is_staff):
                 if request.team is None:
                     return redirect(reverse('registration'))
-                elif request.puzzle.episode not in request.hunt.get_episodes(request.user,request.team) \
-                        or request.puzzle not in request.team.puz_unlocked.all():
+                elif not can_see_puzzle(get_team_pk(request.user, request.hunt.pk), request.hunt.pk, request.puzzle):
                     return redirect(reverse('hunt', kwargs={'hunt_num' : request.hunt.hunt_number }))
                     
         
@@ -87,3 +95,78 @@ class APITokenRequiredMixin():
                 'message': 'Invalid Bearer token',
             }, status=401)
         return super().dispatch(request, *args, **kwargs)
+
+
+# Versions that a page can depend on, used to build its ETag (see etag_versions)
+def _versioned_objects(request, inputs):
+    hunt = request.hunt
+    objects = []
+    if 'hunt' in inputs:
+        objects += [('hunt', hunt.pk), ('hunts', 0)]
+    if 'puzzle' in inputs:
+        objects.append(('puzzle', request.puzzle.pk))
+    if 'progress' in inputs:
+        team_pk = get_team_pk(request.user, hunt.pk)
+        if team_pk is not None:
+            objects += [('team-progress', team_pk), ('hunt-progress', hunt.pk)]
+    if 'solves' in inputs:
+        objects += [('hunt-solves', hunt.pk), ('hunt-progress', hunt.pk)]
+    return objects
+
+
+def compute_etag(request, inputs):
+    """ A strong ETag for the page as seen by this user, made from the versions listed in inputs:
+    hunt (content of the hunt), puzzle (content of the puzzle), progress (progress of the team of
+    the user), solves (solves of all the teams of the hunt) and minute (for pages showing
+    durations). The page always depends on the user and on the CSRF token of its forms. """
+    hunt = request.hunt
+    parts = [request.user.pk, request.META.get('CSRF_COOKIE', '')]
+    parts += get_versions(_versioned_objects(request, inputs))
+    if 'hunt' in inputs:
+        # the dates of the hunt change what is shown without any write
+        parts += [hunt.is_locked, hunt.is_open, hunt.is_public, hunt.is_finished]
+    if 'progress' in inputs:
+        team_pk = get_team_pk(request.user, hunt.pk)
+        if team_pk is not None:
+            # nor do episodes reaching their start date minus headstart
+            parts.append(len(visible_episode_pks(team_pk, hunt.pk)))
+    if 'minute' in inputs:
+        parts.append(int(time.time() // 60))
+    return '"%s"' % sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def etag_versions(*inputs):
+    """ Decorator answering GET requests with 304 Not Modified, before the view runs, when the
+    versions listed in inputs (see compute_etag) did not change since the client got the page.
+    Views serving data older than these versions set response.stale, and no ETag is sent. """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if (request.method not in ('GET', 'HEAD') or request.hunt is None or
+                    len(get_messages(request)) > 0):
+                return view(request, *args, **kwargs)
+            etag = compute_etag(request, inputs)
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if (response.status_code == 200 and not response.has_header('ETag') and
+                        not getattr(response, 'stale', False)):
+                    response['ETag'] = etag
+            return response
+        return wrapper
+    return decorator
+
+
+class ConditionalGetMixin():
+    """ Applies etag_versions to the view, after the access checks of the mixins listed before
+    this one. get_etag_inputs can return None for pages that should not be conditional. """
+    etag_inputs = ()
+
+    def get_etag_inputs(self, request):
+        return self.etag_inputs
+
+    def dispatch(self, request, *args, **kwargs):
+        inputs = self.get_etag_inputs(request)
+        if inputs is None:
+            return super().dispatch(request, *args, **kwargs)
+        return etag_versions(*inputs)(super().dispatch)(request, *args, **kwargs)
@@ -10,14 +10,11 @@
 #
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
-from datetime import datetime
-from dateutil import tz
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import admin
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.mail import EmailMessage
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.http import HttpResponse, HttpResponseNotFound, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.template.loader import render_to_string
 from django.utils import timezone
@@ -30,8 +27,10 @@ import json
 from copy import deepcopy
 # from silk.profiling.profiler import silk_profile
 
-from hunts.models import Guess, Hunt, Puzzle, Episode
-from teams.models import Team, TeamPuzzleLink, PuzzleSolve, Person
+from hunts.models import Guess, Hunt, Puzzle, Episode, get_current_hunt, get_hunt_by_number
+from hunts.graph import get_hunt_graph
+from hunts.tasks import release_initial_puzzles_task, reset_hunt_task, build_hunt_stats, get_task_progress
+from teams.models import Team, TeamPuzzleLink, Person, HuntEvent, encode_queue_cursor
 from teams.forms import GuessForm, UnlockForm, EmailForm, LookupForm
 
 DT_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
@@ -39,7 +38,7 @@ DT_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
 @staff_member_required
 def index(request):
-    context = {'hunt': Hunt.objects.get(is_current_hunt=True)}
+    context = {'hunt': get_current_hunt()}
     return render(request, 'staff/index.html', context)
 
 
@@ -47,8 +46,13 @@ def index(request):
 @staff_member_required
 def queue(request):
     """
-    A view to handle queue response updates via POST, handle guess update requests via AJAX,
-    and render the queue page. Guesss are pre-rendered for standard and AJAX requests.
+    A view to handle queue response updates via POST, and render the queue page. New guesses are
+    pushed to the page by teams.consumers.StaffQueueWebsocket, AJAX requests with the cursor of
+    the last guess seen are the fallback when the websocket is unavailable. Both send the guesses
+    as JSON rows rendered by the browser.
+    The page goes through the guesses by pk with the before/after cursors of GuessManager.queue_page,
+    ?format=json returns the same page as JSON rows: asked with after= the newest cursor it returned,
+    it gives the guesses made since.
     """
 
     if request.method == 'POST':
@@ -56,65 +60,62 @@ def queue(request):
         if not form.is_valid():
             return HttpResponse(status=400)
         response = form.cleaned_data['response']
-        s = Guess.objects.get(pk=form.cleaned_data['sub_id'])
+        s = Guess.objects.select_related('team', 'puzzle').get(pk=form.cleaned_data['sub_id'])
         s.update_response(response)
-        guesss = [s]
+        return JsonResponse({'guesses': [s.serialize_for_queue()]})
 
-    elif request.is_ajax():
-        last_date = datetime.strptime(request.GET.get("last_date"), DT_FORMAT)
-        last_date = last_date.replace(tzinfo=tz.gettz('UTC'))
-        guesss = Guess.objects.filter(modified_date__gt=last_date)
-        guesss = guesss.exclude(team__location="DUMMY")
-        team_id = request.GET.get("team_id")
-        puzzle_id = request.GET.get("puzzle_id")
-        if(team_id and team_id != "None"):
-            guesss = guesss.filter(team__pk=team_id)
-        if(puzzle_id and puzzle_id != "None"):
-            guesss = guesss.filter(puzzle__pk=puzzle_id)
+    hunt = get_current_hunt()
+    team_id = request.GET.get("team_id")
+    puzzle_id = request.GET.get("puzzle_id")
+    team_id = int(team_id) if team_id and team_id.isdigit() else None
+    puzzle_id = int(puzzle_id) if puzzle_id and puzzle_id.isdigit() else None
 
-    else:
-        page_num = request.GET.get("page_num")
-        team_id = request.GET.get("team_id")
-        puzzle_id = request.GET.get("puzzle_id")
-        hunt = Hunt.objects.get(is_current_hunt=True)
-        guesss = Guess.objects.filter(puzzle__episode__hunt=hunt).exclude(team__location="DUMMY")
-        arg_string = ""
-        if(team_id):
-            team_id = int(team_id)
+    if request.is_ajax():
+        cursor = request.GET.get("cursor", "")
+        try:
+            guesss = Guess.objects.modified_after(cursor)
+        except ValueError:
+            return HttpResponse(status=400)
+        guesss = guesss.filter(hunt=hunt).exclude(team__location="DUMMY")
+        if team_id is not None:
             guesss = guesss.filter(team__pk=team_id)
-            arg_string = arg_string + ("&team_id=%s" % team_id)
-        if(puzzle_id):
-            puzzle_id = int(puzzle_id)
+        if puzzle_id is not None:
             guesss = guesss.filter(puzzle__pk=puzzle_id)
-            arg_string = arg_string + ("&puzzle_id=%s" % puzzle_id)
-        guesss = guesss.select_related('team', 'puzzle').order_by('-pk')
-        pages = Paginator(guesss, 30)
-        try:
-            guesss = pages.page(page_num)
-        except PageNotAnInteger:
-            guesss = pages.page(1)
-        except EmptyPage:
-            guesss = pages.page(pages.num_pages)
-        puzzle_list = [puzzle for episode in hunt.episode_set.all() for puzzle in episode.puzzle_set.all()]
+        guesss = [guess.serialize_for_queue() for guess in guesss.select_related('team', 'puzzle')[:100]]
+        # the cursor only moves up to the last guess sent, the next poll gets the rest
+        if len(guesss) > 0:
+            cursor = guesss[-1]['cursor']
+        return JsonResponse({'guesses': guesss, 'cursor': cursor})
+
+    # taken before the rows of the page are loaded: the first poll may send some of them again
+    cursor = Guess(modified_date=timezone.now(), pk=0).queue_cursor
+    try:
+        guesss, older, newer = Guess.objects.queue_page(hunt, team_id, puzzle_id, request.GET.get("before"),
+                                                        request.GET.get("after"))
+    except ValueError:
+        return HttpResponse(status=400)
+    arg_string = ""
+    if team_id is not None:
+        arg_string = arg_string + ("&team_id=%s" % team_id)
+    if puzzle_id is not None:
+        arg_string = arg_string + ("&puzzle_id=%s" % puzzle_id)
+
+    if request.GET.get("format") == "json":
+        latest = request.GET.get("after")
+        if len(guesss) > 0:
+            latest = encode_queue_cursor(guesss[0].pk)
+        return JsonResponse({'guesses': [guess.serialize_for_queue() for guess in guesss],
+                             'older': older, 'newer': newer, 'latest': latest})
+
+    puzzle_list = [puzzle for episode in hunt.episode_set.all() for puzzle in episode.puzzle_set.all()]
 
     form = GuessForm()
-    try:
-        last_date = Guess.objects.latest('modified_date').modified_date.strftime(DT_FORMAT)
-    except Guess.DoesNotExist:
-        last_date = timezone.now().strftime(DT_FORMAT)
-    guess_list = [render_to_string('staff/queue_row.html', {'guess': guess},
-                                        request=request)
-                       for guess in guesss]
-                       
-
-    if request.is_ajax() or request.method == 'POST':
-        context = {'guess_list': guess_list, 'last_date': last_date}
-        return HttpResponse(json.dumps(context))
-    else:
-        context = {'form': form, 'page_info': guesss, 'arg_string': arg_string,
-                   'guess_list': guess_list, 'last_date': last_date, 'hunt': hunt,
-                   'puzzle_id': puzzle_id, 'team_id': team_id, 'puzzle_list': puzzle_list}
-        return render(request, 'staff/queue.html', context)
+    guess_list = [render_to_string('staff/queue_row.html', {'guess': guess}, request=request)
+                  for guess in guesss]
+    context = {'form': form, 'older': older, 'newer': newer, 'arg_string': arg_string,
+               'guess_list': guess_list, 'cursor': cursor, 'hunt': hunt,
+               'puzzle_id': puzzle_id, 'team_id': team_id, 'puzzle_list': puzzle_list}
+    return render(request, 'staff/queue.html', context)
 
 
 @staff_member_required
@@ -123,6 +124,8 @@ def progress(request, ep_pk):
     A view to handle puzzle unlocks via POST, handle unlock/solve update requests via AJAX,
     and render the progress page. Rendering the progress page is extremely data intensive and so
     the view involves a good amount of pre-fetching.
+    Updates are the HuntEvents of the episode after the cursor of the page, pushed by
+    teams.consumers.StaffProgressWebsocket or polled with AJAX when the websocket is unavailable.
     """
     
     episode = get_object_or_404(Episode, pk=ep_pk)
@@ -150,52 +153,23 @@ def progress(request, ep_pk):
         return HttpResponse(status=400)
 
     elif request.is_ajax():
-        update_info = []
-        if not ("last_solve_pk" in request.GET and
-                "last_unlock_pk" in request.GET and
-                "last_guess_pk" in request.GET):
+        cursor = request.GET.get("cursor", "")
+        if not cursor.isdigit():
             return HttpResponse(status=404)
-        results = []
-
-        last_solve_pk = request.GET.get("last_solve_pk")
-        solves = PuzzleSolve.objects.filter(pk__gt=last_solve_pk, episode=episode)
-        for solve in solves:
-            results.append(solve.serialize_for_ajax())
-
-        last_unlock_pk = request.GET.get("last_unlock_pk")
-        unlocks = TeamPuzzleLink.objects.filter(pk__gt=last_unlock_pk)
-        for unlock in unlocks:
-            results.append(unlock.serialize_for_ajax())
-
-        last_guess_pk = request.GET.get("last_guess_pk")
-        guesss = Guess.objects.filter(pk__gt=last_guess_pk)
-        for guess in guesss:
-            if(not guess.team.puz_solved.filter(pk=guess.puzzle.pk).exists()):
-                results.append(guess.serialize_for_ajax())
-
-        if(len(results) > 0):
-            try:
-                last_solve_pk = PuzzleSolve.objects.latest('id').id
-            except PuzzleSolve.DoesNotExist:
-                last_solve_pk = 0
-            try:
-                last_unlock_pk = TeamPuzzleLink.objects.latest('id').id
-            except TeamPuzzleLink.DoesNotExist:
-                last_unlock_pk = 0
-            try:
-                last_guess_pk = Guess.objects.latest('id').id
-            except Guess.DoesNotExist:
-                last_guess_pk = 0
-            update_info = [last_solve_pk, last_unlock_pk, last_guess_pk]
-        response = json.dumps({'messages': results, 'update_info': update_info})
-        return HttpResponse(response)
+        events = HuntEvent.objects.filter(episode=episode, pk__gt=cursor).order_by('pk')[:500]
+        results = [event.serialize_for_ajax() for event in events]
+        if len(results) > 0:
+            cursor = results[-1]['id']
+        return JsonResponse({'messages': results, 'cursor': int(cursor)})
 
     else:
-        curr_hunt = Hunt.objects.get(is_current_hunt=True)
+        curr_hunt = get_current_hunt()
         teams = curr_hunt.team_set.all().order_by('team_name')
 #        puzzles = curr_hunt.puzzle_set.all().order_by('puzzle_number')
         
         
+        # taken before the grid is built: the first update may send some of its events again
+        cursor = HuntEvent.objects.filter(episode=episode).order_by('-pk').values_list('pk', flat=True).first() or 0
         puzzles = [p for p in episode.puzzle_set.order_by('puzzle_number')]
 #        puzzles = [p  for episode in curr_hunt.episode_set.order_by('ep_number').all() for p in episode.puzzle_set.order_by('puzzle_number')]
         # An array of solves, organized by team then by puzzle
@@ -230,21 +204,8 @@ def progress(request, ep_pk):
             sol_list.append({'team': {'name': team.team_name, 'pk': team.pk},
                              'puzzles': puzzle_list})
 
-        try:
-            last_solve_pk = PuzzleSolve.objects.latest('id').id
-        except PuzzleSolve.DoesNotExist:
-            last_solve_pk = 0
-        try:
-            last_unlock_pk = TeamPuzzleLink.objects.latest('id').id
-        except TeamPuzzleLink.DoesNotExist:
-            last_unlock_pk = 0
-        try:
-            last_guess_pk = Guess.objects.latest('id').id
-        except Guess.DoesNotExist:
-            last_guess_pk = 0
         context = {'puzzle_list': puzzles, 'team_list': teams, 'sol_list': sol_list,
-                   'last_unlock_pk': last_unlock_pk, 'last_solve_pk': last_solve_pk,
-                   'last_guess_pk': last_guess_pk, 'hunt': curr_hunt}
+                   'cursor': cursor, 'episode': episode, 'hunt': curr_hunt}
         return render(request, 'staff/progress.html', context)
 
 
@@ -272,10 +233,11 @@ def overview(request):
     # not relevant if puzzles unlocked before are unsolved
 
     # TODO no idea about the performance of this code, in terms of prefecthing database accesses
-    curr_hunt = Hunt.objects.get(is_current_hunt=True)
+    curr_hunt = get_current_hunt()
     teams = curr_hunt.team_set.all().order_by('team_name')
 
     sol_list = []
+    wrong_answers = {}
     for team in teams:
       puz_solved = team.puz_solved
       nb_solve = puz_solved.count()
@@ -286,7 +248,8 @@ def overview(request):
                        'guesses': {'nb' : '-' , 'last': '...', 'time': '-' },
                        'eurekas': {'nb' : 0 , 'last': '...', 'time': '-', 'total': 1},
                        'hints': {'nb' : 0 , 'last_time': '-', 'next_time': '-', 'total': 1},
-                       'admin_eurekas' : []
+                       'admin_eurekas' : [],
+                       'wrong_answers' : [],
                        })
         continue
       puzzle = puzzle_unlock.puzzle
@@ -326,6 +289,8 @@ def overview(request):
         last_hint_time = -1
       if next_hint_time == 360:
         next_hint_time = -1
+      if puzzle.pk not in wrong_answers:
+        wrong_answers[puzzle.pk] = Guess.objects.common_wrong_answers(puzzle, limit=3)
 
       sol_list.append({'team': team.team_name,
                        'puzzle': {'name': puzzle_name, 'time': time_stuck, 'index': nb_solve+1, 'color': color},
@@ -333,6 +298,7 @@ def overview(request):
                        'eurekas': {'nb' : team_eurekas.count() , 'last': text_lasteureka, 'time': time_lasteureka, 'total': total_eureka},
                        'hints': {'nb' : team_hints , 'last_time': last_hint_time, 'next_time': next_hint_time, 'total': total_hints},
                        'admin_eurekas' : list_admin_eurekas,
+                       'wrong_answers' : wrong_answers[puzzle.pk],
                        })
 
     context = {'data': sol_list, 'hunt':curr_hunt}
@@ -359,7 +325,7 @@ def hunt_management(request):
 
     puzzles = Puzzle.objects.all()
 
-    context = {'hunts': hunts, 'puzzles': puzzles , 'hunt':curr_hunt}
+    context = {'hunts': hunts, 'puzzles': puzzles , 'hunt': get_current_hunt()}
     return render(request, 'staff/hunt_management.html', context)
 
 
@@ -367,7 +333,7 @@ def hunt_management(request):
 def hunt_info(request):
     """ A view to render the hunt info page, which contains room and allergy information """
 
-    curr_hunt = Hunt.objects.get(is_current_hunt=True)
+    curr_hunt = get_current_hunt()
     if request.method == 'POST':
         if "json_data" in request.POST:
             team_data = json.loads(request.POST.get("json_data"))
@@ -384,7 +350,7 @@ def hunt_info(request):
         teams = curr_hunt.team_set
         people = Person.objects.filter(teams__hunt=curr_hunt)
         try:
-            old_hunt = Hunt.objects.get(hunt_number=curr_hunt.hunt_number - 1)
+            old_hunt = get_hunt_by_number(curr_hunt.hunt_number - 1)
             new_people = people.filter(user__date_joined__gt=old_hunt.end_date)
         except Hunt.DoesNotExist:
             new_people = people
@@ -412,31 +378,37 @@ def control(request):
     This view is not responsible for rendering any normal pages.
     """
 
-    curr_hunt = Hunt.objects.get(is_current_hunt=True)
+    curr_hunt = get_current_hunt()
     if(request.method == 'GET' and "action" in request.GET):
         if(request.GET['action'] == "check_task"):
             task_result = result(request.GET['task_id'])
             if(task_result is None):
-                response = {"have_result": False, "result_text": ""}
+                response = {"have_result": False, "result_text": get_task_progress(request.GET['task_id'])}
             else:
                 response = {"have_result": True, "result_text": task_result}
             return HttpResponse(json.dumps(response))
 
     if(request.method == 'POST' and "action" in request.POST):
         if(request.POST["action"] == "initial"):
-            if(curr_hunt.is_open):
-                teams = curr_hunt.team_set.all().order_by('team_name')
-            else:
-                teams = curr_hunt.team_set.filter(playtester=True).order_by('team_name')
-            for team in teams:
-                team.unlock_puzzles_and_episodes()
-            messages.success(request, "Initial puzzles released")
+            task = release_initial_puzzles_task(curr_hunt.pk, not curr_hunt.is_open)
+            if(request.is_ajax()):
+                return HttpResponse(task.id)
+            messages.success(request, "Initial puzzles release started")
             return redirect('hunt_management')
         if(request.POST["action"] == "reset"):
-            teams = curr_hunt.team_set.all().order_by('team_name')
-            for team in teams:
-                team.reset()
-            messages.success(request, "Progress reset")
+            task = reset_hunt_task(curr_hunt.pk,
+                                   dry_run="dry_run" in request.POST,
+                                   release="release" in request.POST,
+                                   playtesters_only=not curr_hunt.is_open)
+            if(request.is_ajax()):
+                return HttpResponse(task.id)
+            messages.success(request, "Progress reset started")
+            return redirect('hunt_management')
+        if(request.POST["action"] == "build_stats"):
+            task = build_hunt_stats(curr_hunt.pk)
+            if(request.is_ajax()):
+                return HttpResponse(task.id)
+            messages.success(request, "Stats build started")
             return redirect('hunt_management')
 
         if(request.POST["action"] == "new_current_hunt"):
@@ -458,7 +430,7 @@ def lookup(request):
     """
     person = None
     team = None
-    hunt = Hunt.objects.get(is_current_hunt=True)
+    hunt = get_current_hunt()
     if request.method == 'POST':
         lookup_form = LookupForm(request.POST)
         if lookup_form.is_valid():
@@ -472,11 +444,7 @@ def lookup(request):
             team = Team.objects.get(pk=request.GET.get("team_pk"))
             team.latest_guesss = team.guess_set.values_list('puzzle')
             team.latest_guesss = team.latest_guesss.annotate(Max('guess_time'))
-            all_teams = team.hunt.team_set.annotate(solves=Count('puz_solved'))
-            all_teams = all_teams.annotate(last_time=Max('puz_solved__guess__guess_time'))
-            ids = all_teams.order_by(F('solves').desc(nulls_last=True),
-                                     F('last_time').asc(nulls_last=True))
-            team.rank = list(ids.values_list('pk', flat=True)).index(team.pk) + 1
+            team.rank = team.standing.rank
             
         lookup_form = LookupForm()
         results = {}
@@ -489,11 +457,25 @@ def lookup(request):
 
 @staff_member_required
 def puzzle_dag(request):
-    """ A view to render the DAG of puzzles unlocking relations """
+    """ A view to render the DAG of puzzles unlocking relations, the graph itself is fetched
+    from puzzle_dag_json """
 
-    puzzles = Puzzle.objects.all()
-    episodes = Episode.objects.all()
-    hunts = Hunt.objects.all()
-
-    context = {'puzzles': puzzles, 'episodes':episodes, 'hunts': hunts, 'hunt': Hunt.objects.get(is_current_hunt=True)}
+    context = {'hunt': get_current_hunt()}
     return render(request, 'staff/puzzle_dag.html', context)
+
+
+@staff_member_required
+def puzzle_dag_json(request):
+    """ The unlocking relations of all hunts as cytoscape elements, read from the cached hunt graphs """
+
+    nodes = []
+    edges = []
+    for hunt in Hunt.objects.all():
+        nodes.append({'id': 'hu%d' % hunt.pk, 'name': str(hunt),
+                      'href': '/admin/hunts/hunt/%d/change/' % hunt.pk})
+        graph = get_hunt_graph(hunt.pk).serialize_for_ajax()
+        nodes.extend(graph['nodes'])
+        edges.extend(graph['edges'])
+
+    return JsonResponse({'nodes': [{'data': node} for node in nodes],
+                         'edges': [{'data': edge} for edge in edges]})
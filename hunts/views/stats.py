@@ -10,41 +10,38 @@
 #
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
-from datetime import datetime
 from dateutil import tz
 from datetime import timedelta
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import admin
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.cache import cache
 from django.core.mail import EmailMessage
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.http import HttpResponse, HttpResponseNotFound, HttpResponseRedirect
 from django.shortcuts import render, redirect
 from django.template.loader import render_to_string
-from django.utils import timezone
+from django.utils.cache import patch_vary_headers
 from django.contrib import messages
-from django.db.models import F, Max, Count, Min, Subquery, OuterRef, Value, ExpressionWrapper, fields, Avg, Sum
-from django.db.models.fields import PositiveIntegerField
+from django.db.models import Count, ExpressionWrapper, fields, Sum
 from django.db.models.functions import Lower
 from huey.contrib.djhuey import result
 from django.contrib.auth.decorators import login_required
-from django.core.serializers.json import DjangoJSONEncoder
 from django.utils.dateparse import parse_datetime
 import json
 from copy import deepcopy
-from collections import Counter
 # from silk.profiling.profiler import silk_profile
 
-import re
-import math
-import os.path
-from hunts.models import Guess, Hunt, Puzzle
-from teams.models import Team, TeamPuzzleLink, PuzzleSolve, Person
+import gzip
+from hunts.models import Guess, Hunt, get_current_hunt, get_last_finished_hunt
+from hunts.graph import get_hunt_graph
+from hunts.artifacts import get_artifact_store
+from hunts.stats import TEAMS, TEAM, PUZZLES, PUZZLE, CHARTS, CHARTS_DATA
+from teams.models import PuzzleSolve, Person
 from teams.forms import GuessForm, UnlockForm, EmailForm, LookupForm
 
 DT_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
-
-UPDATE_STATS = False
+# the ?teams=N of the charts data is rounded up to one of these, larger values give all the teams
+CHARTS_TEAM_LIMITS = (10, 25, 50, 100, 250)
 
 
 def add_apps_to_context(context, request):
@@ -53,37 +50,17 @@ def add_apps_to_context(context, request):
 
 def get_last_hunt_or_none(request):
     if (request.user.is_staff):
-        hunt = Hunt.objects.filter(is_current_hunt=True)
-        nb_puzzle = len([0 for episode in hunt.first().episode_set.all() for puzzle in episode.puzzle_set.all()])
-        return hunt.annotate(puz=Value(nb_puzzle, output_field=PositiveIntegerField())).first()
-
-    last_hunts = Hunt.objects.filter(end_date__lt=timezone.now()).order_by('-end_date')
-    if last_hunts.count() == 0:
-      return None
-    nb_puzzle = len([0 for episode in last_hunts.first().episode_set.all() for puzzle in episode.puzzle_set.all()])
-
-    hunt = last_hunts[:1].annotate(puz=Value(nb_puzzle, output_field=PositiveIntegerField())).first()
+        try:
+            hunt = get_current_hunt()
+        except Hunt.DoesNotExist:
+            return None
+    else:
+        hunt = get_last_finished_hunt()
+        if hunt is None:
+            return None
+    hunt.puz = len(get_hunt_graph(hunt.pk).puzzle_pks)
     return hunt
 
-def format_duration(arg):
-    try:
-      seconds = int(arg.total_seconds())
-      if seconds < 60:
-        return str(seconds) + "s"
-      elif seconds < 3600:
-        return str(int(seconds/60)) + "m" + str(seconds % 60) + "s"
-      elif seconds < 3600*24:
-        return str(int(seconds/3600)) + "h" + str(int((seconds % 3600)/60)) + "m"
-      else:
-        return str(int(seconds/3600/24)) + "d" + str(int((seconds % (3600*24))/3600)) + "h"    
-#      return str(timedelta(seconds=int(arg.total_seconds())))
-    except AttributeError:
-      return ''
-
-def int_to_rank(n):
-  return "%d%s" % (n,"tsnrhtdd"[(n//10%10!=1)*(n%10<4)*n%10::4])
-
-
 
 @login_required
 def stats(request):
@@ -95,7 +72,7 @@ def stats(request):
 
     teams = hunt.team_set.count()
     people = hunt.team_set.annotate(team_size=Count('person')).aggregate(res=Sum('team_size'))['res']
-    guesses = Guess.objects.filter(puzzle__episode__hunt=hunt).count()
+    guesses = Guess.objects.filter(hunt=hunt).count()
     solved = PuzzleSolve.objects.filter(puzzle__episode__hunt=hunt).count()
 
 
@@ -103,119 +80,35 @@ def stats(request):
     return render(request, 'stats/stats.html', context)
 
 
+def _parse_times(rows, *keys):
+    """ Artifacts store times as ISO strings """
+    for row in rows:
+      for key in keys:
+        row[key] = parse_datetime(row[key]) if row[key] else None
+
+
 @login_required
 def teams(request):
     ''' General view of all teams:  rank, number of solved puzzles, finish time (if finished) '''
     hunt = get_last_hunt_or_none(request)
-    if hunt == None:
-      context = {'hunt': None}
-      return render(request, 'stats/teams.html', context)
-
-
-
-    
-    # load json if exists & non staff
-    template_filename =  'stats/static/teams.json'
-    filename =  'hunts/templates/' + template_filename
-
-    if ((not request.user.is_staff or not UPDATE_STATS) and os.path.exists(filename)):
-      with open(filename) as json_file:
-        context = json.load(json_file)
-        for d in context['team_data']:
-          d.update({'last_time': parse_datetime(d['last_time']) if d['last_time'] is not None else None})
-          
-    else:
-      teams = hunt.team_set
-      teams = teams.annotate(solves=Count('puz_solved'))
-      teams = teams.order_by(F('solves').desc(nulls_last=True),
-                                     F('last_time').asc(nulls_last=True))
-      teams = teams.annotate(last_time=Max('puzzlesolve__guess__guess_time'))
-      
-      team_data = []   
-      for team in teams.all():
-        hints = 0
-        for solve in team.puzzlesolve_set.all():
-            duration = solve.duration
-            hints += sum([hint.delay_for_team(team) < duration for hint in solve.puzzle.hint_set.all()])
-        guesses = Guess.objects.filter(puzzle__episode__hunt=hunt, team__team_name=team.team_name).count()
-        team_data.append({'team_name': team.team_name, 'solves': team.solves, 'last_time':team.last_time, 'guesses':guesses, 'hints':hints, 'pk':team.pk, 'size': team.size})
-
-      context = {'team_data': team_data, 'hunt': {'hunt_name':hunt.hunt_name, 'display_start_date': hunt.display_start_date, 'puz' : hunt.puz}}
-      
-      
-      # write json
-      with open(filename, 'w') as outfile:
-        json.dump(context, outfile, cls=DjangoJSONEncoder)
-      
+    context = None if hunt is None else get_artifact_store().get(hunt.pk, TEAMS)
+    if context is None:
+      return render(request, 'stats/teams.html', {'hunt': None})
+    _parse_times(context['team_data'], 'last_time')
     return render(request, 'stats/teams.html', context)
 
 @login_required
 def team(request):
     ''' Summary of a single team performance, asked by /?team=ID: time / duration per puzzle, rank on each, number of guesses, number of hints needed
       global param: #teammates'''
-      
-      
-      
     hunt = get_last_hunt_or_none(request)
-    context = {'hunt': None}
-    if hunt == None:
-      return render(request, 'stats/team.html', context)
-      
-    try:
-      team = Team.objects.get(pk=request.GET.get("team"))
-    except ObjectDoesNotExist:
-      return render(request, 'stats/team.html', context)
-
-    if team.hunt != hunt:
-      return render(request, 'stats/team.html', context)
-
-    if(team is None):
-      return render(request, 'stats/team.html', context)
-
-    
-    # load json if exists & non staff
-    template_filename =  'stats/static/team-' + str(request.GET.get("team")) + '.json'
-    filename =  'hunts/templates/' + template_filename
-
-    if ((not request.user.is_staff or not UPDATE_STATS) and os.path.exists(filename)):
-      with open(filename) as json_file:
-        context = json.load(json_file)
-        for d in context['solve_data']:
-          d.update({'sol_time': parse_datetime(d['sol_time'])})
-        
-    else:
-      solves = team.puzzlesolve_set.annotate(time=F('guess__guess_time'), puzId = F('puzzle__puzzle_id')).order_by('time')
-      unlocks = team.teampuzzlelink_set.annotate(puzId = F('puzzle__puzzle_id'), name = F('puzzle__puzzle_name')).order_by('time')
-
-      solves_data = []
-      for unlock in unlocks.all():
-        duration = ''
-        solvetime = ''
-        rank = ''
-        rankduration = ''
-        hints= ''
-        nbguesses = team.guess_set.filter(puzzle=unlock.puzzle).count()
-        try:
-          solve = solves.get(puzId=unlock.puzId)
-          solvetime = solve.time
-          duration = solve.duration
-          rank = int_to_rank(PuzzleSolve.objects.filter(puzzle= unlock.puzzle, guess__guess_time__lt= solvetime).count()+1)
-     #     wrap = ExpressionWrapper(F('guess__guess_time')-F('unlock_time'), output_field=fields.DurationField())
-          rankduration = int_to_rank(PuzzleSolve.objects.filter(puzzle = unlock.puzzle, duration__lt=duration).count()+1)
-          hints = sum([hint.delay_for_team(team) < duration for hint in unlock.puzzle.hint_set.all()])
-          duration = format_duration(duration)
-        except ObjectDoesNotExist:
-          pass
-
-        solves_data.append({'name' : unlock.name, 'pk':unlock.puzzle.pk, 'sol_time': solvetime , 'duration' : duration, 'rank' : rank, 'rankduration': rankduration, 'hints': hints, 'nbguesses': nbguesses})
-
-      context = {'solve_data': solves_data, 'team': {'team_name': team.team_name, 'size': team.size}, 'hunt': {'hunt_name':hunt.hunt_name, 'display_start_date': hunt.display_start_date}}
-      
-      # write json
-      with open(filename, 'w') as outfile:
-        json.dump(context, outfile, cls=DjangoJSONEncoder)
-    
-    
+    context = None
+    if hunt is not None and request.GET.get("team", "").isdigit():
+      # teams of other hunts have no artifact in this hunt
+      context = get_artifact_store().get(hunt.pk, TEAM % int(request.GET["team"]))
+    if context is None:
+      return render(request, 'stats/team.html', {'hunt': None})
+    _parse_times(context['solve_data'], 'sol_time')
     return render(request, 'stats/team.html', context)
 
 
@@ -223,51 +116,10 @@ def team(request):
 def puzzles(request):
     ''' Summary of all puzzles: #teams successful, fastest time / duration / smallest number of hints, average duration / number of hints, link to solution file '''
     hunt = get_last_hunt_or_none(request)
-    if hunt == None:
-      context = {'hunt': None}
-      return render(request, 'stats/puzzles.html', context)
-
-    
-    # load json if exists & non staff
-    template_filename =  'stats/static/puzzles.json'
-    filename =  'hunts/templates/' + template_filename
-
-    if ((not request.user.is_staff or not UPDATE_STATS) and os.path.exists(filename)):
-      with open(filename) as json_file:
-        context = json.load(json_file)
-        for d in context['data']:
-          d.update({'min_time': parse_datetime(d['min_time'])})
-          d.update({'av_time': parse_datetime(d['av_time'])})
-          
-    else:
-      puzzle_list = [puzzle for episode in hunt.episode_set.order_by('ep_number').all() for puzzle in episode.puzzle_set.all()]
-
-      data = []
-      reftime = timezone.now()
-      for puz in puzzle_list:
-        solves = PuzzleSolve.objects.filter(puzzle=puz)
-        unlocks = TeamPuzzleLink.objects.filter(puzzle=puz)
-        dic = solves.annotate(ref=F('guess__guess_time')-reftime).aggregate(min_time = Min('ref')+reftime, av_dur= Avg('duration'), min_dur = Min('duration'), av_time=Avg('ref')+reftime)
-        dic['av_dur'] = format_duration(dic['av_dur'])
-        dic['min_dur'] = format_duration(dic['min_dur'])
-        dic['success'] = solves.count()
-        dic['name'] = puz.puzzle_name
-        hints = [sum([hint.delay_for_team(sol.team) < sol.duration for hint in puz.hint_set.all()]) for sol in solves]
-        dic['min_hints'] = 0 if len(hints)==0 else min(hints)
-        dic['av_hints'] =  0 if len(hints)==0 else round(sum(hints)/len(hints), 2)
-        if (unlocks.count() == 0):
-          dic['guesses'] = 0
-        else:
-          dic['guesses'] = round(Guess.objects.filter(puzzle=puz).count() / unlocks.count(), 2)
-        dic['pk'] = puz.pk
-        data.append(dic)
-        
-      context = {'hunt': {'hunt_name':hunt.hunt_name, 'display_start_date': hunt.display_start_date}, 'data': data}
-      
-      # write json
-      with open(filename, 'w') as outfile:
-        json.dump(context, outfile, cls=DjangoJSONEncoder)
-    
+    context = None if hunt is None else get_artifact_store().get(hunt.pk, PUZZLES)
+    if context is None:
+      return render(request, 'stats/puzzles.html', {'hunt': None})
+    _parse_times(context['data'], 'min_time', 'av_time')
     return render(request, 'stats/puzzles.html', context)
 
 
@@ -276,83 +128,16 @@ def puzzles(request):
 def puzzle(request):
     ''' Summary of 1 puzzle results: each team duration, time solved, guesses, number of hints seen, duration to get each eureka. Also show all eurekas / hints '''
     hunt = get_last_hunt_or_none(request)
-    context = {'name': "No hunt found"}
     if hunt == None:
-      return render(request, 'stats/puzzle.html', context)
-
-    context = {'name': "No puzzle found"}
-    try:
-      puz = Puzzle.objects.get(pk=request.GET.get("puzzle"))
-    except ObjectDoesNotExist:
-      return render(request, 'stats/puzzle.html', context)
-
-
-    context = {'name': "Puzzle from wrong hunt"}
-    if puz.episode.hunt != hunt:
-      return render(request, 'stats/puzzle.html', context)
-
-
-    
-    
-    # load json if exists & non staff
-    template_filename =  'stats/static/puzzle-' + str(request.GET.get("puzzle")) + '.json'
-    filename =  'hunts/templates/' + template_filename
-
-    if ((not request.user.is_staff or not UPDATE_STATS) and os.path.exists(filename)):
-      with open(filename) as json_file:
-        context = json.load(json_file)
-        for d in context['data']:
-          d.update({'sol_time': parse_datetime(d['sol_time'])})
-
-    else:
-    
-      solves = PuzzleSolve.objects.filter(puzzle=puz)
-
-      data = []
-
-      for sol in solves:
-        duration = sol.duration
-        sol_time = sol.guess.guess_time
-        guesses = sol.team.guess_set.filter(puzzle=puz, guess_time__lte=sol_time).count()
-        hints = sum([hint.delay_for_team(sol.team) < sol.duration for hint in puz.hint_set.all()])
-        eurekas = [ {'txt' : eur.eureka.answer , 'time': format_duration(eur.time - sol_time + duration) } for eur in sol.team.teameurekalink_set.filter(eureka__puzzle=puz,time__lt=sol_time).all()]
-        data.append({'duration':format_duration(duration), 'sol_time': sol_time, 'guesses':guesses, 'hints': hints, 'eurekas':eurekas, 'team':sol.team.team_name, 'team_pk':sol.team.pk})
-        
-        
-      guesses = Guess.objects.filter(puzzle=puz).annotate(teampk=F('team'))
-      
-      guesses = list(dict.fromkeys([(g.guess_text.lower().replace(" ", ""), g.teampk) for g in guesses.all()])) # remove duplicate guesses per team
-      guesses = Counter(elem[0] for elem in guesses).most_common(30) # want 10 most common uncorrect answers, take some margin to remove eureka and answers
-      
-      common_guess = []
-      
-      for g,c in guesses:
-        if c < 2:
-          break
-        if (g == puz.answer.lower().replace(" ","") or
-                 (puz.answer_regex!="" and re.fullmatch(puz.answer_regex, g, re.IGNORECASE))):
-          continue
-          
-        eur = False
-        for resp in puz.eureka_set.all():
-          if(re.fullmatch(resp.regex.replace(" ",""), g, re.IGNORECASE)):
-            eur = True
-            break
-        if eur:
-          continue
-        
-        common_guess.append({'txt': g, 'teams': c})
-        if len(common_guess) > 9 :
-          break
-        
-
-      context = {'hunt': {'hunt_name':hunt.hunt_name, 'display_start_date': hunt.display_start_date}, 'data':data, 'name': puz.puzzle_name, 'common_guess': common_guess }
-      
-      # write json
-      with open(filename, 'w') as outfile:
-        json.dump(context, outfile, cls=DjangoJSONEncoder)
-        
-        
+      return render(request, 'stats/puzzle.html', {'name': "No hunt found"})
+
+    context = None
+    if request.GET.get("puzzle", "").isdigit():
+      # puzzles of other hunts have no artifact in this hunt
+      context = get_artifact_store().get(hunt.pk, PUZZLE % int(request.GET["puzzle"]))
+    if context is None:
+      return render(request, 'stats/puzzle.html', {'name': "No puzzle found"})
+    _parse_times(context['data'], 'sol_time')
     return render(request, 'stats/puzzle.html', context)
 
 
@@ -360,71 +145,44 @@ def puzzle(request):
 def charts(request):
     ''' CHARTSSSS: progress of all teams with toggles / top teams, spam contest by user / team , top / average teams time for each puzzle '''
     hunt = get_last_hunt_or_none(request)
-    if hunt == None:
+    context = None if hunt is None else get_artifact_store().get(hunt.pk, CHARTS)
+    if context is None:
       context = {'hunt': None}
-      return render(request, 'stats/charts.html', context)
-
-
-
-    # load json if exists & non staff
-    template_filename =  'stats/static/charts.json'
-    filename =  'hunts/templates/' + template_filename
-
-    if ((not request.user.is_staff or not UPDATE_STATS) and os.path.exists(filename)):
-      with open(filename) as json_file:
-        context = json.load(json_file)
-    
-    else:        
-    
-      spams = list(Guess.objects.filter(puzzle__episode__hunt=hunt).values(name=F('user__username' )).annotate(c=Count('name')).order_by('-c')[:10])
-      spam_teams = list(Guess.objects.filter(puzzle__episode__hunt=hunt).values(team_name=F('team__team_name'),team_iid=F('team')).annotate(c=Count('team_name')).order_by('-c')[:10])
-
-
-
-      # Chart solve over time
-      solve_time = []
-      teams = Team.objects.filter(hunt=hunt)
-      teams = teams.annotate(solves=Count('puz_solved')).filter(solves__gt=0)
-      teams = teams.annotate(last_time=Max('puzzlesolve__guess__guess_time'))
-      teams = teams.order_by(F('solves').desc(nulls_last=True),
-                                     F('last_time').asc(nulls_last=True))
-                                     
-      for ep in hunt.episode_set.order_by('ep_number').all():
-        minTime = timezone.now()
-        solve_ep = []
-        for team in teams:
-          solves = team.puzzlesolve_set.filter(puzzle__episode=ep)
-          solves = solves.order_by('guess__guess_time').values_list('guess__guess_time', flat=True)
-          if len(solves)>0:
-            minTime = min(minTime, min(solves))
-          solves = [sol.isoformat() for sol in solves]
-          solves += [None] * (ep.puzzle_set.count() - len(solves))
-
-          solve_ep.append({'solve': solves, 'name': team.team_name})
-        names = ep.puzzle_set.values_list('puzzle_name',flat=True)
-        solve_time.append({'solve': solve_ep, 'names': list(names), 'min': minTime.isoformat()})
-
-
-      #Chart fast / average puzzle solves
-      puzzle_list = [puzzle for episode in hunt.episode_set.order_by('ep_number').all() for puzzle in episode.puzzle_set.all()]
+    return render(request, 'stats/charts.html', context)
 
-      data_puz = []
-      for puz in puzzle_list:
-        solves = PuzzleSolve.objects.filter(puzzle=puz).order_by('duration')
-        dic = solves.aggregate(av_dur= Avg('duration'), min_dur = Min('duration'))
-        if len(solves)>0:
-          dic =  {'av_dur': datetime.fromtimestamp(dic['av_dur'].total_seconds(), timezone.utc).isoformat()[:-13] , 
-          'min_dur': datetime.fromtimestamp(dic['min_dur'].total_seconds(), timezone.utc).isoformat()[:-13],
-          'med_dur': datetime.fromtimestamp(solves[math.floor(solves.count()/2-1)].duration.total_seconds(), timezone.utc).isoformat()[:-13],
-          'name': puz.puzzle_name}
-        else:
-          dic =  {'av_dur': None, 'min_dur': None,  'name': puz.puzzle_name, 'med_dur': None}
-        data_puz.append(dic)
-    
-      context = { 'hunt': {'hunt_name':hunt.hunt_name, 'display_start_date': hunt.display_start_date}, 'spammers' : spams, 'spam_teams': spam_teams, 'solve_time':solve_time, 'data_puz': data_puz}
-    
-      # write json
-      with open(filename, 'w') as outfile:
-        json.dump(context, outfile, cls=DjangoJSONEncoder)
 
-    return render(request, 'stats/charts.html', context)
+@login_required
+def charts_data(request):
+    ''' The progress curves of the charts page as gzipped JSON, prepared once per stats build. ?teams=N keeps at least the N best teams '''
+    hunt = get_last_hunt_or_none(request)
+    store = get_artifact_store()
+    build_id = None if hunt is None else store.build_id(hunt.pk)
+    if build_id is None:
+      return HttpResponseNotFound()
+
+    limit = request.GET.get("teams", "")
+    # a bounded number of cached payloads per build, whatever the values asked for
+    limit = int(limit) if limit.isdigit() else None
+    if limit is not None:
+      limit = next((size for size in CHARTS_TEAM_LIMITS if size >= limit), None)
+    key = "charts-data:%s:%s:%s" % (hunt.pk, build_id, limit)
+    payload = cache.get(key)
+    if payload is None:
+      data = store.get(hunt.pk, CHARTS_DATA)
+      if data is None:
+        return HttpResponseNotFound()
+      if limit is not None:
+        data['teams'] = data['teams'][:limit]
+        data['names'] = data['names'][:limit]
+        for ep in data['episodes']:
+          ep['solves'] = ep['solves'][:limit]
+      payload = gzip.compress(json.dumps(data, separators=(',', ':')).encode())
+      cache.set(key, payload, 24 * 3600)
+
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+      response = HttpResponse(payload, content_type='application/json')
+      response['Content-Encoding'] = 'gzip'
+    else:
+      response = HttpResponse(gzip.decompress(payload), content_type='application/json')
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -242,6 +242,10 @@ if os.environ.get("SENTRY_DSN"):
 
 # ENV settings
 DEBUG = os.getenv("DJANGO_ENABLE_DEBUG", default="False").lower() == "true"
+# How protected puzzle/solution files are sent, see hunts.files: x-accel, sendfile or stream
+PROTECTED_FILE_BACKEND = os.getenv("DJANGO_FILE_BACKEND", default="stream" if DEBUG else "x-accel")
+# Where the stats pages built by hunts.tasks.build_hunt_stats are kept, see hunts.artifacts: cache or media
+STATS_ARTIFACT_STORE = os.getenv("DJANGO_STATS_STORE", default="cache")
 SECRET_KEY = os.environ.get("DJANGO_SECRET_KEY")
 DATABASES = {'default': dj_database_url.config(conn_max_age=600)}
 
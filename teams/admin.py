@@ -130,7 +130,28 @@ class TeamAdmin(admin.ModelAdmin):
 
 
 
-class PuzzleSolveAdmin(admin.ModelAdmin):
+class StandingsAdminMixin(object):
+    """ Keeps the standings of the hunt up to date when staff edit or delete solves """
+
+    def rebuild_standings(self, hunt_pks):
+        for hunt_pk in set(hunt_pks):
+            models.TeamStanding.objects.rebuild(hunt_pk)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self.rebuild_standings([obj.team.hunt_id])
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        self.rebuild_standings([obj.team.hunt_id])
+
+    def delete_queryset(self, request, queryset):
+        hunt_pks = list(queryset.values_list('team__hunt', flat=True).distinct())
+        super().delete_queryset(request, queryset)
+        self.rebuild_standings(hunt_pks)
+
+
+class PuzzleSolveAdmin(StandingsAdminMixin, admin.ModelAdmin):
     list_display = ['__str__', 'solve_time']
     autocomplete_fields = ['team', 'guess']
     list_filter = [('puzzle', RelatedDropdownFilter),('team', RelatedDropdownFilter),('puzzle__episode', RelatedDropdownFilter)]
@@ -148,7 +169,7 @@ class TeamPuzzleLinkAdmin(admin.ModelAdmin):
     list_filter = [('puzzle', RelatedDropdownFilter),('team', RelatedDropdownFilter),('puzzle__episode', RelatedDropdownFilter)]
 
 
-class EpisodeSolveAdmin(admin.ModelAdmin):
+class EpisodeSolveAdmin(StandingsAdminMixin, admin.ModelAdmin):
     list_display = ['__str__', 'time']
     autocomplete_fields = ['team']
     list_filter = [('episode', RelatedDropdownFilter),('team', RelatedDropdownFilter)]
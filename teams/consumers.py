@@ -13,6 +13,7 @@
 import asyncio
 from collections import defaultdict
 from datetime import datetime
+from urllib.parse import parse_qs
 
 from asgiref.sync import async_to_sync, sync_to_async
 from channels.generic.websocket import JsonWebsocketConsumer
@@ -23,8 +24,8 @@ from django.db import transaction
 from django.db.models.signals import pre_save, post_save, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
-from .models import Guess, TeamEurekaLink
-from hunts.models import Puzzle, Hunt, Hint
+from .models import Guess, TeamEurekaLink, progress_group
+from hunts.models import Puzzle, Hunt, Hint, get_current_hunt, get_hunt_by_number
 
 from . import utils
 
@@ -52,10 +53,13 @@ def pre_save_handler(func):
     transaction has been successfully committed, ensuring that the instance argument is stored in the database and
     accessible via database connections in other threads, and that data is ready to be sent to clients."""
     def inner(cls, sender, instance, *args, **kwargs):
-        try:
-            old = type(instance).objects.get(pk=instance.pk)
-        except ObjectDoesNotExist:
-            old = None
+        # A new instance has nothing in the database yet, no need to query it
+        old = None
+        if instance.pk is not None:
+            try:
+                old = type(instance).objects.get(pk=instance.pk)
+            except ObjectDoesNotExist:
+                old = None
 
         def after_commit():
             func(cls, old, sender, instance, *args, **kwargs)
@@ -88,7 +92,7 @@ class TeamMixin:
         # tenant or anything!
         # This means this is a bit weirdly placed.
         try:
-            hunt = get_object_or_404(Hunt, hunt_number=self.scope['url_route']['kwargs']['hunt_num'])
+            hunt = get_hunt_by_number(self.scope['url_route']['kwargs']['hunt_num'])
             self.team = hunt.team_from_user(self.scope['user'])
         except (ObjectDoesNotExist, AttributeError):
             # A user on the website will never open the websocket without getting a userprofile and team.
@@ -366,5 +370,91 @@ class PuzzleWebsocket(JsonWebsocketConsumer):
             })
 
 
+class StaffQueueWebsocket(JsonWebsocketConsumer):
+    """ Pushes the guesses of the current hunt to the staff queue as they are made or answered,
+    optionally only those of one team or puzzle (?team_id=...&puzzle_id=...) """
+
+    @classmethod
+    def _queue_groupname(cls, hunt_pk):
+        return f'staff-queue.hunt-{hunt_pk}'
+
+    def connect(self):
+        if not self.scope['user'].is_staff:
+            self.close()
+            return
+        try:
+            hunt = get_current_hunt()
+        except Hunt.DoesNotExist:
+            self.close()
+            return
+        query = parse_qs(self.scope['query_string'].decode())
+        self.team_id = self._int_param(query, 'team_id')
+        self.puzzle_id = self._int_param(query, 'puzzle_id')
+        self.group = self._queue_groupname(hunt.pk)
+        async_to_sync(self.channel_layer.group_add)(self.group, self.channel_name)
+        self.accept()
+
+    def disconnect(self, close_code):
+        if hasattr(self, 'group'):
+            async_to_sync(self.channel_layer.group_discard)(self.group, self.channel_name)
+
+    @staticmethod
+    def _int_param(query, name):
+        values = query.get(name, [])
+        return int(values[0]) if len(values) > 0 and values[0].isdigit() else None
+
+    def queue_guess(self, event):
+        guess = event['guess']
+        if ((self.team_id is not None and guess['team'] != self.team_id) or
+                (self.puzzle_id is not None and guess['puzzle'] != self.puzzle_id)):
+            return
+        self.send_json({'type': 'guess', 'content': guess})
+
+    @classmethod
+    def send_guess(cls, guess):
+        """ guess should come with its team and puzzle, see _saved_guess """
+        layer = get_channel_layer()
+        async_to_sync(layer.group_send)(cls._queue_groupname(guess.hunt_id), {
+            'type': 'queue.guess',
+            'guess': guess.serialize_for_queue(),
+        })
+
+    # handler: Guess.post_save
+    @classmethod
+    def _saved_guess(cls, sender, instance, raw, *args, **kwargs):
+        if raw:
+            return
+
+        def send():
+            guess = instance
+            if not (Guess.team.is_cached(guess) and Guess.puzzle.is_cached(guess)):
+                # guesses saved without their team and puzzle (admin, scripts): one query for both
+                guess = Guess.objects.select_related('team', 'puzzle').get(pk=guess.pk)
+            if guess.team.location != "DUMMY":  # nocover
+                cls.send_guess(guess)
+        transaction.on_commit(send)
+
+
+class StaffProgressWebsocket(JsonWebsocketConsumer):
+    """ Pushes the HuntEvents of an episode to its staff progress pages, in batches of the events
+    committed together (see teams.models.HuntEventManager) """
+
+    def connect(self):
+        if not self.scope['user'].is_staff:
+            self.close()
+            return
+        self.group = progress_group(self.scope['url_route']['kwargs']['ep_pk'])
+        async_to_sync(self.channel_layer.group_add)(self.group, self.channel_name)
+        self.accept()
+
+    def disconnect(self, close_code):
+        if hasattr(self, 'group'):
+            async_to_sync(self.channel_layer.group_discard)(self.group, self.channel_name)
+
+    def progress_events(self, event):
+        self.send_json({'type': 'events', 'content': event['events']})
+
+
 pre_save.connect(PuzzleWebsocket._saved_guess, sender=Guess)
 pre_save.connect(PuzzleWebsocket._saved_teamEurekaLink, sender=TeamEurekaLink)
+post_save.connect(StaffQueueWebsocket._saved_guess, sender=Guess)
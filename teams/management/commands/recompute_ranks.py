@@ -0,0 +1,39 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from hunts.models import Hunt
+from teams.models import PuzzleSolve, EpisodeSolve, TeamStanding
+
+
+class Command(BaseCommand):
+    help = "Recomputes the ranks of puzzle and episode solves and the team standings, after solves were edited or imported"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hunt', type=int, help="Only recompute the ranks of the hunt with this number")
+
+    def handle(self, *args, **options):
+        hunt = None
+        if options['hunt'] is not None:
+            try:
+                hunt = Hunt.objects.get(hunt_number=options['hunt'])
+            except Hunt.DoesNotExist:
+                raise CommandError("There is no hunt number %d" % options['hunt'])
+
+        with transaction.atomic():
+            puzzles = PuzzleSolve.objects.recompute_ranks(hunt)
+            episodes = EpisodeSolve.objects.recompute_ranks(hunt)
+            hunts = [hunt] if hunt is not None else Hunt.objects.all()
+            standings = sum(TeamStanding.objects.rebuild(hunt) for hunt in hunts)
+        self.stdout.write(self.style.SUCCESS("Updated the ranks of %d puzzle solves and %d episode solves, "
+                                             "and %d team standings" % (puzzles, episodes, standings)))
@@ -0,0 +1,36 @@
+# Copyright (C) 2018 The MindbreakersServer Contributors.
+#
+# This file is part of MindbreakersServer.
+#
+# MindbreakersServer is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# MindbreakersServer is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from teams.models import Team
+
+
+class Command(BaseCommand):
+    help = "Recomputes the unlock counters of teams and unlocks everything they should have unlocked"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hunt', type=int, help="Only repair the teams of the hunt with this number")
+        parser.add_argument('--team', type=int, action='append', help="Only repair the team with this pk (repeatable)")
+
+    def handle(self, *args, **options):
+        teams = Team.objects.select_related('hunt').order_by('pk')
+        if options['hunt'] is not None:
+            teams = teams.filter(hunt__hunt_number=options['hunt'])
+        if options['team']:
+            teams = teams.filter(pk__in=options['team'])
+
+        for team in teams:
+            with transaction.atomic():
+                team.unlock_puzzles_and_episodes()
+            self.stdout.write("Repaired %s" % team.team_name)
+        self.stdout.write(self.style.SUCCESS("Repaired %d teams" % len(teams)))
@@ -0,0 +1,48 @@
+# Generated by Django 3.1.7 on 2021-05-20 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_counters(apps, schema_editor):
+    Puzzle = apps.get_model('hunts', 'Puzzle')
+    PuzzleSolve = apps.get_model('teams', 'PuzzleSolve')
+    TeamUnlockCounter = apps.get_model('teams', 'TeamUnlockCounter')
+    counters = {}
+    edges = Puzzle.unlocks.through.objects \
+        .filter(to_puzzle__episode=models.F('from_puzzle__episode')) \
+        .values_list('from_puzzle', 'to_puzzle')
+    successors = {}
+    for source, target in edges:
+        successors.setdefault(source, []).append(target)
+    for team, puzzle in PuzzleSolve.objects.values_list('team', 'puzzle'):
+        for target in successors.get(puzzle, []):
+            counters[(team, target)] = counters.get((team, target), 0) + 1
+    TeamUnlockCounter.objects.bulk_create(
+        [TeamUnlockCounter(team_id=team, puzzle_id=puzzle, solved_prerequisites=count)
+         for (team, puzzle), count in counters.items()],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hunts', '0013_auto_20210516_1459'),
+        ('teams', '0009_team_discord_linked'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeamUnlockCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('solved_prerequisites', models.IntegerField(default=0, help_text='The number of prerequisite puzzles solved by the team')),
+                ('puzzle', models.ForeignKey(help_text='The puzzle that this counter is for', on_delete=django.db.models.deletion.CASCADE, to='hunts.puzzle')),
+                ('team', models.ForeignKey(help_text='The team that this counter is for', on_delete=django.db.models.deletion.CASCADE, to='teams.team')),
+            ],
+            options={
+                'unique_together': {('puzzle', 'team')},
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.1.7 on 2021-05-24 18:40
+
+from django.db import migrations, models
+from django.db.models import F, Window
+from django.db.models.functions import Rank
+
+
+def fill_ranks(apps, schema_editor):
+    PuzzleSolve = apps.get_model('teams', 'PuzzleSolve')
+    EpisodeSolve = apps.get_model('teams', 'EpisodeSolve')
+    solves = list(PuzzleSolve.objects.annotate(
+        new_rank=Window(Rank(), partition_by=[F('puzzle')], order_by=F('guess__guess_time').asc()),
+        new_duration_rank=Window(Rank(), partition_by=[F('puzzle')], order_by=F('duration').asc())))
+    for solve in solves:
+        solve.rank = solve.new_rank
+        solve.duration_rank = solve.new_duration_rank
+    PuzzleSolve.objects.bulk_update(solves, ['rank', 'duration_rank'], batch_size=1000)
+
+    solves = list(EpisodeSolve.objects.annotate(
+        new_rank=Window(Rank(), partition_by=[F('episode')], order_by=F('time').asc())))
+    for solve in solves:
+        solve.rank = solve.new_rank
+    EpisodeSolve.objects.bulk_update(solves, ['rank'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teams', '0010_teamunlockcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='episodesolve',
+            name='rank',
+            field=models.PositiveIntegerField(default=0, help_text='The position of this solve among the solves of the episode'),
+        ),
+        migrations.AddField(
+            model_name='puzzlesolve',
+            name='duration_rank',
+            field=models.PositiveIntegerField(default=0, help_text='The position of this solve among the solves of the puzzle, by duration'),
+        ),
+        migrations.AddField(
+            model_name='puzzlesolve',
+            name='rank',
+            field=models.PositiveIntegerField(default=0, help_text='The position of this solve among the solves of the puzzle'),
+        ),
+        migrations.RunPython(fill_ranks, migrations.RunPython.noop),
+    ]
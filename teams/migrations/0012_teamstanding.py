@@ -0,0 +1,61 @@
+# Generated by Django 3.1.7 on 2021-05-26 21:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_standings(apps, schema_editor):
+    Team = apps.get_model('teams', 'Team')
+    TeamStanding = apps.get_model('teams', 'TeamStanding')
+    teams = Team.objects.annotate(
+        solves=models.Count('puzzlesolve', distinct=True),
+        last_solve_time=models.Max('puzzlesolve__guess__guess_time'),
+        episodes_solved=models.Count('episodesolve', distinct=True))
+    hunts = {}
+    for team in teams:
+        hunts.setdefault(team.hunt_id, []).append(team)
+    standings = []
+    for teams in hunts.values():
+        teams.sort(key=lambda team: (-team.solves, team.last_solve_time is None, team.last_solve_time))
+        for position, team in enumerate(teams):
+            previous = teams[position - 1] if position > 0 else None
+            if (previous is not None and
+                    (previous.solves, previous.last_solve_time) == (team.solves, team.last_solve_time)):
+                rank = standings[-1].rank
+            else:
+                rank = position + 1
+            standings.append(TeamStanding(team_id=team.pk, hunt_id=team.hunt_id, solves=team.solves,
+                                          last_solve_time=team.last_solve_time,
+                                          episodes_solved=team.episodes_solved, rank=rank))
+    TeamStanding.objects.bulk_create(standings, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hunts', '0013_auto_20210516_1459'),
+        ('teams', '0011_solve_ranks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeamStanding',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('solves', models.PositiveIntegerField(default=0, help_text='The number of puzzles solved by the team')),
+                ('last_solve_time', models.DateTimeField(blank=True, help_text='The time of the last puzzle solve of the team', null=True)),
+                ('episodes_solved', models.PositiveIntegerField(default=0, help_text='The number of episodes solved by the team')),
+                ('rank', models.PositiveIntegerField(default=1, help_text='The position of the team by solves, then by last solve time')),
+                ('hunt', models.ForeignKey(help_text='The hunt of the team', on_delete=django.db.models.deletion.CASCADE, to='hunts.hunt')),
+                ('team', models.OneToOneField(help_text='The team that this standing is for', on_delete=django.db.models.deletion.CASCADE, related_name='standing', to='teams.team')),
+            ],
+            options={
+                'verbose_name_plural': 'Team standings',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='teamstanding',
+            index=models.Index(fields=['hunt', 'rank'], name='teams_teams_hunt_id_26edb8_idx'),
+        ),
+        migrations.RunPython(fill_standings, migrations.RunPython.noop),
+    ]
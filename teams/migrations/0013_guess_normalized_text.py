@@ -0,0 +1,31 @@
+# Generated by Django 3.1.7 on 2021-05-28 10:12
+
+from django.db import migrations, models
+from django.db.models import Value
+from django.db.models.functions import Replace, Upper
+
+
+def fill_normalized_text(apps, schema_editor):
+    Guess = apps.get_model('teams', 'Guess')
+    # same as hunts.matching.normalize_guess
+    Guess.objects.update(normalized_text=Replace(Upper('guess_text'), Value(' '), Value('')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teams', '0012_teamstanding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='guess',
+            name='normalized_text',
+            field=models.CharField(default='', editable=False, help_text='The guess text as it is matched, see hunts.matching.normalize_guess', max_length=100),
+        ),
+        migrations.RunPython(fill_normalized_text, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='guess',
+            index=models.Index(fields=['puzzle', 'normalized_text', 'team'], name='teams_guess_puzzle__ba49da_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.1.7 on 2021-05-29 16:47
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def fill_hunts(apps, schema_editor):
+    Guess = apps.get_model('teams', 'Guess')
+    Puzzle = apps.get_model('hunts', 'Puzzle')
+    hunt = Puzzle.objects.filter(pk=OuterRef('puzzle')).values('episode__hunt')[:1]
+    Guess.objects.update(hunt=Subquery(hunt))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hunts', '0013_auto_20210516_1459'),
+        ('teams', '0013_guess_normalized_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='guess',
+            name='hunt',
+            field=models.ForeignKey(editable=False, help_text='The hunt of the puzzle, to page through the guesses of a hunt without joins', null=True, on_delete=django.db.models.deletion.CASCADE, to='hunts.hunt'),
+        ),
+        migrations.RunPython(fill_hunts, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='guess',
+            name='hunt',
+            field=models.ForeignKey(editable=False, help_text='The hunt of the puzzle, to page through the guesses of a hunt without joins', on_delete=django.db.models.deletion.CASCADE, to='hunts.hunt'),
+        ),
+        migrations.AddIndex(
+            model_name='guess',
+            index=models.Index(fields=['hunt', 'id'], name='teams_guess_hunt_id_a96140_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='guess',
+            index=models.Index(fields=['team', 'id'], name='teams_guess_team_id_ddb885_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='guess',
+            index=models.Index(fields=['puzzle', 'id'], name='teams_guess_puzzle__3b5646_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.7 on 2021-05-30 11:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hunts', '0013_auto_20210516_1459'),
+        ('teams', '0014_guess_hunt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HuntEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(choices=[('unlock', 'Unlock'), ('solve', 'Solve'), ('guess', 'Guess'), ('eureka', 'Eureka')], help_text='What happened', max_length=8)),
+                ('time', models.DateTimeField(help_text='The time of the event')),
+                ('payload', models.JSONField(default=dict, help_text='What the progress pages show of the event, the puzzle_id of the puzzle at least')),
+                ('episode', models.ForeignKey(help_text='The episode of the puzzle', on_delete=django.db.models.deletion.CASCADE, to='hunts.episode')),
+                ('hunt', models.ForeignKey(help_text='The hunt of the puzzle', on_delete=django.db.models.deletion.CASCADE, to='hunts.hunt')),
+                ('puzzle', models.ForeignKey(help_text='The puzzle that was unlocked, solved or guessed', on_delete=django.db.models.deletion.CASCADE, to='hunts.puzzle')),
+                ('team', models.ForeignKey(help_text='The team the event is about', on_delete=django.db.models.deletion.CASCADE, to='teams.team')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='huntevent',
+            index=models.Index(fields=['episode', 'id'], name='teams_hunte_episode_1ad90e_idx'),
+        ),
+    ]
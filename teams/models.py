@@ -10,18 +10,28 @@
 #
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db import models, transaction
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.utils.dateformat import DateFormat
 from dateutil import tz
 from django.conf import settings
-from datetime import timedelta
+from datetime import datetime, timedelta
 from enum import Enum
-from django.db.models.signals import post_save
+from django.db.models import Window
+from django.db.models.functions import Rank, RowNumber
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.template.defaultfilters import slugify
+from hunts.graph import get_hunt_graph
+from hunts.matching import get_matcher, normalize_guess
+from hunts.progress import bump_team_progress, bump_hunt_solves, can_see_puzzle, add_unlocked_puzzles, forget_unlocked_puzzles
+from hunts.resolver import invalidate_users
 
+import base64
+import binascii
 import os
 import re
 import uuid
@@ -31,6 +41,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 time_zone = tz.gettz(settings.TIME_ZONE)
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 class TeamManager(models.Manager):
     def search(self, query=None):
@@ -122,6 +133,13 @@ class Team(models.Model):
 
     objects = TeamManager()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """ Remembers the hunt the team was loaded with, see team_changed """
+        team = super().from_db(db, field_names, values)
+        team._loaded_hunt_id = team.__dict__.get('hunt_id')
+        return team
+
     @property
     def is_playtester_team(self):
         """ A boolean indicating whether or not the team is a playtesting team """
@@ -164,63 +182,131 @@ class Team(models.Model):
         """ The number of people on the team """
         return self.person_set.count()
 
+    def can_see_puzzle(self, puzzle):
+        """ Whether the team has unlocked the puzzle and the puzzle's episode has started for them """
+        return can_see_puzzle(self.pk, self.hunt_id, puzzle)
+
+    def unlock_puzzles(self, puzzle_pks):
+        """ Unlocks the given puzzles, which the team must not have unlocked yet: the unlock events
+        and cached sets are updated for all of them. Links created concurrently are ignored. """
+        now = timezone.now()
+        links = [TeamPuzzleLink(team=self, puzzle_id=pk, time=now) for pk in puzzle_pks]
+        if len(links) > 0:
+            logger.info("Team %s unlocked puzzles %s" % (str(self.team_name),
+                        str([link.puzzle_id for link in links])))
+            TeamPuzzleLink.objects.bulk_create(links, ignore_conflicts=True)
+            HuntEvent.objects.record_unlocks(self.hunt_id, links)
+            bump_team_progress(self.pk)
+            add_unlocked_puzzles(self.pk, self.hunt_id, [link.puzzle_id for link in links])
+
+    def unlock_episode_puzzles(self, episode_pks):
+        """ Unlocks the puzzles of the given episodes whose prerequisites are already met """
+        graph = get_hunt_graph(self.hunt_id)
+        puzzles = [pk for episode_pk in episode_pks for pk in graph.episode_puzzles(episode_pk)]
+        unlocked = set(self.teampuzzlelink_set.filter(puzzle__in=puzzles).values_list('puzzle', flat=True))
+        puzzles = [pk for pk in puzzles if pk not in unlocked]
+        ready = [pk for pk in puzzles if graph.required_for(pk) <= 0]
+        waiting = [pk for pk in puzzles if graph.required_for(pk) > 0]
+        if len(waiting) > 0:
+            counters = self.teamunlockcounter_set.filter(puzzle__in=waiting) \
+                .values_list('puzzle', 'solved_prerequisites')
+            ready += [pk for pk, count in counters if graph.required_for(pk) <= count]
+        self.unlock_puzzles(ready)
+
+    def unlock_episodes(self, episode_pks, headstart=timedelta(0)):
+        """ Unlocks the given episodes and their initial puzzles """
+        TeamEpisodeLink.objects.bulk_create(
+            [TeamEpisodeLink(team=self, episode_id=pk, headstart=headstart) for pk in episode_pks],
+            ignore_conflicts=True)
+        bump_team_progress(self.pk)
+        self.unlock_episode_puzzles(episode_pks)
+
+    def unlock_initial_episodes(self):
+        """ Unlocks the episodes of the hunt that do not have prerequisites """
+        self.unlock_episodes(get_hunt_graph(self.hunt_id).initial_episode_pks)
+
+    def finish_episode(self, episode):
+        """ Records the episode as solved and unlocks the next one with the headstart earned """
+        try:
+            with transaction.atomic():
+                TeamStanding.objects.record_episode_solve(self)
+                solve = EpisodeSolve.objects.create_ranked(team=self, episode=episode, time=timezone.now())
+        except IntegrityError:
+            return
+        previous_finishers = solve.rank - 1
+        logger.info("Team %s finished episode %s" % (str(self.team_name),
+                        str(episode.ep_number)))
+        if episode.unlocks_id is not None:
+            if (previous_finishers < len(episode.headstarts)):
+              headstart = episode.headstarts[previous_finishers]
+            else:
+              headstart = timedelta(0)
+            self.unlock_episodes([episode.unlocks_id], headstart)
+
+    def unlock_after_solve(self, puzzle):
+        """ Unlocks what a new solve of the puzzle gives access to. Only the successors of the
+        puzzle are considered, using the per-team counters of solved prerequisites, so the cost
+        does not depend on the size of the episode. """
+        graph = get_hunt_graph(self.hunt_id)
+        successors = graph.episode_successors(puzzle.pk)
+        if len(successors) > 0:
+            TeamUnlockCounter.objects.bulk_create(
+                [TeamUnlockCounter(team=self, puzzle_id=pk) for pk in successors],
+                ignore_conflicts=True)
+            TeamUnlockCounter.objects.filter(team=self, puzzle__in=successors) \
+                .update(solved_prerequisites=models.F('solved_prerequisites') + 1)
+            # the puzzles the team already has (unlocked by hand, or met more prerequisites than
+            # required) are left out, so that they are not logged as unlocked once more
+            counters = TeamUnlockCounter.objects.filter(team=self, puzzle__in=successors) \
+                .exclude(puzzle__unlocked_for=self).values_list('puzzle', 'solved_prerequisites')
+            self.unlock_puzzles([pk for pk, count in counters if graph.required_for(pk) <= count])
+
+        episode = puzzle.episode
+        if self.puzzlesolve_set.filter(puzzle__episode=episode).count() == graph.puzzle_count(episode.pk):
+            self.finish_episode(episode)
+
+    def rebuild_unlock_counters(self):
+        """ Recomputes the counters of solved prerequisites of the team from its solves.
+        Returns the counters as a dictionary puzzle pk => number of solved prerequisites """
+        graph = get_hunt_graph(self.hunt_id)
+        counts = {}
+        for solved in self.puzzlesolve_set.values_list('puzzle', flat=True):
+            if solved in graph.index:
+                for pk in graph.episode_successors(solved):
+                    counts[pk] = counts.get(pk, 0) + 1
+        with transaction.atomic():
+            self.teamunlockcounter_set.all().delete()
+            TeamUnlockCounter.objects.bulk_create(
+                [TeamUnlockCounter(team=self, puzzle_id=pk, solved_prerequisites=count) for pk, count in counts.items()])
+        return counts
+
     def unlock_puzzles_and_episodes(self):
-        """ Unlocks all puzzles and episodes a team is currently supposed to have unlocked """
+        """ Unlocks all puzzles and episodes a team is currently supposed to have unlocked.
+        This walks the whole hunt and is only meant to repair inconsistencies, the normal
+        flow goes through unlock_after_solve (see the repair_unlocks command) """
+        graph = get_hunt_graph(self.hunt_id)
+        counts = self.rebuild_unlock_counters()
 
         # Unlock the first episodes that do not have prerequisites
-        if self.ep_unlocked.count() == 0:
-            for ep in self.hunt.episode_set.filter(episode=None):
-                TeamEpisodeLink.objects.create(team=self, episode=ep)
+        if not self.teamepisodelink_set.exists():
+            self.unlock_initial_episodes()
 
+        solved = set(self.puzzlesolve_set.values_list('puzzle', flat=True))
+        unlocked = set(self.teampuzzlelink_set.values_list('puzzle', flat=True))
+        ep_solved = set(self.episodesolve_set.values_list('episode', flat=True))
         for ep in self.ep_unlocked.all():
             # skip if the episode was already solved
-            if ep in self.ep_solved.all():
+            if ep.pk in ep_solved:
                 continue
 
-            # puzzles and associated numbers
-            puzzles = [puzzle for puzzle in ep.puzzle_set.all()]
-            puz_numbers = [puz.puzzle_number for puz in puzzles]
-            num_solved = 0
-            
-            if len(puzzles)>0:
-              # mapping between a puzzle number and the number of prerequisite puzzles already solved by a team
-              mapping = [0]*(max(puz_numbers) + 1)
-
-              # go through each solved puzzle and add to mapping for each puzzle it unlocks
-              # we also count the number of solved puzzles to determine if ep was solved
-              for puz in self.puz_solved.filter(episode=ep):
-                  num_solved += 1
-                  for num in puz.unlocks.values_list('puzzle_number', flat=True):
-                      mapping[num] += 1
-
-            # See if we can unlock the next episode (if there remains one)
-            if num_solved==len(puzzles) and ep.unlocks!=None and ep.unlocks not in self.ep_unlocked.all():
-                logger.info("Team %s finished episode %s" % (str(self.team_name),
-                                str(ep.ep_number)))
-                previous_finishers = EpisodeSolve.objects.filter(episode=ep).count()
-                if (previous_finishers < len(ep.headstarts)):
-                  headstart = ep.headstarts[previous_finishers]
-                else:
-                  headstart = '00:00:00'
-                EpisodeSolve.objects.create(team=self, episode=ep, time=timezone.now())
-                TeamEpisodeLink.objects.create(team=self, episode=ep.unlocks, headstart = headstart)
-                continue #all puzzles from this episode already solved so unlocked
-            
-            # If ep do not have an unlocks but was finished, only create an EpisodeSolve (for weird admins)
-            if num_solved==len(puzzles):
-                EpisodeSolve.objects.create(team=self, episode=ep, time=timezone.now())
+            puzzles = graph.episode_puzzles(ep.pk)
+            if all(pk in solved for pk in puzzles):
+                # also unlocks the next episode if there remains one
+                self.finish_episode(ep)
                 continue
-            
-            # See if we can unlock any given puzzle (will only be exec if len(puzzles)>0 so mapping is well-defined)
-            unlocked_numbers = [puz.puzzle_number for puz in self.puz_unlocked.filter(episode=ep)]
-            for puz in puzzles:
-                if (puz.puzzle_number in unlocked_numbers):
-                    continue
-                if(puz.num_required_to_unlock <= mapping[puz.puzzle_number]):
-                    logger.info("Team %s unlocked puzzle %s" % (str(self.team_name),
-                                str(puz.puzzle_id)))
-                    TeamPuzzleLink.objects.create(team=self, puzzle=puz, time=timezone.now())
-        
+
+            self.unlock_puzzles([pk for pk in puzzles
+                                 if pk not in unlocked and graph.required_for(pk) <= counts.get(pk, 0)])
 
     def reset(self):
         """ Resets/deletes all of the team's progress """
@@ -229,13 +315,15 @@ class Team(models.Model):
         self.teamepisodelink_set.all().delete()
         self.episodesolve_set.all().delete()
         self.teameurekalink_set.all().delete()
+        self.teamunlockcounter_set.all().delete()
         self.puz_solved.clear()
         self.puz_unlocked.clear()
         self.ep_solved.clear()
         self.ep_unlocked.clear()
         self.guess_set.all().delete()
-        self.eureka
-        self.save()
+        TeamStanding.objects.rebuild(self.hunt_id)
+        bump_team_progress(self.pk)
+        self.unlock_initial_episodes()
 
     def __str__(self):
         return self.short_name
@@ -283,10 +371,101 @@ class Person(models.Model):
             return name
 
 
+def encode_queue_cursor(pk):
+    """ The opaque cursor of the staff queue pages starting next to the guess """
+    return base64.urlsafe_b64encode(str(pk).encode()).decode().rstrip('=')
+
+
+def decode_queue_cursor(cursor):
+    """ The pk of the guess of the cursor, raises ValueError if the cursor is malformed """
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError("Invalid cursor %r" % cursor)
+
+
+class GuessManager(models.Manager):
+    @transaction.atomic
+    def submit(self, team, user, puzzle, text):
+        """ Records a guess and responds to it within a single transaction.
+        The puzzle is expected to come with its episode and hunt already loaded.
+        Returns the guess and the response dictionary of Guess.respond """
+        guess = self.model(
+            guess_text=text,
+            team=team,
+            user=user,
+            puzzle=puzzle,
+            hunt=puzzle.episode.hunt,
+            guess_time=timezone.now())
+        guess.save()
+        return guess, guess.respond()
+
+    def queue_page(self, hunt, team_id=None, puzzle_id=None, before=None, after=None, size=30):
+        """ A page of the guesses of the hunt for the staff queue, newest first. The page starts
+        right before or right after the given cursors (see encode_queue_cursor), or at the newest
+        guess, and is found by pk so that deep pages cost as much as the first one. Returns the guesses
+        with the cursors of the older and newer pages, None when there are none. Raises ValueError if
+        a cursor is malformed. """
+        guesses = self.filter(hunt=hunt).exclude(team__location="DUMMY").select_related('team', 'puzzle')
+        if team_id is not None:
+            guesses = guesses.filter(team=team_id)
+        if puzzle_id is not None:
+            guesses = guesses.filter(puzzle=puzzle_id)
+        if after is not None:
+            after = decode_queue_cursor(after)
+            page = list(guesses.filter(pk__gt=after).order_by('pk')[:size + 1])
+            has_newer, has_older = len(page) > size, True
+            page = page[:size][::-1]
+        else:
+            if before is not None:
+                guesses = guesses.filter(pk__lt=decode_queue_cursor(before))
+            page = list(guesses.order_by('-pk')[:size + 1])
+            has_newer, has_older = before is not None, len(page) > size
+            page = page[:size]
+        older = encode_queue_cursor(page[-1].pk) if has_older and len(page) > 0 else None
+        if len(page) > 0:
+            newer = encode_queue_cursor(page[0].pk) if has_newer else None
+        else:
+            # an empty refresh keeps asking from where it was
+            newer = encode_queue_cursor(after) if after is not None else None
+        return page, older, newer
+
+    def modified_after(self, cursor):
+        """ The guesses created or updated after the queue cursor (see Guess.queue_cursor), in
+        modification order. Raises ValueError if the cursor is malformed. """
+        microseconds, pk = (int(part) for part in cursor.split('-'))
+        time = EPOCH + timedelta(microseconds=microseconds)
+        return self.filter(models.Q(modified_date__gt=time) | models.Q(modified_date=time, pk__gt=pk)) \
+            .order_by('modified_date', 'pk')
+
+    def common_wrong_answers(self, puzzle, limit=10, min_teams=2):
+        """ The wrong answers given by the most teams to the puzzle, as a list of dictionaries
+        {'txt': normalized guess, 'teams': number of distinct teams}. The guesses are grouped in the
+        database, the ones matching the answer or a eureka are skipped using the compiled matcher. """
+        matcher = get_matcher(puzzle)
+        groups = self.filter(puzzle=puzzle).order_by().values('normalized_text') \
+            .annotate(teams=models.Count('team', distinct=True)).filter(teams__gte=min_teams) \
+            .order_by('-teams', 'normalized_text').values_list('normalized_text', 'teams')
+        answers = []
+        for text, teams in groups.iterator(chunk_size=4 * limit):
+            if matcher.is_correct(text) or matcher.match_eureka(text) is not None:
+                continue
+            answers.append({'txt': text, 'teams': teams})
+            if len(answers) >= limit:
+                break
+        return answers
+
+
 class Guess(models.Model):
     """ A class representing a guess to a given puzzle from a given team """
     class Meta:
         verbose_name_plural = '     Guesses'
+        indexes = [
+            models.Index(fields=['puzzle', 'normalized_text', 'team']),
+            models.Index(fields=['hunt', 'id']),
+            models.Index(fields=['team', 'id']),
+            models.Index(fields=['puzzle', 'id']),
+        ]
 
     user = models.ForeignKey(
         User,
@@ -299,6 +478,11 @@ class Guess(models.Model):
     guess_time = models.DateTimeField()
     guess_text = models.CharField(
         max_length=100)
+    normalized_text = models.CharField(
+        max_length=100,
+        default='',
+        editable=False,
+        help_text="The guess text as it is matched, see hunts.matching.normalize_guess")
     response_text = models.CharField(
         blank=True,
         max_length=400,
@@ -307,9 +491,16 @@ class Guess(models.Model):
         "hunts.Puzzle",
         on_delete=models.CASCADE,
         help_text="The puzzle that this guess is in response to")
+    hunt = models.ForeignKey(
+        "hunts.Hunt",
+        on_delete=models.CASCADE,
+        editable=False,
+        help_text="The hunt of the puzzle, to page through the guesses of a hunt without joins")
     modified_date = models.DateTimeField(
         help_text="Last date/time of response modification")
 
+    objects = GuessManager()
+
     def serialize_for_ajax(self):
         """ Serializes the time, puzzle, team, and status fields for ajax transmission """
         message = dict()
@@ -320,13 +511,28 @@ class Guess(models.Model):
         message['status_type'] = "guess"
         return message
 
+    @property
+    def queue_cursor(self):
+        """ The position of the last modification of the guess, the staff queue asks for the
+        guesses modified after the last one it has seen """
+        return "%d-%d" % ((self.modified_date - EPOCH) // timedelta(microseconds=1), self.pk)
+
+    def serialize_for_queue(self):
+        """ Serializes the guess as a row of the staff queue, rendered by the browser """
+        if self.response_text == '':
+            status = "pending"
+        else:
+            status = "correct" if self.is_correct else "wrong"
+        return {'pk': self.pk, 'team': self.team_id, 'team_name': self.team.team_name,
+                'puzzle': self.puzzle_id, 'puzzle_name': self.puzzle.puzzle_name, 'text': self.guess_text,
+                'time_str': DateFormat(self.guess_time.astimezone(time_zone)).format("H:i (D d)"),
+                'status': status, 'cursor': self.queue_cursor}
+
     @property
     def is_correct(self):
         """ A boolean indicating if the guess given is exactly correct (matches either the
         answer or the non-empty regex). Spaces do not matter so are removed. """
-        noSpace = self.guess_text.upper().replace(" ","")
-        return ( noSpace == self.puzzle.answer.upper().replace(" ","") or
-                 (self.puzzle.answer_regex!="" and re.fullmatch(self.puzzle.answer_regex, noSpace, re.IGNORECASE)) )
+        return get_matcher(self.puzzle).is_correct(self.guess_text)
 
     @property
     def convert_markdown_response(self):
@@ -334,20 +540,32 @@ class Guess(models.Model):
         return re.sub(r'\[(.*?)\]\((.*?)\)', '<a href="\\2">\\1</a>', self.response_text)
 
     def save(self, *args, **kwargs):
-        """ Overrides the default save function to update the modified date on save """
+        """ Overrides the default save function to update the modified date and the normalized text on save """
         self.modified_date = timezone.now()
+        self.normalized_text = normalize_guess(self.guess_text)
+        if self.hunt_id is None:
+            self.hunt_id = self.puzzle.episode.hunt_id
         super(Guess, self).save(*args, **kwargs)
 
     def create_solve(self):
-        """ Creates a solve based on this guess """
-        unlock = self.team.teampuzzlelink_set.filter(puzzle=self.puzzle)
-        if unlock.count() == 1: #normal case
-          duration = self.guess_time - self.puzzle.starting_time_for_team(self.team)
+        """ Creates a solve based on this guess. Returns the new solve, or None if the team
+        had already solved the puzzle """
+        start = self.puzzle.unlock_time_for_team(self.team)
+        if start is not None: #normal case
+          duration = self.guess_time - start
         else:
-          duration = "00"
-        PuzzleSolve.objects.create(puzzle=self.puzzle, team=self.team, guess=self, duration=duration)
+          duration = timedelta(0)
+        # The unique constraint on (puzzle, team) tells us about previous solves, the savepoint
+        # keeps the surrounding transaction usable when it triggers
+        try:
+            with transaction.atomic():
+                TeamStanding.objects.record_puzzle_solve(self.team, self.guess_time)
+                solve = PuzzleSolve.objects.create_ranked(puzzle=self.puzzle, team=self.team, guess=self, duration=duration)
+        except IntegrityError:
+            return None
         logger.info("Team %s correctly solved puzzle %s" % (str(self.team.team_name),
                                                             str(self.puzzle.puzzle_id)))
+        return solve
 
     # Automatic guess response system
     # Returning an empty string means that huntstaff should respond via the queue
@@ -356,33 +574,36 @@ class Guess(models.Model):
         """ Takes the guess's text and uses various methods to craft and populate a response.
             If the response is correct a solve is created and the correct puzzles are unlocked"""
 
-        noSpace = self.guess_text.upper().replace(" ","")
+        matcher = get_matcher(self.puzzle)
         # Compare against correct answer
-        if(self.is_correct):
+        if(matcher.is_correct(self.guess_text)):
             # Make sure we don't have duplicate or after hunt guess objects
-            if(self.puzzle not in self.team.puz_solved.all()):
-                self.create_solve()
-                t = self.team
-                t.save()
-                t.refresh_from_db()
-                t.unlock_puzzles_and_episodes()
+            if self.create_solve() is not None:
+                self.team.unlock_after_solve(self.puzzle)
 
             return {"status": "correct", "message": "Correct!"}
 
         else:
             # TODO removed unlocked Eureka
-            for resp in self.puzzle.eureka_set.all():
-                if(re.fullmatch(resp.regex.replace(" ",""), noSpace, re.IGNORECASE)):
-                    if(resp not in self.team.eurekas.all()):
-                        TeamEurekaLink.objects.create(team=self.team, eureka=resp, time=timezone.now())
-                    if resp.admin_only:
-                      return {"status" : "wrong", "message" : "Wrong Answer" }
-                    else:
-                      return {"status": "eureka", "message": resp.get_feedback}
-            else:  # Give a default response if no regex matches
+            resp = matcher.match_eureka(self.guess_text)
+            if resp is None:  # Give a default response if no regex matches
                 # Current philosphy is to auto-can wrong answers: If it's not right, it's wrong
                 return {"status" : "wrong", "message" : "Wrong Answer" }
 
+            if not TeamEurekaLink.objects.filter(team=self.team, eureka_id=resp.pk).exists():
+                link = TeamEurekaLink(team=self.team, eureka_id=resp.pk, time=timezone.now())
+                # logged here where the hunt and puzzle are known, see eureka_logged
+                link.logged = True
+                link.save()
+                HuntEvent.objects.record(HuntEvent.EUREKA, self.hunt_id, self.team_id, self.puzzle_id,
+                                         link.time, eureka=resp.pk)
+            if resp.admin_only:
+              return {"status" : "wrong", "message" : "Wrong Answer" }
+            elif resp.feedback != '':
+              return {"status": "eureka", "message": resp.feedback}
+            else:
+              return {"status": "eureka", "message": self.puzzle.episode.hunt.eureka_feedback}
+
 
     def update_response(self, text):
         """ Updates the response with the given text """
@@ -395,12 +616,57 @@ class Guess(models.Model):
 
 
 
+def _lock(model, pk):
+    """ Locks the row until the end of the transaction """
+    list(model.objects.select_for_update().filter(pk=pk).values_list('pk', flat=True))
+
+
+class PuzzleSolveManager(models.Manager):
+    def create_ranked(self, puzzle, duration, **kwargs):
+        """ Creates a new solve of the puzzle with its ranks, as recompute_ranks gives them: the
+        rank is the position of the solve by guess time (the first created first among equal
+        times), the duration rank is shared by equal durations. The puzzle is locked so that
+        concurrent solves get distinct ranks, the solves slower than this one lose a place in
+        the duration ranking, and the ones guessed later (committed first) a place in the ranking. """
+        _lock(puzzle.__class__, puzzle.pk)
+        time = kwargs['guess'].guess_time
+        solves = self.filter(puzzle=puzzle)
+        counts = solves.aggregate(solves=models.Count('pk'),
+                                  later=models.Count('pk', filter=models.Q(guess__guess_time__gt=time)),
+                                  faster=models.Count('pk', filter=models.Q(duration__lt=duration)))
+        solves.filter(duration__gt=duration).update(duration_rank=models.F('duration_rank') + 1)
+        if counts['later'] > 0:
+            solves.filter(guess__guess_time__gt=time).update(rank=models.F('rank') + 1)
+        return self.create(puzzle=puzzle, duration=duration, rank=counts['solves'] - counts['later'] + 1,
+                           duration_rank=counts['faster'] + 1, **kwargs)
+
+    def recompute_ranks(self, hunt=None):
+        """ Recomputes all ranks in one pass with window functions, after solves were edited or
+        imported. Returns the number of solves updated. """
+        solves = self.all()
+        if hunt is not None:
+            solves = solves.filter(puzzle__episode__hunt=hunt)
+        solves = solves.annotate(
+            new_rank=Window(RowNumber(), partition_by=[models.F('puzzle')],
+                            order_by=[models.F('guess__guess_time').asc(), models.F('pk').asc()]),
+            new_duration_rank=Window(Rank(), partition_by=[models.F('puzzle')], order_by=models.F('duration').asc()))
+        changed = [solve for solve in solves
+                   if (solve.rank, solve.duration_rank) != (solve.new_rank, solve.new_duration_rank)]
+        for solve in changed:
+            solve.rank = solve.new_rank
+            solve.duration_rank = solve.new_duration_rank
+        self.bulk_update(changed, ['rank', 'duration_rank'], batch_size=1000)
+        return len(changed)
+
+
 class PuzzleSolve(models.Model):
     """ A class that links a team and a puzzle to indicate that the team has solved the puzzle """
     class Meta:
         verbose_name_plural = "    Puzzles solved by teams"
         unique_together = ('puzzle', 'team',)
 
+    objects = PuzzleSolveManager()
+
     puzzle = models.ForeignKey(
         "hunts.Puzzle",
         on_delete=models.CASCADE,
@@ -418,6 +684,12 @@ class PuzzleSolve(models.Model):
         default="00",
         help_text="Time between the puzzle unlocked and its solve" 
     )
+    rank = models.PositiveIntegerField(
+        default=0,
+        help_text="The position of this solve among the solves of the puzzle")
+    duration_rank = models.PositiveIntegerField(
+        default=0,
+        help_text="The position of this solve among the solves of the puzzle, by duration")
 
     def serialize_for_ajax(self):
         """ Serializes the puzzle, team, time, and status fields for ajax transmission """
@@ -464,12 +736,40 @@ class TeamPuzzleLink(models.Model):
         return self.team.short_name + ": " + self.puzzle.puzzle_name
 
 
+class EpisodeSolveManager(models.Manager):
+    def create_ranked(self, episode, **kwargs):
+        """ Creates a new solve of the episode with its rank, see PuzzleSolveManager """
+        _lock(episode.__class__, episode.pk)
+        solves = self.filter(episode=episode)
+        counts = solves.aggregate(solves=models.Count('pk'),
+                                  later=models.Count('pk', filter=models.Q(time__gt=kwargs['time'])))
+        if counts['later'] > 0:
+            solves.filter(time__gt=kwargs['time']).update(rank=models.F('rank') + 1)
+        return self.create(episode=episode, rank=counts['solves'] - counts['later'] + 1, **kwargs)
+
+    def recompute_ranks(self, hunt=None):
+        """ See PuzzleSolveManager.recompute_ranks """
+        solves = self.all()
+        if hunt is not None:
+            solves = solves.filter(episode__hunt=hunt)
+        solves = solves.annotate(
+            new_rank=Window(RowNumber(), partition_by=[models.F('episode')],
+                            order_by=[models.F('time').asc(), models.F('pk').asc()]))
+        changed = [solve for solve in solves if solve.rank != solve.new_rank]
+        for solve in changed:
+            solve.rank = solve.new_rank
+        self.bulk_update(changed, ['rank'], batch_size=1000)
+        return len(changed)
+
+
 class EpisodeSolve(models.Model):
     """ A class that links a team and an episode to indicate that the team has solved the episode """
     class Meta:
         verbose_name_plural = "  Episode solved by teams"
         unique_together = ('episode', 'team',)
 
+    objects = EpisodeSolveManager()
+
     episode = models.ForeignKey(
         "hunts.Episode",
         on_delete=models.CASCADE,
@@ -480,6 +780,9 @@ class EpisodeSolve(models.Model):
         help_text="The team that this solve is from")
     time = models.DateTimeField(
         help_text="The time the episode was finished by this team")
+    rank = models.PositiveIntegerField(
+        default=0,
+        help_text="The position of this solve among the solves of the episode")
 
     def serialize_for_ajax(self):
         """ Serializes the puzzle, team, time, and status fields for ajax transmission """
@@ -530,6 +833,149 @@ class TeamEpisodeLink(models.Model):
 
 
 
+class TeamUnlockCounter(models.Model):
+    """ A class that counts, for a team and a puzzle, how many prerequisites of the puzzle the
+    team has solved. The puzzle is unlocked once it reaches num_required_to_unlock. """
+    class Meta:
+        unique_together = ('puzzle', 'team',)
+
+    puzzle = models.ForeignKey(
+        "hunts.Puzzle",
+        on_delete=models.CASCADE,
+        help_text="The puzzle that this counter is for")
+    team = models.ForeignKey(
+        Team,
+        on_delete=models.CASCADE,
+        help_text="The team that this counter is for")
+    solved_prerequisites = models.IntegerField(
+        default=0,
+        help_text="The number of prerequisite puzzles solved by the team")
+
+    def __str__(self):
+        return self.team.short_name + ": " + self.puzzle.puzzle_name + " (" + str(self.solved_prerequisites) + ")"
+
+
+class TeamStandingManager(models.Manager):
+    def create_for_team(self, team):
+        """ Creates the standing of a new team, ranked after all the teams that solved something """
+        rank = self.filter(hunt=team.hunt_id, solves__gt=0).count() + 1
+        return self.create(team=team, hunt_id=team.hunt_id, rank=rank)
+
+    def record_puzzle_solve(self, team, time):
+        """ Counts a new puzzle solve of the team, at the given time, and moves it up the ranking.
+        The hunt is locked with the standing so that concurrent solves keep consistent ranks,
+        this must run in the transaction creating the solve. """
+        # The rank of a solve depends on the standings of all the teams of the hunt, which other
+        # solves move: locking only the standings read here would not keep a concurrent solve from
+        # moving another team across them. The solves of a hunt are thus serialized on its row, from
+        # the solve to the commit of its guess: a few indexed queries, the guesses of a team being
+        # rate limited to one every few seconds anyway.
+        standing = self.select_related('hunt').select_for_update(of=('self', 'hunt')).get(team=team)
+        solves = standing.solves + 1
+        better = self.filter(hunt=standing.hunt_id).filter(
+            models.Q(solves__gt=solves) | models.Q(solves=solves, last_solve_time__lt=time)).count()
+        # the teams that were ahead of (or tied with) the team and are now behind it, and the ones
+        # that reached the new number of solves after the time of this one (committed first while
+        # this solve was waiting for the lock)
+        was_ahead = models.Q(solves=standing.solves)
+        if standing.last_solve_time is not None:
+            was_ahead &= models.Q(last_solve_time__lte=standing.last_solve_time)
+        passed = self.filter(hunt=standing.hunt_id).exclude(pk=standing.pk) \
+            .filter(was_ahead | models.Q(solves=solves, last_solve_time__gt=time))
+        passed.update(rank=models.F('rank') + 1)
+        standing.solves = solves
+        standing.last_solve_time = time
+        standing.rank = better + 1
+        standing.save(update_fields=['solves', 'last_solve_time', 'rank'])
+        return standing
+
+    def record_episode_solve(self, team):
+        """ Counts a new episode solve of the team, the ranking does not depend on episodes """
+        self.filter(team=team).update(episodes_solved=models.F('episodes_solved') + 1)
+
+    def clear(self, hunt):
+        """ Resets the standings of all the teams of the hunt, see hunts.tasks.reset_hunt_progress """
+        self.filter(hunt=hunt).update(solves=0, last_solve_time=None, episodes_solved=0, rank=1)
+
+    def rebuild(self, hunt):
+        """ Recomputes the standings of the hunt from the solves, after solves were deleted or
+        edited. Only existing standings are updated. Returns the number of standings changed. """
+        teams = Team.objects.filter(hunt=hunt).annotate(
+            solves=models.Count('puzzlesolve', distinct=True),
+            last_solve_time=models.Max('puzzlesolve__guess__guess_time'),
+            episodes_solved=models.Count('episodesolve', distinct=True))
+        values = {team.pk: (team.solves, team.last_solve_time, team.episodes_solved) for team in teams}
+        ordered = sorted(values.items(), key=lambda item: (-item[1][0], item[1][1] is None, item[1][1]))
+        ranks = {}
+        for position, (pk, (solves, last_solve_time, episodes)) in enumerate(ordered):
+            previous = ordered[position - 1][1] if position > 0 else None
+            if previous is not None and previous[:2] == (solves, last_solve_time):
+                ranks[pk] = ranks[ordered[position - 1][0]]
+            else:
+                ranks[pk] = position + 1
+
+        changed = []
+        for standing in self.filter(hunt=hunt):
+            if standing.team_id not in values:
+                continue
+            solves, last_solve_time, episodes = values[standing.team_id]
+            new = (solves, last_solve_time, episodes, ranks[standing.team_id])
+            if (standing.solves, standing.last_solve_time, standing.episodes_solved, standing.rank) != new:
+                standing.solves, standing.last_solve_time, standing.episodes_solved, standing.rank = new
+                changed.append(standing)
+        self.bulk_update(changed, ['solves', 'last_solve_time', 'episodes_solved', 'rank'], batch_size=1000)
+        return len(changed)
+
+    def rebuild_on_commit(self, hunt_pk):
+        """ Rebuilds the standings of the hunt once the current transaction is committed. The teams
+        deleted together, by a queryset or with their hunt, share a single rebuild. """
+        connection = transaction.get_connection(self.db)
+        if any(getattr(func, 'standings_hunt', None) == hunt_pk for sids, func in connection.run_on_commit):
+            return
+
+        def rebuild():
+            self.rebuild(hunt_pk)
+        rebuild.standings_hunt = hunt_pk
+        transaction.on_commit(rebuild, using=self.db)
+
+
+class TeamStanding(models.Model):
+    """ The position of a team in the ranking of its hunt, kept up to date by the solve code paths
+    so that the leaderboard does not aggregate all the solves of the hunt """
+    class Meta:
+        verbose_name_plural = "Team standings"
+        indexes = [models.Index(fields=['hunt', 'rank'])]
+
+    objects = TeamStandingManager()
+
+    team = models.OneToOneField(
+        Team,
+        on_delete=models.CASCADE,
+        related_name='standing',
+        help_text="The team that this standing is for")
+    hunt = models.ForeignKey(
+        "hunts.Hunt",
+        on_delete=models.CASCADE,
+        help_text="The hunt of the team")
+    solves = models.PositiveIntegerField(
+        default=0,
+        help_text="The number of puzzles solved by the team")
+    last_solve_time = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="The time of the last puzzle solve of the team")
+    episodes_solved = models.PositiveIntegerField(
+        default=0,
+        help_text="The number of episodes solved by the team")
+    rank = models.PositiveIntegerField(
+        default=1,
+        help_text="The position of the team by solves, then by last solve time")
+
+    def __str__(self):
+        return self.team.short_name + ": " + str(self.rank)
+
+
+
 class TeamEurekaLink(models.Model):
     """ A class that links a team and a eureka to indicate that the team has unlocked the eureka """
     class Meta:
@@ -559,14 +1005,233 @@ class TeamEurekaLink(models.Model):
     def __str__(self):
         return self.team.short_name + ": " + self.eureka.answer
 
+
+
+def progress_group(episode_pk):
+    """ The channel group of the staff progress pages of the episode """
+    return f'staff-progress.episode-{episode_pk}'
+
+
+class HuntEventManager(models.Manager):
+    def _event(self, event_type, graph, team_pk, puzzle_pk, time, payload):
+        index = graph.index.get(puzzle_pk)
+        if index is None:
+            # a puzzle of another hunt, nothing to show on the progress pages of this one
+            return None
+        payload['puzzle_id'] = graph.puzzle_ids[index]
+        return self.model(event_type=event_type, hunt_id=graph.hunt_pk, episode_id=graph.episode_of[index],
+                          puzzle_id=puzzle_pk, team_id=team_pk, time=time, payload=payload)
+
+    def _broadcast(self, events):
+        """ Sends the committed events to the progress pages of their episodes """
+        batches = {}
+        for event in events:
+            batches.setdefault(event.episode_id, []).append(event.serialize_for_ajax())
+        layer = get_channel_layer()
+        for episode_pk, batch in batches.items():
+            async_to_sync(layer.group_send)(progress_group(episode_pk), {'type': 'progress.events', 'events': batch})
+
+    def _write_on_commit(self, events):
+        """ Writes the events once the current transaction is committed, all the events of a
+        transaction (or savepoint) in a single INSERT. The guess and solve paths do not pay one
+        query per event, and the ids the progress pages follow are only given once the progress
+        is committed, so a poll can hardly move past an event committed later. """
+        if len(events) == 0:
+            return
+        connection = transaction.get_connection(self.db)
+        if connection.in_atomic_block and len(connection.run_on_commit) > 0:
+            # joins the events waiting for the same savepoints (the ones of a savepoint rolled back
+            # are dropped with it) when nothing was scheduled since, to keep them in order
+            sids, func = connection.run_on_commit[-1]
+            if sids == set(connection.savepoint_ids) and hasattr(func, 'hunt_events'):
+                func.hunt_events.extend(events)
+                return
+
+        def write():
+            self._broadcast(self.bulk_create(write.hunt_events))
+        write.hunt_events = list(events)
+        transaction.on_commit(write, using=self.db)
+
+    def record(self, event_type, hunt_pk, team_pk, puzzle_pk, time, **payload):
+        """ Appends an event of the team on the puzzle to the log, once committed """
+        event = self._event(event_type, get_hunt_graph(hunt_pk), team_pk, puzzle_pk, time, payload)
+        if event is not None:
+            self._write_on_commit([event])
+        return event
+
+    def record_unlocks(self, hunt_pk, links):
+        """ Appends the unlock events of the TeamPuzzleLinks to the log, once committed """
+        graph = get_hunt_graph(hunt_pk)
+        events = [self._event(HuntEvent.UNLOCK, graph, link.team_id, link.puzzle_id, link.time, {}) for link in links]
+        events = [event for event in events if event is not None]
+        self._write_on_commit(events)
+        return events
+
+
+class HuntEvent(models.Model):
+    """ An append-only log of the unlocks, solves, guesses and eurekas of the teams, which the staff
+    progress pages follow with a single cursor """
+    class Meta:
+        indexes = [models.Index(fields=['episode', 'id'])]
+
+    UNLOCK = 'unlock'
+    SOLVE = 'solve'
+    GUESS = 'guess'
+    EUREKA = 'eureka'
+    EVENT_TYPES = [(UNLOCK, 'Unlock'), (SOLVE, 'Solve'), (GUESS, 'Guess'), (EUREKA, 'Eureka')]
+
+    event_type = models.CharField(
+        max_length=8,
+        choices=EVENT_TYPES,
+        help_text="What happened")
+    hunt = models.ForeignKey(
+        "hunts.Hunt",
+        on_delete=models.CASCADE,
+        help_text="The hunt of the puzzle")
+    episode = models.ForeignKey(
+        "hunts.Episode",
+        on_delete=models.CASCADE,
+        help_text="The episode of the puzzle")
+    puzzle = models.ForeignKey(
+        "hunts.Puzzle",
+        on_delete=models.CASCADE,
+        help_text="The puzzle that was unlocked, solved or guessed")
+    team = models.ForeignKey(
+        Team,
+        on_delete=models.CASCADE,
+        help_text="The team the event is about")
+    time = models.DateTimeField(
+        help_text="The time of the event")
+    payload = models.JSONField(
+        default=dict,
+        help_text="What the progress pages show of the event, the puzzle_id of the puzzle at least")
+
+    objects = HuntEventManager()
+
+    def serialize_for_ajax(self):
+        """ Serializes the event like the unlocks, solves and guesses used to be, without any query """
+        message = dict()
+        message['id'] = self.pk
+        message['puzzle'] = {'id': self.payload['puzzle_id']}
+        message['team_pk'] = self.team_id
+        df = DateFormat(self.time.astimezone(time_zone))
+        message['time_str'] = df.format("h:i a")
+        message['status_type'] = self.event_type
+        return message
+
+    def __str__(self):
+        return "%s %s of team %s on %s" % (self.event_type, self.pk, self.team_id, self.payload.get('puzzle_id'))
+
         
 # unlock puzzles when admin unlocks episode
 @receiver(post_save, sender=TeamEpisodeLink)
-def my_callback_episode(sender, instance, *args, **kwargs):
-  instance.team.unlock_puzzles_and_episodes()
+def my_callback_episode(sender, instance, created, *args, **kwargs):
+  if created:
+    instance.team.unlock_episode_puzzles([instance.episode_id])
 
 # pre-unlock episode and puzzles (lie on starting time) when a team is created 
 @receiver(post_save, sender=Team)
-def my_callback_team(sender, instance, *args, **kwargs):
-  instance.unlock_puzzles_and_episodes()
+def my_callback_team(sender, instance, created, *args, **kwargs):
+  if created:
+    TeamStanding.objects.create_for_team(instance)
+    instance.unlock_initial_episodes()
         
+
+# keep the user => team mapping of hunts.resolver up to date
+@receiver(m2m_changed, sender=Person.teams.through)
+def person_teams_changed(sender, instance, action, reverse, pk_set, *args, **kwargs):
+  if not reverse:
+    if action in ('post_add', 'post_remove', 'post_clear'):
+      invalidate_users([instance.user_id])
+  elif action == 'pre_clear':
+    invalidate_users(instance.person_set.values_list('user', flat=True))
+  elif action in ('post_add', 'post_remove'):
+    invalidate_users(Person.objects.filter(pk__in=pk_set).values_list('user', flat=True))
+
+@receiver(post_save, sender=Team)
+def team_changed(sender, instance, created, update_fields, *args, **kwargs):
+  previous_hunt_id = getattr(instance, '_loaded_hunt_id', None)
+  instance._loaded_hunt_id = instance.hunt_id
+  if not created:
+    bump_team_progress(instance.pk)
+    # only a team moved to another hunt changes the users mapping and the standings
+    if previous_hunt_id != instance.hunt_id and (update_fields is None or 'hunt' in update_fields):
+      invalidate_users(instance.person_set.values_list('user', flat=True))
+      TeamStanding.objects.filter(team=instance).exclude(hunt=instance.hunt_id).update(hunt=instance.hunt_id)
+      bump_hunt_solves(instance.hunt_id)
+      if previous_hunt_id is not None:
+        bump_hunt_solves(previous_hunt_id)
+
+@receiver(pre_delete, sender=Team)
+def team_deleted(sender, instance, *args, **kwargs):
+  invalidate_users(instance.person_set.values_list('user', flat=True))
+
+@receiver(post_delete, sender=Team)
+def team_removed(sender, instance, *args, **kwargs):
+  TeamStanding.objects.rebuild_on_commit(instance.hunt_id)
+
+@receiver(pre_delete, sender=Person)
+def person_deleted(sender, instance, *args, **kwargs):
+  invalidate_users([instance.user_id])
+
+
+# invalidate what is cached per team progress (see hunts.progress), bulk operations bump it themselves
+@receiver(post_save, sender=TeamPuzzleLink)
+@receiver(post_save, sender=PuzzleSolve)
+@receiver(post_save, sender=TeamEpisodeLink)
+@receiver(post_save, sender=EpisodeSolve)
+def progress_created(sender, instance, created, *args, **kwargs):
+  if created:
+    bump_team_progress(instance.team_id)
+
+@receiver(post_delete, sender=TeamPuzzleLink)
+@receiver(post_delete, sender=PuzzleSolve)
+@receiver(post_delete, sender=TeamEpisodeLink)
+@receiver(post_delete, sender=EpisodeSolve)
+def progress_deleted(sender, instance, *args, **kwargs):
+  bump_team_progress(instance.team_id)
+
+# keep the sets of unlocked puzzles used for access checks (see hunts.progress) up to date
+@receiver(post_save, sender=TeamPuzzleLink)
+def puzzle_unlocked(sender, instance, created, *args, **kwargs):
+  if created:
+    add_unlocked_puzzles(instance.team_id, instance.team.hunt_id, [instance.puzzle_id])
+
+@receiver(post_delete, sender=TeamPuzzleLink)
+def puzzle_relocked(sender, instance, *args, **kwargs):
+  forget_unlocked_puzzles(instance.team_id, instance.team.hunt_id)
+
+# conditional GETs of the leaderboard depend on the solves of all teams (see hunts.views.mixin)
+@receiver(post_save, sender=PuzzleSolve)
+def puzzle_solved(sender, instance, created, *args, **kwargs):
+  if created:
+    bump_hunt_solves(instance.team.hunt_id)
+
+@receiver(post_delete, sender=PuzzleSolve)
+def puzzle_unsolved(sender, instance, *args, **kwargs):
+  bump_hunt_solves(instance.team.hunt_id)
+
+# the log followed by the staff progress pages (see HuntEvent), bulk unlocks record themselves
+@receiver(post_save, sender=TeamPuzzleLink)
+def unlock_logged(sender, instance, created, *args, **kwargs):
+  if created:
+    HuntEvent.objects.record_unlocks(instance.team.hunt_id, [instance])
+
+@receiver(post_save, sender=PuzzleSolve)
+def solve_logged(sender, instance, created, *args, **kwargs):
+  if created:
+    HuntEvent.objects.record(HuntEvent.SOLVE, instance.team.hunt_id, instance.team_id, instance.puzzle_id,
+                             instance.guess.guess_time)
+
+@receiver(post_save, sender=Guess)
+def guess_logged(sender, instance, created, raw, *args, **kwargs):
+  if created and not raw:
+    HuntEvent.objects.record(HuntEvent.GUESS, instance.hunt_id, instance.team_id, instance.puzzle_id,
+                             instance.guess_time, text=instance.guess_text)
+
+@receiver(post_save, sender=TeamEurekaLink)
+def eureka_logged(sender, instance, created, *args, **kwargs):
+  # the eurekas found by guesses are logged by Guess.respond without loading the team and eureka
+  if created and not getattr(instance, 'logged', False):
+    HuntEvent.objects.record(HuntEvent.EUREKA, instance.team.hunt_id, instance.team_id, instance.eureka.puzzle_id,
+                             instance.time, eureka=instance.eureka_id)
@@ -16,4 +16,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r"^ws/puzzle/(?P<puzzle_id>[0-9a-zA-Z]{3,12})/$", consumers.PuzzleWebsocket.as_asgi(), name='puzzle_websocket'),
+    re_path(r"^ws/staff/queue/$", consumers.StaffQueueWebsocket.as_asgi(), name='staff_queue_websocket'),
+    re_path(r"^ws/staff/progress/(?P<ep_pk>[0-9]+)/$", consumers.StaffProgressWebsocket.as_asgi(), name='staff_progress_websocket'),
 ]
@@ -17,89 +17,89 @@ function setAllHidden(chart, hidden) {
       return '#' + (Math.random().toString(16) + '0000000').slice(2, 8); 
   };
 
-{% for ep in solve_time %}
-    var teamCanvas{{forloop.counter}} = $("canvas#chart_teams_{{forloop.counter}}");
-
-    if (teamCanvas{{forloop.counter}}.length != 1) {
-      return
-    }
+  function addButton(parent, text, style, onClick) {
+    var button = document.createElement('button');
+    button.className = 'btn btn-sm ' + style;
+    button.textContent = text;
+    button.addEventListener('click', onClick);
+    parent.appendChild(button);
+  }
 
-  let chart{{forloop.counter}} = new Chart(teamCanvas{{forloop.counter}}, {
-      type: 'line',
-      data: {
-        labels: [
-        {% for x in ep.names %}
-        "{{x | safe}}",
-        {%endfor%}
-        ],
-          
-        datasets: [
-{% for team in ep.solve %}
-          {
-            label: "{{team.name |truncatechars:40 }}",
-            data: [
-                  {% for point in team.solve %}
-                  {
-                  x: {{forloop.counter}},
-                  y: "{{point}}"
-                  },
-                  {%endfor%}
-                  ],
-        borderColor: randomColorGenerator(),
-        hidden: {% if forloop.counter < 11 %} false {%else%} true {%endif%}
-              },
-{%endfor%}
-        ]
-      },
-            options: {
-        scales: {
+  // see HuntStats.charts_data for the format: the solve times of every team are seconds since the
+  // start of the episode, each one stored as the difference with the previous one
+  function drawTeamCharts(data) {
+    var container = document.getElementById('team-charts');
+    data.episodes.forEach(function(ep, epIndex) {
+      var start = Date.parse(ep.start);
+      var min = null;
+      var datasets = ep.solves.map(function(deltas, teamIndex) {
+        var time = start;
+        var points = deltas.map(function(delta, k) {
+          time += delta * 1000;
+          return {x: k + 1, y: time};
+        });
+        if (points.length > 0 && (min === null || points[0].y < min)) {
+          min = points[0].y;
+        }
+        return {
+          label: data.names[teamIndex].substring(0, 40),
+          data: points,
+          borderColor: randomColorGenerator(),
+          hidden: teamIndex >= 10
+        };
+      });
+
+      var buttons = document.createElement('div');
+      buttons.className = 'statbtns';
+      container.appendChild(buttons);
+      var canvas = document.createElement('canvas');
+      canvas.className = 'statchart';
+      canvas.width = 600;
+      canvas.height = 350;
+      container.appendChild(canvas);
+
+      var chart = new Chart(canvas, {
+        type: 'line',
+        data: {labels: ep.names, datasets: datasets},
+        options: {
+          scales: {
             y: {
-                type: 'time',
-                min: "{{ep.min}}",
-                time: {
+              type: 'time',
+              min: min === null ? undefined : min,
+              time: {
                 tooltipFormat:'dd/MM HH:mm',
-                        displayFormats: {
-                        'millisecond':'dd/MM HH:mm',
-                         'second': 'dd/MM HH:mm',
-                         'minute': 'dd/MM HH:mm',
-                         'hour': 'dd/MM HH:mm',
-                         'day': 'dd/MM HH:mm',
-                         'week': 'dd/MM HH:mm',
-                         'month': 'dd/MM HH:mm',
-                         'quarter': 'dd/MM HH:mm',
-                         'year': 'dd/MM HH:mm',
-                        },
-                }
+                displayFormats: {
+                  'millisecond':'dd/MM HH:mm',
+                  'second': 'dd/MM HH:mm',
+                  'minute': 'dd/MM HH:mm',
+                  'hour': 'dd/MM HH:mm',
+                  'day': 'dd/MM HH:mm',
+                  'week': 'dd/MM HH:mm',
+                  'month': 'dd/MM HH:mm',
+                  'quarter': 'dd/MM HH:mm',
+                  'year': 'dd/MM HH:mm',
+                },
+              }
             },
-            },
-            
-            plugins:{
+          },
+          plugins:{
             title: {
               display: true,
-              text: 'Resolution times for Episode {{forloop.counter}}'
+              text: 'Resolution times for Episode ' + (epIndex + 1)
             }
-    }
+          }
         }
-      
-      
-      
-      
-      
-    });
-
-
-  let showAllButton{{forloop.counter}} = document.getElementById(`show-all-{{forloop.counter}}`)
-  showAllButton{{forloop.counter}}.addEventListener('click', function() {
-    setAllHidden(chart{{forloop.counter}}, false)
-  })
+      });
 
-  let hideAllButton{{forloop.counter}} = document.getElementById(`hide-all-{{forloop.counter}}`)
-  hideAllButton{{forloop.counter}}.addEventListener('click', function() {
-    setAllHidden(chart{{forloop.counter}}, true)
-  })
-
-{% endfor %}
+      addButton(buttons, 'Show All Teams', 'btn-outline-primary', function() { setAllHidden(chart, false); });
+      addButton(buttons, 'Hide All Teams', 'btn-outline-secondary', function() { setAllHidden(chart, true); });
+    });
+  }
 
+  var teamCharts = $("div#team-charts");
+  if (teamCharts.length == 1) {
+    $.getJSON(teamCharts.data('url'), drawTeamCharts);
+  }
 
   var puzCanvas = $("canvas#chart_puz");
 
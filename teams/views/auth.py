@@ -25,7 +25,7 @@ from django.core.exceptions import ValidationError
 import random
 import re
 
-from hunts.models import Hunt
+from hunts.models import Hunt, get_current_hunt
 from teams.models import Person, Team
 from teams.forms import UserForm, PersonForm
 from teams.utils import parse_attributes
@@ -97,8 +97,8 @@ class Registration(LoginRequiredMixin, View):
     post request. The rendered page is nearly entirely static.
     """
     def get(self, request):
-        curr_hunt = Hunt.objects.get(is_current_hunt=True)
-        team = curr_hunt.team_from_user(request.user)
+        curr_hunt = get_current_hunt()
+        team = request.team
 
         if(curr_hunt.is_locked):
             return redirect(reverse("index"))
@@ -110,10 +110,10 @@ class Registration(LoginRequiredMixin, View):
                           {'teams': teams, 'curr_hunt': curr_hunt})
 
     def post(self, request):
-        curr_hunt = Hunt.objects.get(is_current_hunt=True)
+        curr_hunt = get_current_hunt()
         
         if(request.POST["form_type"] == "create_team"):
-            if(request.user.person.teams.filter(hunt=curr_hunt).count()>0):
+            if(request.team is not None):
                 messages.error(request, "You already have a team for this hunt")
             elif len(request.POST.get("team_name")) > 100:
                 messages.error(request, "Your team name is too long")
@@ -160,8 +160,8 @@ class ManageTeam(View):
     """
 
     def get(self, request):
-        curr_hunt = Hunt.objects.get(is_current_hunt=True)
-        team = curr_hunt.team_from_user(request.user)
+        curr_hunt = get_current_hunt()
+        team = request.team
 
         if(team is not None):
             context = {'registered_team': team, 'curr_hunt': curr_hunt}
@@ -176,8 +176,8 @@ class ManageTeam(View):
 
 
     def post(self, request):
-        curr_hunt = Hunt.objects.get(is_current_hunt=True)
-        team = curr_hunt.team_from_user(request.user)
+        curr_hunt = get_current_hunt()
+        team = request.team
 
         if("form_type" in request.POST):
             if(request.POST["form_type"] == "leave_team"):